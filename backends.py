@@ -0,0 +1,418 @@
+"""
+Pluggable margin calculator backends and the multi-venue runner.
+
+A backend turns one positions file into {portfolio: margin}. ICE books run
+on ICA through a BrowserSession; EUREX books are sent to the Eurex Clearing
+Prisma Margin Estimator (PME) REST API. ``calculate_books`` splits a mixed
+request by venue, runs every venue at the same time and merges the results,
+so they are ready as soon as the slowest venue is, not after all of them.
+Totals are kept per currency; ICE and EUREX margins are never added up.
+
+    python backends.py "excels/ICE Live (2).xlsx" "excels/EUREX Live (3).csv"
+"""
+
+import abc
+import argparse
+import json
+import os
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+
+from margin_calculator import (
+    PORTFOLIO_COLUMN,
+    BrowserSession,
+    _phase,
+    get_browser_session,
+    read_positions,
+    run_margin_calc,
+)
+
+# ---------------------------------------------------------------------
+# CONFIG
+# ---------------------------------------------------------------------
+EUREX_API_URL = (
+    "https://api.developer.deutsche-boerse.com/prod/prisma-margin-estimator-2-0-0/estimator"
+)
+EUREX_API_KEY_ENV = "EUREX_PME_API_KEY"  # Environment variable with the API key
+EUREX_REQUEST_TIMEOUT = 120  # Seconds per PME request
+EUREX_MAX_REQUESTS = 4  # Portfolios priced in parallel on the PME API
+EUREX_MARGIN_LIST = "portfolio_margin"  # Response list with one entry per margin class
+EUREX_MARGIN_KEY = "initial_margin"  # Field of each entry holding the margin
+# EUREX position export column -> PME position field
+EUREX_FIELDS = {
+    "Product ID": "product_id",
+    "Contract Date": "contract_date",
+    "Call Put Flag": "call_put_flag",
+    "Exercise Price": "exercise_price",
+    "Version Number": "version_number",
+    "Net LS Balance": "net_ls_balance",
+}
+# ---------------------------------------------------------------------
+
+ICE = "ICE"
+EUREX = "EUREX"
+
+# Headers that identify a book's venue
+VENUE_HEADERS = {
+    ICE: ("Exchange Code", "Exchange Contract Code"),
+    EUREX: ("Product ID", "Contract Date", "Net LS Balance"),
+}
+
+# Currency each venue reports margins in
+VENUE_CURRENCIES = {ICE: "USD", EUREX: "EUR"}
+
+
+def venue_of(headers):
+    """Return ICE or EUREX for a header row, or None if neither matches."""
+    present = set(headers)
+    for venue, required in VENUE_HEADERS.items():
+        if all(h in present for h in required):
+            return venue
+    return None
+
+
+def detect_venue(path):
+    """Return ICE or EUREX from the headers of the positions file at ``path``."""
+    headers, _ = read_positions(path)
+    venue = venue_of(headers)
+    if venue is None:
+        raise ValueError(
+            f"Cannot tell the venue of {Path(path).name} from its headers: {headers}"
+        )
+    return venue
+
+
+def eurex_positions(headers, rows, default_portfolio):
+    """
+    Map EUREX export rows to PME positions, grouped by portfolio.
+
+    Rows without a ``Portfolio Name`` belong to ``default_portfolio``.
+    Returns: {portfolio: [PME position, ...]}
+    """
+    missing = [h for h in VENUE_HEADERS[EUREX] if h not in headers]
+    if missing:
+        raise ValueError(f"Missing EUREX column(s): {', '.join(missing)}")
+
+    index = {name: headers.index(name) for name in EUREX_FIELDS if name in headers}
+    portfolio_col = headers.index(PORTFOLIO_COLUMN) if PORTFOLIO_COLUMN in headers else None
+
+    books = {}
+    for _, values in rows:
+        portfolio = default_portfolio
+        if portfolio_col is not None and values[portfolio_col] not in (None, ""):
+            portfolio = str(values[portfolio_col]).strip()
+        position = {}
+        for column, i in index.items():
+            value = values[i]
+            if value is None or value == "":
+                continue
+            if column == "Contract Date":
+                value = str(int(value)) if isinstance(value, (int, float)) else str(value)
+            position[EUREX_FIELDS[column]] = value
+        books.setdefault(portfolio, []).append(position)
+    return books
+
+
+def pme_request(positions):
+    """PME estimator request body for one portfolio's positions."""
+    return {"portfolio_components": [{"type": "etd_portfolio", "etd_portfolio": positions}]}
+
+
+def split_by_venue(paths):
+    """Group ``paths`` by venue: {venue: [path, ...]} (input order kept)."""
+    groups = {}
+    for path in paths:
+        groups.setdefault(detect_venue(path), []).append(Path(path))
+    return groups
+
+
+class CalculatorBackend(abc.ABC):
+    """
+    One venue's margin calculator.
+
+    Subclasses implement ``calculate``; ``warm_up`` and ``close`` are
+    optional. Backends are used from one thread at a time.
+    """
+
+    name = None
+    venue = None
+
+    @abc.abstractmethod
+    def calculate(self, path, store=None, timeout=None, timings=None, progress=None):
+        """Price the book at ``path``. Returns: {portfolio: margin}."""
+
+    def warm_up(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class IcaBackend(CalculatorBackend):
+    """ICE books on ICA, automated through a BrowserSession."""
+
+    name = "ica"
+    venue = ICE
+
+    def __init__(self, session=None, headless=False, result_source=None):
+        self._session = session
+        self._owns_session = False
+        self.headless = headless
+        self.result_source = result_source
+
+    @property
+    def session(self) -> BrowserSession:
+        if self._session is None:
+            self._session = BrowserSession(
+                headless=self.headless, slow_mo=0 if self.headless else 150
+            )
+            self._owns_session = True
+        return self._session
+
+    def calculate(self, path, store=None, timeout=None, timings=None, progress=None):
+        return run_margin_calc(
+            path,
+            session=self.session,
+            store=store,
+            timeout=timeout,
+            timings=timings,
+            progress=progress,
+            result_source=self.result_source,
+        )
+
+    def warm_up(self):
+        self.session.warm_up()
+
+    def close(self):
+        if self._owns_session and self._session is not None:
+            self._session.close()
+            self._session = None
+
+
+class EurexBackend(CalculatorBackend):
+    """
+    EUREX books on the Prisma Margin Estimator REST API.
+
+    Each portfolio (the ``Portfolio Name`` column, or the whole file when
+    there is none) is one request; up to EUREX_MAX_REQUESTS run at once.
+    """
+
+    name = "eurex"
+    venue = EUREX
+
+    def __init__(self, api_url=EUREX_API_URL, api_key=None, max_requests=EUREX_MAX_REQUESTS):
+        self.api_url = api_url
+        self.api_key = api_key or os.environ.get(EUREX_API_KEY_ENV)
+        self.max_requests = max_requests
+
+    def calculate(self, path, store=None, timeout=None, timings=None, progress=None):
+        path = Path(path).resolve()
+        if not path.exists():
+            raise FileNotFoundError(f"Positions file not found: {path}")
+        if not self.api_key:
+            raise RuntimeError(f"No EUREX PME API key: set {EUREX_API_KEY_ENV}")
+
+        print(f"📤 Pricing {path.name} on EUREX PME...")
+        timings = {} if timings is None else timings
+        started_at = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+        try:
+            with _phase(timings, "upload", progress):
+                books = self._portfolios(path)
+            with _phase(timings, "run", progress):
+                with ThreadPoolExecutor(max_workers=max(1, self.max_requests)) as pool:
+                    results = pool.map(
+                        lambda item: (item[0], self._price(item[1], timeout)), books.items()
+                    )
+                    margins = dict(results)
+        except Exception as e:
+            print(f"\n❌ EUREX calculation failed: {e}")
+            if store is not None:
+                store.record_run(
+                    path,
+                    {},
+                    timings=timings,
+                    error=str(e),
+                    engine=self.name,
+                    started_at=started_at,
+                )
+            raise
+
+        for portfolio, margin in margins.items():
+            print(f"✅ {portfolio}: {margin:,.2f}")
+        if store is not None:
+            store.record_run(
+                path, margins, timings=timings, engine=self.name, started_at=started_at
+            )
+        return margins
+
+    def _portfolios(self, path):
+        """Group the file's rows into {portfolio: [PME position, ...]}."""
+        headers, rows = read_positions(path)
+        try:
+            return eurex_positions(headers, rows, path.stem)
+        except ValueError as e:
+            raise ValueError(f"{path.name}: {e}") from e
+
+    def _price(self, positions, timeout=None):
+        request = urllib.request.Request(
+            self.api_url,
+            data=json.dumps(pme_request(positions)).encode(),
+            headers={
+                "Content-Type": "application/json",
+                "Accept": "application/json",
+                "X-DBP-APIKEY": self.api_key,
+            },
+            method="POST",
+        )
+        try:
+            with urllib.request.urlopen(
+                request, timeout=timeout or EUREX_REQUEST_TIMEOUT
+            ) as response:
+                body = json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            detail = e.read().decode(errors="replace")[:300]
+            raise RuntimeError(f"EUREX PME returned HTTP {e.code}: {detail}") from e
+
+        margin = _sum_key(body, EUREX_MARGIN_LIST, EUREX_MARGIN_KEY)
+        if margin is None:
+            raise RuntimeError(
+                f"No '{EUREX_MARGIN_LIST}[].{EUREX_MARGIN_KEY}' in the EUREX PME response"
+            )
+        return margin
+
+
+def _sum_key(body, list_key, key):
+    """
+    Sum ``body[list_key][*][key]``, the documented PME margin path.
+
+    Returns None if the response does not have that layout; other fields
+    that happen to share the name are never used.
+    """
+    entries = body.get(list_key) if isinstance(body, dict) else None
+    if not isinstance(entries, list):
+        return None
+    values = [
+        e[key]
+        for e in entries
+        if isinstance(e, dict) and isinstance(e.get(key), (int, float))
+    ]
+    return float(sum(values)) if values else None
+
+
+BACKENDS = {IcaBackend.name: IcaBackend, EurexBackend.name: EurexBackend}
+VENUE_ENGINES = {ICE: IcaBackend.name, EUREX: EurexBackend.name}
+
+
+def create_backend(engine, headless=False, result_source=None):
+    """Create a backend by engine name ("ica" or "eurex")."""
+    if engine == IcaBackend.name:
+        return IcaBackend(headless=headless, result_source=result_source)
+    return BACKENDS[engine]()
+
+
+def _run_venue(backend, paths, store, timeout):
+    start = time.perf_counter()
+    files = {}
+    errors = {}
+    for path in paths:
+        try:
+            files[str(path)] = backend.calculate(path, store=store, timeout=timeout)
+        except Exception as e:  # noqa: BLE001 - reported per file
+            errors[str(path)] = str(e)
+    # Books of one venue often share portfolio names (every ICE book has
+    # "Account"), so merged margins are keyed by file as well
+    margins = {
+        (file, name): margin for file, result in files.items() for name, margin in result.items()
+    }
+    return {
+        "engine": backend.name,
+        "files": files,
+        "errors": errors,
+        "margins": margins,
+        "currency": VENUE_CURRENCIES.get(backend.venue),
+        "total": sum(sum(result.values()) for result in files.values()),
+        "elapsed": time.perf_counter() - start,
+    }
+
+
+def calculate_books(paths, backends=None, store=None, timeout=None):
+    """
+    Price a mixed set of ICE and EUREX books, one venue per thread.
+
+    ``backends`` maps venue -> CalculatorBackend; missing venues get the
+    default backend (the shared browser session for ICE). Files of the same
+    venue run one after another on that venue's backend.
+
+    Returns: dict with
+        "venues": {venue: {"engine", "files", "errors", "margins", "currency",
+                           "total", "elapsed"}}
+        "totals": {currency: total of the venues in that currency}
+        "elapsed": wall time, i.e. the slowest venue
+    A venue's "files" maps each path to its {portfolio: margin}; its
+    "margins" holds all of them keyed by (path, portfolio).
+    """
+    start = time.perf_counter()
+    groups = split_by_venue(paths)
+    backends = dict(backends or {})
+    created = []
+    for venue in groups:
+        if venue not in backends:
+            if venue == ICE:
+                backends[venue] = IcaBackend(session=get_browser_session())
+            else:
+                backends[venue] = create_backend(VENUE_ENGINES[venue])
+                created.append(backends[venue])
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, len(groups))) as pool:
+            futures = {
+                venue: pool.submit(_run_venue, backends[venue], files, store, timeout)
+                for venue, files in groups.items()
+            }
+            venues = {venue: future.result() for venue, future in futures.items()}
+    finally:
+        for backend in created:
+            backend.close()
+
+    totals = {}
+    for result in venues.values():
+        currency = result["currency"]
+        totals[currency] = totals.get(currency, 0.0) + result["total"]
+    return {
+        "venues": venues,
+        "totals": totals,
+        "elapsed": time.perf_counter() - start,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Price ICE and EUREX books concurrently.")
+    parser.add_argument("files", nargs="+", help="ICE .xlsx and EUREX .csv position files")
+    parser.add_argument("-t", "--timeout", type=float, default=None, help="Seconds per file")
+    parser.add_argument("--db", help="Also record results in this result_store DB")
+    args = parser.parse_args()
+
+    store = None
+    if args.db:
+        from result_store import ResultStore
+
+        store = ResultStore(args.db)
+    try:
+        result = calculate_books(args.files, store=store, timeout=args.timeout)
+    finally:
+        if store is not None:
+            store.close()
+
+    for venue, venue_result in result["venues"].items():
+        print(
+            f"\n{venue} ({venue_result['elapsed']:.1f}s): "
+            f"{venue_result['total']:,.2f} {venue_result['currency']}"
+        )
+        for file, error in venue_result["errors"].items():
+            print(f"   ❌ {Path(file).name}: {error}")
+    totals = ", ".join(f"{total:,.2f} {currency}" for currency, total in result["totals"].items())
+    print(f"\n🧮 Total: {totals} in {result['elapsed']:.1f}s")
@@ -0,0 +1,171 @@
+"""
+Overhead benchmark for failure capture (failure_capture.py).
+
+Replays a calculation job against an in-process mock page: each phase
+fires ``--requests`` request/response/finished events (plus a console
+message every tenth request) and ends with a recorded step, as a real
+ICA job does through BrowserSession. The same job is timed with capture
+off and with the rolling buffers, which is all a healthy job pays.
+Writing one failure bundle (trace, HAR, page HTML, screenshot) is timed
+separately.
+
+The mock has no browser, so this measures the capture code itself. On a
+real page the bundle's ``page.content()`` and screenshot also cost a round
+trip to Chromium, but only when a bundle is written.
+
+Run: python bench_capture.py --jobs 200 --requests 50
+"""
+
+import argparse
+import json
+import statistics
+import tempfile
+import time
+from contextlib import redirect_stdout
+from io import StringIO
+from pathlib import Path
+
+from failure_capture import FlightRecorder, record_step
+
+PHASES = ("open", "clear", "upload", "run", "results")
+
+
+class _MockRequest:
+    __slots__ = ("method", "url", "resource_type", "failure")
+
+    def __init__(self, n):
+        self.method = "POST" if n % 4 == 0 else "GET"
+        self.url = f"https://ica.ice.com/ICA/api/portfolio/{n}?view=grid"
+        self.resource_type = "xhr" if n % 4 == 0 else "fetch"
+        self.failure = None
+
+
+class _MockResponse:
+    __slots__ = ("request", "status")
+
+    def __init__(self, request, status):
+        self.request = request
+        self.status = status
+
+
+class _MockMessage:
+    __slots__ = ("type", "text")
+
+    def __init__(self, n):
+        self.type = "log"
+        self.text = f"grid refreshed ({n} rows)"
+
+
+class MockPage:
+    """Just enough of a Playwright page for FlightRecorder."""
+
+    url = "https://ica.ice.com/ICA/Main"
+
+    def __init__(self, dom_kb=300):
+        self._handlers = {}
+        self._parts = ["<div class='ag-row'>" + "x" * 80 + "</div>"] * (dom_kb * 10)
+
+    def on(self, event, handler):
+        self._handlers.setdefault(event, []).append(handler)
+
+    def emit(self, event, arg):
+        for handler in self._handlers.get(event, ()):
+            handler(arg)
+
+    def content(self):
+        return "<html><body>" + "".join(self._parts) + "</body></html>"
+
+    def is_closed(self):
+        return False
+
+    def screenshot(self, path, full_page=False):
+        Path(path).write_bytes(b"\x89PNG\r\n\x1a\n")
+
+
+class _MockTask:
+    fn = None
+    args = ("book.xlsx",)
+
+
+def _job(page, requests):
+    n = 0
+    for phase in PHASES:
+        start = time.perf_counter()
+        for _ in range(requests):
+            request = _MockRequest(n)
+            page.emit("request", request)
+            page.emit("response", _MockResponse(request, 200))
+            page.emit("requestfinished", request)
+            if n % 10 == 0:
+                page.emit("console", _MockMessage(n))
+            n += 1
+        record_step(phase, time.perf_counter() - start)
+
+
+def _time_jobs(mode, jobs, requests, dom_kb):
+    page = MockPage(dom_kb)
+    recorder = None
+    if mode != "off":
+        recorder = FlightRecorder(directory="unused")  # Healthy jobs write nothing
+        recorder.attach(page)
+    samples = []
+    for _ in range(jobs):
+        start = time.perf_counter()
+        if recorder is not None:
+            recorder.begin(_MockTask())
+        _job(page, requests)
+        if recorder is not None:
+            recorder.finish()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def _time_bundles(count, requests, dom_kb):
+    page = MockPage(dom_kb)
+    samples = []
+    with tempfile.TemporaryDirectory(prefix="bench_capture_") as directory:
+        recorder = FlightRecorder(directory=directory)
+        recorder.attach(page)
+        for _ in range(count):
+            recorder.begin(_MockTask())
+            _job(page, requests)
+            start = time.perf_counter()
+            with redirect_stdout(StringIO()):
+                recorder.finish(error=RuntimeError("benchmark"), kind="unknown")
+            samples.append(time.perf_counter() - start)
+    return samples
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark failure-capture overhead")
+    parser.add_argument("--jobs", type=int, default=200, help="Jobs per mode")
+    parser.add_argument("--requests", type=int, default=50, help="Requests per phase")
+    parser.add_argument("--dom-kb", type=int, default=300, help="Size of the mock page HTML")
+    parser.add_argument("--bundles", type=int, default=20, help="Failure bundles to write")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    args = parser.parse_args(argv)
+
+    summary = {}
+    for mode in ("off", "buffers"):
+        samples = _time_jobs(mode, args.jobs, args.requests, args.dom_kb)
+        summary[mode] = statistics.median(samples) * 1000
+    summary["bundle"] = statistics.median(
+        _time_bundles(args.bundles, args.requests, args.dom_kb)
+    ) * 1000
+
+    if args.json:
+        print(json.dumps(summary, indent=2))
+        return
+
+    requests = args.requests * len(PHASES)
+    print(f"Median per job ({requests} requests, {len(PHASES)} steps, {args.dom_kb} KB DOM):")
+    for mode in ("off", "buffers"):
+        overhead = summary[mode] - summary["off"]
+        print(f"   {mode:<12} {summary[mode]:8.3f} ms   overhead {overhead:8.3f} ms")
+    per_request = (summary["buffers"] - summary["off"]) * 1000 / requests
+    print(f"   {'bundle':<12} {summary['bundle']:8.3f} ms   (written on failure/SLO only)")
+    print(f"\nBuffers cost about {per_request:.1f} µs per request.")
+
+
+if __name__ == "__main__":
+    main()
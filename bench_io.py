@@ -0,0 +1,241 @@
+"""
+I/O micro-benchmarks on synthetic position books.
+
+For each layout (ICE .xlsx, EUREX .csv) and size, a book is generated with
+book_generator.py and every step below is timed on its own, with the peak
+Python memory of a second pass measured by tracemalloc:
+
+  read        read_excel_file, read_positions, excel_live_reader (saved-file path)
+  validate    venue detection plus positions normalize/hash (delta uploads)
+  serialize   upload workbook (ICE) / PME request bodies (EUREX)
+  write-back  write_margin_to_excel, excel_live_reader (saved-file path)
+
+Results are stored in the result store (``benchmarks`` table) and compared
+with the previous run of the same case.
+
+Run: python bench_io.py --sizes 1000,100000,1000000
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+from pathlib import Path
+
+import book_generator
+import excel_live_reader
+import margin_calculator
+from backends import eurex_positions, pme_request, venue_of
+from position_delta import portfolio_hashes
+from result_store import RESULTS_DB, ResultStore
+
+# ---------------------------------------------------------------------
+# CONFIG
+# ---------------------------------------------------------------------
+DEFAULT_SIZES = (1_000, 100_000, 1_000_000)  # Rows per generated book
+ROWS_PER_PORTFOLIO = 250  # Portfolio count of generated ICE books = rows / this
+REGRESSION_THRESHOLD = 0.25  # Slower than the previous run by this much is flagged
+REGRESSION_MIN_SECONDS = 0.05  # Cases faster than this are too noisy to flag
+SUITE = "io"
+# ---------------------------------------------------------------------
+
+
+def _ice_cases(path, work_dir):
+    headers, rows = margin_calculator.read_positions(path)
+    upload = Path(work_dir) / "upload.xlsx"
+
+    def validate():
+        if venue_of(headers) != "ICE":
+            raise ValueError("not an ICE book")
+        portfolio_hashes(headers, rows)
+
+    def serialize():
+        margin_calculator.write_positions_file(upload, headers, rows)
+
+    def write_back():
+        margin_calculator.write_margin_to_excel(path, 123456.78)
+
+    def write_back_live():
+        excel_live_reader.write_margin_to_excel_live(path, "123,456.78 USD")
+
+    return [
+        ("read/read_excel_file", lambda: margin_calculator.read_excel_file(path)),
+        ("read/read_positions", lambda: margin_calculator.read_positions(path)),
+        ("read/excel_live_reader", lambda: excel_live_reader.read_excel_live(path)),
+        ("validate/venue+hash", validate),
+        ("serialize/upload_workbook", serialize),
+        ("write-back/write_margin_to_excel", write_back),
+        ("write-back/excel_live_reader", write_back_live),
+    ]
+
+
+def _eurex_cases(path, work_dir):
+    headers, rows = margin_calculator.read_positions(path)
+    books = eurex_positions(headers, rows, path.stem)
+
+    def validate():
+        if venue_of(headers) != "EUREX":
+            raise ValueError("not a EUREX book")
+        eurex_positions(headers, rows, path.stem)
+
+    def serialize():
+        for positions in books.values():
+            json.dumps(pme_request(positions))
+
+    return [
+        ("read/read_positions", lambda: margin_calculator.read_positions(path)),
+        ("validate/venue+positions", validate),
+        ("serialize/pme_request", serialize),
+    ]
+
+
+def _measure(fn, memory=True, repeat=1):
+    """Best time of ``repeat`` runs, plus the tracemalloc peak of one more run."""
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        seconds = None
+        for _ in range(max(1, repeat)):
+            start = time.perf_counter()
+            fn()
+            elapsed = time.perf_counter() - start
+            seconds = elapsed if seconds is None else min(seconds, elapsed)
+
+        peak_mb = None
+        if memory:
+            tracemalloc.start()
+            try:
+                fn()
+                peak_mb = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+            finally:
+                tracemalloc.stop()
+    return seconds, peak_mb
+
+
+def _revision():
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=Path(__file__).resolve().parent,
+        )
+        return out.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(
+    sizes=DEFAULT_SIZES, layouts=("ice", "eurex"), memory=True, repeat=1, keep_dir=None
+):
+    """
+    Generate books and benchmark every case.
+
+    Returns: list of {name, rows, seconds, peak_mb}
+    """
+    work_dir = Path(keep_dir or tempfile.mkdtemp(prefix="bench_io_"))
+    work_dir.mkdir(parents=True, exist_ok=True)
+    results = []
+    try:
+        for rows in sizes:
+            for layout in layouts:
+                suffix = ".xlsx" if layout == "ice" else ".csv"
+                path = work_dir / f"{layout}_{rows}{suffix}"
+                print(f"📊 {layout.upper()} {rows:,} rows: generating...", flush=True)
+                start = time.perf_counter()
+                portfolios = max(1, rows // ROWS_PER_PORTFOLIO) if layout == "ice" else 1
+                book_generator.write_book(layout, path, rows, portfolios=portfolios)
+                results.append(
+                    {
+                        "name": f"{layout}/generate",
+                        "rows": rows,
+                        "seconds": time.perf_counter() - start,
+                        "peak_mb": None,
+                    }
+                )
+
+                cases = _ice_cases if layout == "ice" else _eurex_cases
+                for name, fn in cases(path, work_dir):
+                    try:
+                        seconds, peak_mb = _measure(fn, memory, repeat)
+                    except Exception as e:  # noqa: BLE001 - reported, suite continues
+                        print(f"   ❌ {name}: {e}")
+                        continue
+                    results.append(
+                        {
+                            "name": f"{layout}/{name}",
+                            "rows": rows,
+                            "seconds": seconds,
+                            "peak_mb": peak_mb,
+                        }
+                    )
+                    memory_text = f"{peak_mb:9.1f} MB" if peak_mb is not None else ""
+                    print(f"   {name:<36} {seconds:9.3f} s {memory_text}", flush=True)
+    finally:
+        if keep_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+def compare(results, store):
+    """Print each result next to the previous stored run of the same case."""
+    print(f"\n{'case':<48} {'rows':>9} {'seconds':>9} {'previous':>9} {'change':>8}")
+    regressions = 0
+    for r in results:
+        previous = store.benchmark_history(SUITE, r["name"], r["rows"], limit=1)
+        line = f"{r['name']:<48} {r['rows']:>9,} {r['seconds']:>9.3f}"
+        if previous and previous[0]["seconds"]:
+            before = previous[0]["seconds"]
+            change = r["seconds"] / before - 1
+            slow = change > REGRESSION_THRESHOLD and r["seconds"] >= REGRESSION_MIN_SECONDS
+            flag = " ⚠️" if slow else ""
+            regressions += bool(flag)
+            line += f" {before:>9.3f} {change:>+7.0%}{flag}"
+        print(line)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark position-book I/O")
+    parser.add_argument(
+        "--sizes",
+        default=",".join(str(n) for n in DEFAULT_SIZES),
+        help="Comma-separated row counts (default: %(default)s)",
+    )
+    parser.add_argument("--layouts", default="ice,eurex", help="ice, eurex or both")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per case (best is kept)")
+    parser.add_argument("--no-memory", action="store_true", help="Skip the tracemalloc pass")
+    parser.add_argument("--keep", help="Keep the generated books in this directory")
+    parser.add_argument("--db", default=RESULTS_DB, help="Result store for history")
+    parser.add_argument("--no-save", action="store_true", help="Do not store the results")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    args = parser.parse_args(argv)
+
+    sizes = [int(n) for n in args.sizes.split(",") if n.strip()]
+    layouts = [layout.strip() for layout in args.layouts.split(",") if layout.strip()]
+    results = run_suite(
+        sizes, layouts, memory=not args.no_memory, repeat=args.repeat, keep_dir=args.keep
+    )
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+
+    store = ResultStore(args.db)
+    try:
+        regressions = compare(results, store)
+        if not args.no_save:
+            store.record_benchmarks(SUITE, results, revision=_revision())
+    finally:
+        store.close()
+
+    if regressions:
+        print(f"\n⚠️ {regressions} case(s) more than {REGRESSION_THRESHOLD:.0%} slower")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
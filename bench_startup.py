@@ -0,0 +1,114 @@
+"""
+Startup-time benchmark for the GUI.
+
+Launches fresh Python processes and measures:
+  - import:  time to import gui_app
+  - window:  time from process start until the main window has been drawn
+  - backend: time to import the calculator backend (deferred by the GUI),
+             in a process of its own: the GUI starts importing it in the
+             background as soon as the window is up, so timing it after the
+             window would leave out whatever the preload already paid for
+
+Run: python bench_startup.py --runs 10
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+HERE = Path(__file__).resolve().parent
+
+# Timed inside the child process; perf_counter at the top is the reference.
+_CHILD = r"""
+import time
+t0 = time.perf_counter()
+import json, sys
+sys.path.insert(0, {here!r})
+import gui_app
+t_import = time.perf_counter() - t0
+t_window = None
+try:
+    import tkinter as tk
+    root = tk.Tk()
+    app = gui_app.MarginCalculatorGUI(root)
+    root.update()
+    t_window = time.perf_counter() - t0
+    root.destroy()
+except tk.TclError:
+    pass  # no display available
+print(json.dumps({{"import": t_import, "window": t_window}}))
+"""
+
+# A cold import of the backend alone (gui_app itself imports none of it)
+_CHILD_BACKEND = r"""
+import time
+import json, sys
+sys.path.insert(0, {here!r})
+from gui_app import BACKGROUND_IMPORTS
+t1 = time.perf_counter()
+for name in BACKGROUND_IMPORTS:
+    try:
+        __import__(name)
+    except ImportError:
+        pass
+print(json.dumps({{"backend": time.perf_counter() - t1}}))
+"""
+
+
+def _run_child(code):
+    out = subprocess.run(
+        [sys.executable, "-c", code.format(here=str(HERE))],
+        capture_output=True,
+        text=True,
+        check=True,
+        cwd=HERE,
+    )
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def run_once():
+    """Run fresh interpreters for the GUI and the backend; return their timings (seconds)."""
+    return {**_run_child(_CHILD), **_run_child(_CHILD_BACKEND)}
+
+
+def summarize(samples, key):
+    values = [s[key] for s in samples if s[key] is not None]
+    if not values:
+        return None
+    return {
+        "min_ms": min(values) * 1000,
+        "median_ms": statistics.median(values) * 1000,
+        "max_ms": max(values) * 1000,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark GUI startup time")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    args = parser.parse_args(argv)
+
+    run_once()  # discard: populates the OS file cache and __pycache__
+    samples = [run_once() for _ in range(args.runs)]
+    summary = {key: summarize(samples, key) for key in ("import", "window", "backend")}
+
+    if args.json:
+        print(json.dumps(summary, indent=2))
+        return
+
+    print(f"GUI startup over {args.runs} run(s):")
+    for key, stats in summary.items():
+        if stats is None:
+            print(f"   {key:<8} n/a (no display)")
+        else:
+            print(
+                f"   {key:<8} min {stats['min_ms']:8.1f} ms   "
+                f"median {stats['median_ms']:8.1f} ms   max {stats['max_ms']:8.1f} ms"
+            )
+
+
+if __name__ == "__main__":
+    main()
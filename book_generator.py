@@ -0,0 +1,187 @@
+"""
+Synthetic position books in the ICE and EUREX upload layouts.
+
+Modelled on the files in excels/: ICE books carry the ICA upload columns
+with monthly futures strips (Expiry Date as YYYYMM00), EUREX books are the
+position export CSV with quarterly Contract Dates (third-Wednesday based).
+Rows are spread over portfolios and accounts; the same seed gives the same
+book.
+
+    python book_generator.py ice books/ice_100k.xlsx --rows 100000 --portfolios 200
+    python book_generator.py eurex books/eurex_1k.csv --rows 1000
+"""
+
+import argparse
+import csv
+import random
+from datetime import date, timedelta
+from pathlib import Path
+
+# ---------------------------------------------------------------------
+# CONFIG
+# ---------------------------------------------------------------------
+ICE_HEADERS = [
+    "Portfolio Name",
+    "Exchange Code",
+    "Exchange Contract Code",
+    "Security Type",
+    "PutOrCall",
+    "Expiry Date",
+    "Strike Price",
+    "Outright Margin",
+    "Position Type",
+    "Regime",
+    "Customer Type",
+    "Account type",
+    "Contract Type",
+    "Net Position",
+]
+EUREX_HEADERS = [
+    "Product ID",
+    "Contract Date",
+    "Call Put Flag",
+    "Exercise Price",
+    "Version Number",
+    "Net LS Balance",
+    "Long Balance",
+    "Short Balance",
+    "Net EA Balance",
+    "Assigned/Notified Balance",
+    "Exercised/Allocated Balance",
+    "Instrument Type",
+    "Exercise Style Flag",
+]
+ICE_CONTRACTS = ("I", "ER3", "EMP", "L", "SO3", "R", "G")  # IFLL contract codes
+EUREX_PRODUCTS = {"FEU3": -2, "FST3": 0}  # Product -> days from third Wednesday
+DEFAULT_EXPIRIES = 12  # Length of each contract's expiry strip
+DEFAULT_START = date(2025, 9, 1)  # First expiry month
+POSITION_SCALE = 5000  # Typical size of a net position
+# ---------------------------------------------------------------------
+
+# Outright Margin .. Contract Type, as in the ICE sample book
+_ICE_STATIC = ("N", "P", "RCH", "H", "H", "F")
+
+
+def _third_wednesday(year, month):
+    first = date(year, month, 1)
+    return first + timedelta(days=(2 - first.weekday()) % 7 + 14)
+
+
+def _months(start, count, step):
+    year, month = start.year, start.month
+    for _ in range(count):
+        yield year, month
+        month += step
+        year, month = year + (month - 1) // 12, (month - 1) % 12 + 1
+
+
+def _quantity(rng):
+    qty = int(rng.gauss(0, POSITION_SCALE))
+    return qty or 1
+
+
+def portfolio_names(portfolios, accounts):
+    """Portfolio names spread over ``accounts`` accounts (ACC001-PF001, ...)."""
+    accounts = max(1, accounts)
+    return [f"ACC{p % accounts + 1:03d}-PF{p + 1:03d}" for p in range(max(1, portfolios))]
+
+
+def ice_rows(rows, portfolios=10, accounts=3, expiries=DEFAULT_EXPIRIES, seed=1):
+    """Yield ``rows`` ICE-layout position rows (tuples in ICE_HEADERS order)."""
+    rng = random.Random(seed)
+    names = portfolio_names(portfolios, accounts)
+    strip = [f"{y}{m:02d}00" for y, m in _months(DEFAULT_START, expiries, 1)]
+    grid = [(contract, expiry) for contract in ICE_CONTRACTS for expiry in strip]
+    per_portfolio, extra = divmod(rows, len(names))
+
+    for index, name in enumerate(names):
+        count = per_portfolio + (1 if index < extra else 0)
+        offset = rng.randrange(len(grid))
+        for k in range(count):
+            contract, expiry = grid[(offset + k) % len(grid)]
+            yield (name, "IFLL", contract, "FUT", None, expiry, None) + _ICE_STATIC + (
+                _quantity(rng),
+            )
+
+
+def eurex_rows(rows, portfolios=1, accounts=1, expiries=DEFAULT_EXPIRIES, seed=1):
+    """
+    Yield ``rows`` EUREX-layout rows. With more than one portfolio a
+    ``Portfolio Name`` column is prepended (see ``eurex_headers``).
+    """
+    rng = random.Random(seed)
+    names = portfolio_names(portfolios, accounts) if portfolios > 1 else [None]
+    quarters = list(_months(date(DEFAULT_START.year, 12, 1), expiries, 3))
+    grid = [
+        (product, (_third_wednesday(y, m) + timedelta(days=shift)).strftime("%Y%m%d"))
+        for product, shift in EUREX_PRODUCTS.items()
+        for y, m in quarters
+    ]
+    per_portfolio, extra = divmod(rows, len(names))
+
+    for index, name in enumerate(names):
+        count = per_portfolio + (1 if index < extra else 0)
+        offset = rng.randrange(len(grid))
+        for k in range(count):
+            product, contract_date = grid[(offset + k) % len(grid)]
+            row = (product, contract_date, None, None, None, _quantity(rng)) + (None,) * 7
+            yield row if name is None else (name,) + row
+
+
+def eurex_headers(portfolios=1):
+    return (["Portfolio Name"] if portfolios > 1 else []) + EUREX_HEADERS
+
+
+def write_ice_book(path, rows, portfolios=10, accounts=3, expiries=DEFAULT_EXPIRIES, seed=1):
+    """Write an ICE-layout .xlsx book (streamed, constant memory)."""
+    from openpyxl import Workbook
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Positions")
+    ws.append(ICE_HEADERS)
+    for row in ice_rows(rows, portfolios, accounts, expiries, seed):
+        ws.append(row)
+    wb.save(path)
+    return Path(path)
+
+
+def write_eurex_book(path, rows, portfolios=1, accounts=1, expiries=DEFAULT_EXPIRIES, seed=1):
+    """Write a EUREX position export .csv."""
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(eurex_headers(portfolios))
+        for row in eurex_rows(rows, portfolios, accounts, expiries, seed):
+            writer.writerow("" if v is None else v for v in row)
+    return Path(path)
+
+
+def write_book(layout, path, rows, **options):
+    """Write a book in ``layout`` ("ice" or "eurex")."""
+    writer = write_ice_book if layout == "ice" else write_eurex_book
+    return writer(path, rows, **options)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic ICE / EUREX position books")
+    parser.add_argument("layout", choices=("ice", "eurex"))
+    parser.add_argument("output", help="Output .xlsx (ice) or .csv (eurex) file")
+    parser.add_argument("--rows", type=int, default=1000)
+    parser.add_argument(
+        "--portfolios", type=int, default=None, help="Default: 10 (ice), 1 (eurex)"
+    )
+    parser.add_argument("--accounts", type=int, default=3)
+    parser.add_argument("--expiries", type=int, default=DEFAULT_EXPIRIES)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    portfolios = args.portfolios or (10 if args.layout == "ice" else 1)
+    path = write_book(
+        args.layout,
+        args.output,
+        args.rows,
+        portfolios=portfolios,
+        accounts=args.accounts,
+        expiries=args.expiries,
+        seed=args.seed,
+    )
+    print(f"✅ Wrote {args.rows:,} {args.layout.upper()} row(s) to {path}")
@@ -4,13 +4,14 @@ Reads data directly from open Excel instance without requiring save.
 """
 import os
 from pathlib import Path
-import win32com.client
 from openpyxl import load_workbook
 
 
 def get_excel_instance():
-    """Get the running Excel application instance."""
+    """Get the running Excel application instance (None without Excel/pywin32)."""
     try:
+        import win32com.client
+
         excel = win32com.client.GetActiveObject("Excel.Application")
         return excel
     except:
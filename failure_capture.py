@@ -0,0 +1,303 @@
+"""
+Always-on failure capture for BrowserSession jobs.
+
+Full Playwright tracing is too heavy to leave on. Instead each job keeps
+small rolling buffers (collections.deque) of what just happened:
+
+  steps     phase timings as they complete (clear, upload, run, results)
+  network   recent requests: method, URL, status, duration, failure
+  console   recent browser console messages
+
+Healthy jobs only append to these buffers and never talk to the browser
+(bench_capture.py measures the cost). When a job fails, or one of its steps
+takes longer than STEP_SLO_SECONDS, the buffers are written to a bundle
+under CAPTURE_DIR together with the page's HTML and a screenshot, both
+taken at that moment. Cancelled jobs are discarded without a bundle.
+
+  failures/20261019-101500_book.xlsx_failed/
+      trace.json      job, error, error class, steps, slow steps, console, page URL
+      network.har     the buffered requests as a HAR 1.2 file (no headers)
+      dom.html        the page HTML at the moment of capture
+      screenshot.png  the page at the moment of capture
+"""
+
+import json
+import re
+import shutil
+import time
+from collections import deque
+from datetime import datetime, timezone
+from pathlib import Path
+from threading import Lock, local
+
+# ---------------------------------------------------------------------
+# CONFIG
+# ---------------------------------------------------------------------
+CAPTURE_ENABLED = True  # Keep the rolling buffers and write bundles on failure
+CAPTURE_DIR = "failures"  # Where bundles are written
+CAPTURE_KEEP = 50  # Bundles kept on disk; older ones are deleted
+STEP_SLO_SECONDS = 120  # Successful jobs with a step (phase) slower than this are captured too
+CAPTURE_STEPS = 50  # Step timings kept per job
+CAPTURE_NETWORK = 200  # Requests kept per job
+CAPTURE_CONSOLE = 50  # Console messages kept per job
+CAPTURE_DOM = True  # Save the page HTML in each bundle
+CAPTURE_DOM_MAX_CHARS = 500_000  # Longer HTML is truncated
+# ---------------------------------------------------------------------
+
+_current = local()  # The recorder of the job running on this thread
+
+
+def _now():
+    return datetime.now(timezone.utc)
+
+
+def _task_label(task):
+    for arg in task.args:
+        if isinstance(arg, (str, Path)):
+            return Path(arg).name
+    return getattr(task.fn, "__name__", "task")
+
+
+class JobTrace:
+    """The rolling buffers of one job."""
+
+    def __init__(self, label):
+        self.label = label
+        self.started = time.monotonic()
+        self.started_at = _now()
+        self.steps = deque(maxlen=CAPTURE_STEPS)
+        self.network = deque(maxlen=CAPTURE_NETWORK)
+        self.console = deque(maxlen=CAPTURE_CONSOLE)
+        self.slow_steps = []  # (step, seconds) past the SLO
+        self._pending = {}  # request -> network entry, until it finishes
+
+    def request(self, request):
+        entry = {
+            "started": time.time(),
+            "t0": time.monotonic(),
+            "method": request.method,
+            "url": request.url,
+            "type": request.resource_type,
+            "status": None,
+            "ms": None,
+            "failure": None,
+        }
+        self.network.append(entry)
+        if len(self._pending) >= CAPTURE_NETWORK:
+            self._pending.pop(next(iter(self._pending)))
+        self._pending[request] = entry
+
+    def response(self, response):
+        entry = self._pending.get(response.request)
+        if entry is not None:
+            entry["status"] = response.status
+
+    def request_done(self, request, failure=None):
+        entry = self._pending.pop(request, None)
+        if entry is not None:
+            entry["ms"] = round((time.monotonic() - entry["t0"]) * 1000, 1)
+            entry["failure"] = failure
+
+
+class FlightRecorder:
+    """
+    Keeps a JobTrace for the running job of one BrowserSession and writes a
+    bundle when the job fails or one of its steps breaks the latency SLO.
+    The SLO is per step, not per job: a pipelined or batched job runs many
+    books, and each book's upload, run and results wait is a step.
+    """
+
+    def __init__(
+        self, directory=CAPTURE_DIR, slo_seconds=STEP_SLO_SECONDS, enabled=CAPTURE_ENABLED
+    ):
+        self.directory = Path(directory)
+        self.slo_seconds = slo_seconds
+        self.enabled = enabled
+        self.job = None
+        self.page = None
+        self.jobs = 0
+        self.captured = 0
+        self.last_bundle = None
+        self._lock = Lock()
+
+    def attach(self, page):
+        """Listen to a (new) page's requests and console messages."""
+        self.page = page
+        if not self.enabled:
+            return
+        page.on("request", lambda r: self.job and self.job.request(r))
+        page.on("response", lambda r: self.job and self.job.response(r))
+        page.on("requestfinished", lambda r: self.job and self.job.request_done(r))
+        page.on(
+            "requestfailed", lambda r: self.job and self.job.request_done(r, r.failure or "failed")
+        )
+        page.on("console", lambda m: self.job and self.job.console.append((m.type, m.text)))
+
+    def begin(self, task):
+        """Start buffering for ``task`` (a BrowserSession task) on this thread."""
+        if not self.enabled:
+            return None
+        self.jobs += 1
+        self.job = JobTrace(_task_label(task))
+        _current.recorder = self
+        return self.job
+
+    def step(self, name, seconds):
+        job = self.job
+        if job is None:
+            return
+        job.steps.append((name, round(seconds, 3), _now().strftime("%H:%M:%S.%f")[:-3]))
+        if self.slo_seconds and seconds > self.slo_seconds:
+            job.slow_steps.append((name, round(seconds, 3)))
+
+    def discard(self):
+        """End the current job without a bundle (e.g. the caller cancelled it)."""
+        self.job = None
+        _current.recorder = None
+
+    def finish(self, error=None, kind=None):
+        """
+        End the current job. Writes a bundle if it failed or one of its steps
+        was slower than the SLO, and returns the bundle path (else None).
+        """
+        job, self.job = self.job, None
+        _current.recorder = None
+        if job is None:
+            return None
+        if error is None and not job.slow_steps:
+            return None
+        elapsed = time.monotonic() - job.started
+        reason = "failed" if error is not None else "slo"
+        try:
+            bundle = self._write(job, reason, elapsed, error, kind)
+        except Exception as exc:  # noqa: BLE001 - capture is best effort
+            print(f"⚠️ Could not write failure capture: {exc}")
+            return None
+        print(f"🧾 Failure capture written to {bundle}")
+        return bundle
+
+    def _write(self, job, reason, elapsed, error, kind):
+        stamp = job.started_at.strftime("%Y%m%d-%H%M%S")
+        name = re.sub(r"[^\w.-]+", "_", f"{stamp}_{job.label}_{reason}")
+        bundle = self.directory / name
+        suffix = 1
+        while bundle.exists():
+            suffix += 1
+            bundle = self.directory / f"{name}-{suffix}"
+        bundle.mkdir(parents=True)
+
+        url = None
+        dom = False
+        page = self.page
+        if page is not None:
+            try:
+                if not page.is_closed():
+                    url = page.url
+                    if CAPTURE_DOM:
+                        html = page.content()[:CAPTURE_DOM_MAX_CHARS]
+                        (bundle / "dom.html").write_text(html, encoding="utf-8")
+                        dom = True
+                    page.screenshot(path=str(bundle / "screenshot.png"), full_page=True)
+            except Exception:  # noqa: BLE001 - a crashed page has no HTML or screenshot
+                pass
+
+        (bundle / "network.har").write_text(json.dumps(_har(job.network), indent=1))
+        trace = {
+            "job": job.label,
+            "reason": reason,
+            "error": str(error) if error is not None else None,
+            "error_class": kind,
+            "error_type": type(error).__name__ if error is not None else None,
+            "started_at": job.started_at.strftime("%Y-%m-%d %H:%M:%S"),
+            "elapsed": round(elapsed, 3),
+            "slo_seconds": self.slo_seconds,
+            "slow_steps": [{"step": s, "seconds": sec} for s, sec in job.slow_steps],
+            "url": url,
+            "steps": [{"step": s, "seconds": sec, "at": at} for s, sec, at in job.steps],
+            "console": [{"type": t, "text": text} for t, text in job.console],
+            "requests": len(job.network),
+            "failed_requests": sum(
+                1
+                for e in job.network
+                if e["failure"] or (e["status"] is not None and e["status"] >= 400)
+            ),
+            "dom": dom,
+        }
+        (bundle / "trace.json").write_text(json.dumps(trace, indent=2))
+
+        with self._lock:
+            self.captured += 1
+            self.last_bundle = str(bundle)
+        self._prune()
+        return bundle
+
+    def _prune(self):
+        if not CAPTURE_KEEP:
+            return
+        bundles = sorted(p for p in self.directory.iterdir() if p.is_dir())
+        for old in bundles[:-CAPTURE_KEEP]:
+            shutil.rmtree(old, ignore_errors=True)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "jobs": self.jobs,
+                "captured": self.captured,
+                "last_bundle": self.last_bundle,
+            }
+
+
+def record_step(name, seconds):
+    """Record a finished step on the job running on this thread (if any)."""
+    recorder = getattr(_current, "recorder", None)
+    if recorder is not None:
+        recorder.step(name, seconds)
+
+
+def _har(entries):
+    """The buffered requests as a minimal HAR 1.2 log (headers and bodies omitted)."""
+    return {
+        "log": {
+            "version": "1.2",
+            "creator": {"name": "icemargincalculation", "version": "1"},
+            "entries": [
+                {
+                    "startedDateTime": datetime.fromtimestamp(
+                        e["started"], timezone.utc
+                    ).isoformat(),
+                    "time": e["ms"] if e["ms"] is not None else -1,
+                    "request": {
+                        "method": e["method"],
+                        "url": e["url"],
+                        "httpVersion": "",
+                        "headers": [],
+                        "queryString": [],
+                        "cookies": [],
+                        "headersSize": -1,
+                        "bodySize": -1,
+                    },
+                    "response": {
+                        "status": e["status"] or 0,
+                        "statusText": "",
+                        "httpVersion": "",
+                        "headers": [],
+                        "cookies": [],
+                        "content": {"size": -1, "mimeType": ""},
+                        "redirectURL": "",
+                        "headersSize": -1,
+                        "bodySize": -1,
+                    },
+                    "cache": {},
+                    "timings": {
+                        "send": 0,
+                        "wait": e["ms"] if e["ms"] is not None else -1,
+                        "receive": 0,
+                    },
+                    "_resourceType": e["type"],
+                    "_failure": e["failure"],
+                }
+                for e in entries
+            ],
+        }
+    }
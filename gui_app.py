@@ -1,31 +1,157 @@
 """
 GUI Application for ICE Margin Calculator
 Simple interface with file selection and calculate button.
+
+The calculator backend (Playwright, openpyxl) is imported in the background
+after the window is shown, and the browser is only started on first use or
+when the app is launched with --warm-up.
 """
+import argparse
+import importlib
+import itertools
+import queue
+import sys
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
 from pathlib import Path
 import threading
-from margin_calculator import run_margin_calc
+
+from recovery import Cancelled
+
+# Modules imported in the background once the window is on screen
+BACKGROUND_IMPORTS = ("margin_calculator", "result_store", "openpyxl", "playwright.sync_api")
+
+LOG_FLUSH_MS = 100  # How often queued log lines are written to the status box
+LOG_BATCH_LIMIT = 500  # Max lines written per flush (the rest waits a tick)
+LOG_MAX_LINES = 2000  # Older lines are trimmed from the status box
+PROGRESS_STEPS = 5  # session-ready ... result (margin_events.PROGRESS_EVENTS)
+
+
+def preload_backend(warm_up=False):
+    """Import the heavy backend modules and optionally start the browser."""
+    for name in BACKGROUND_IMPORTS:
+        try:
+            importlib.import_module(name)
+        except ImportError as e:
+            print(f"⚠️ Could not preload {name}: {e}")
+
+    if warm_up:
+        from margin_calculator import get_browser_session
+
+        get_browser_session().warm_up()
+
+
+class JobCancelled(Cancelled):
+    """Raised inside a running job when the user cancels it."""
+
+
+class Job:
+    """One queued margin calculation shown in the job panel."""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, excel_path: Path):
+        self.id = str(next(self._ids))
+        self.excel_path = excel_path
+        self.status = "Queued"
+        self.step = ""
+        self.steps_done = 0
+        self.timings = {}
+        self.result = None
+        self.error = None
+        self.cancel_event = threading.Event()
+
+    @property
+    def progress(self):
+        return int(100 * self.steps_done / PROGRESS_STEPS)
+
+    def timings_text(self):
+        # The session thread adds phases while this runs on the Tk thread
+        timings = dict(self.timings)
+        return "  ".join(f"{k} {v:.1f}s" for k, v in timings.items())
+
+
+class _QueueWriter:
+    """File-like object that sends complete lines to a queue (and the original stream)."""
+
+    def __init__(self, target: "queue.Queue[str]", original=None):
+        self.target = target
+        self.original = original
+        self._buffer = ""
+        self._lock = threading.Lock()
+
+    def write(self, text):
+        if self.original is not None:
+            self.original.write(text)
+        with self._lock:
+            self._buffer += text
+            *lines, self._buffer = self._buffer.split("\n")
+        for line in lines:
+            self.target.put(line)
+        return len(text)
+
+    def flush(self):
+        if self.original is not None:
+            self.original.flush()
+
 
 class MarginCalculatorGUI:
-    def __init__(self, root):
+    def __init__(self, root, warm_up=False):
         self.root = root
         self.root.title("ICE Margin Calculator")
-        self.root.geometry("600x400")
+        self.root.geometry("720x640")
         self.root.resizable(False, False)
 
         # Default Excel file
         self.excel_path = Path("positions_template.xlsx").resolve()
-        self.is_calculating = False
+        self.result_store = None
+        self.warm_up = warm_up
+
+        # Worker threads never touch Tk directly: log lines, job updates and
+        # error dialogs go through these queues and are applied on the Tk
+        # thread by _pump().
+        self.log_queue: "queue.Queue[str]" = queue.Queue()
+        self.job_updates: "queue.Queue[str]" = queue.Queue()
+        self.pending_jobs: "queue.Queue[Job]" = queue.Queue()
+        self.error_dialogs: "queue.Queue[tuple[str, str]]" = queue.Queue()
+        self.jobs = {}
+        self.runner_thread = None
+        self._stdout = sys.stdout
+        sys.stdout = _QueueWriter(self.log_queue, self._stdout)
 
         # Close browser when window is closed
         self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
 
         self.setup_ui()
+        self.root.after(LOG_FLUSH_MS, self._pump)
+
+        # Load the backend once the window has been drawn
+        self.root.after_idle(self.start_preload)
+
+    def start_preload(self):
+        """Import the calculator backend on a background thread."""
+        threading.Thread(
+            target=preload_backend,
+            args=(self.warm_up,),
+            name="BackendPreload",
+            daemon=True,
+        ).start()
+
+    def get_result_store(self):
+        """Open the result history on first use."""
+        if self.result_store is None:
+            from result_store import ResultStore
+
+            self.result_store = ResultStore()
+        return self.result_store
 
     def on_closing(self):
         """Handle window close event."""
+        for job in self.jobs.values():
+            job.cancel_event.set()
+        sys.stdout = self._stdout
+        if self.result_store is not None:
+            self.result_store.close()
         self.root.destroy()
 
     def setup_ui(self):
@@ -45,7 +171,7 @@ class MarginCalculatorGUI:
         title_label.pack(pady=15)
 
         # Main content frame
-        content_frame = tk.Frame(self.root, padx=20, pady=20)
+        content_frame = tk.Frame(self.root, padx=20, pady=15)
         content_frame.pack(fill=tk.BOTH, expand=True)
 
         # File selection section
@@ -56,7 +182,7 @@ class MarginCalculatorGUI:
             padx=10,
             pady=10
         )
-        file_frame.pack(fill=tk.X, pady=(0, 20))
+        file_frame.pack(fill=tk.X, pady=(0, 10))
 
         # File path display
         self.file_label = tk.Label(
@@ -71,9 +197,12 @@ class MarginCalculatorGUI:
         )
         self.file_label.pack(fill=tk.X, pady=(0, 10))
 
+        button_row = tk.Frame(file_frame)
+        button_row.pack()
+
         # Browse button
         browse_btn = tk.Button(
-            file_frame,
+            button_row,
             text="📁 Browse Excel File",
             command=self.browse_file,
             font=("Arial", 10),
@@ -84,11 +213,26 @@ class MarginCalculatorGUI:
             padx=10,
             pady=5
         )
-        browse_btn.pack()
+        browse_btn.pack(side=tk.LEFT, padx=5)
+
+        # Queue several files at once
+        queue_btn = tk.Button(
+            button_row,
+            text="➕ Queue Files...",
+            command=self.queue_files,
+            font=("Arial", 10),
+            bg="#4CAF50",
+            fg="white",
+            cursor="hand2",
+            relief=tk.RAISED,
+            padx=10,
+            pady=5
+        )
+        queue_btn.pack(side=tk.LEFT, padx=5)
 
         # Calculate button section
         calc_frame = tk.Frame(content_frame)
-        calc_frame.pack(fill=tk.X, pady=(0, 20))
+        calc_frame.pack(fill=tk.X, pady=(0, 10))
 
         self.calc_button = tk.Button(
             calc_frame,
@@ -100,11 +244,54 @@ class MarginCalculatorGUI:
             cursor="hand2",
             relief=tk.RAISED,
             padx=20,
-            pady=15,
+            pady=10,
             width=25
         )
         self.calc_button.pack()
 
+        # Job queue section
+        jobs_frame = tk.LabelFrame(
+            content_frame,
+            text="Jobs",
+            font=("Arial", 10, "bold"),
+            padx=10,
+            pady=10
+        )
+        jobs_frame.pack(fill=tk.X, pady=(0, 10))
+
+        columns = ("file", "status", "progress", "timings")
+        self.job_tree = ttk.Treeview(jobs_frame, columns=columns, show="headings", height=5)
+        for column, title, width in (
+            ("file", "File", 190),
+            ("status", "Status", 110),
+            ("progress", "Progress", 70),
+            ("timings", "Phase Timings", 260),
+        ):
+            self.job_tree.heading(column, text=title)
+            self.job_tree.column(column, width=width, anchor="w")
+        self.job_tree.pack(fill=tk.X)
+
+        cancel_btn = tk.Button(
+            jobs_frame,
+            text="✖ Cancel Selected",
+            command=self.cancel_selected,
+            font=("Arial", 9),
+            cursor="hand2",
+            relief=tk.RAISED,
+            padx=8,
+            pady=2
+        )
+        cancel_btn.pack(anchor="e", pady=(5, 0))
+
+        # Progress bar (current job)
+        self.progress = ttk.Progressbar(
+            content_frame,
+            mode='determinate',
+            maximum=100,
+            length=400
+        )
+        self.progress.pack(fill=tk.X, pady=(0, 10))
+
         # Status section
         status_frame = tk.LabelFrame(
             content_frame,
@@ -126,13 +313,6 @@ class MarginCalculatorGUI:
         )
         self.status_text.pack(fill=tk.BOTH, expand=True)
 
-        # Progress bar
-        self.progress = ttk.Progressbar(
-            content_frame,
-            mode='indeterminate',
-            length=400
-        )
-
         # Initial status
         self.update_status("Ready. Select Excel file and click 'Calculate Margin'.")
 
@@ -149,19 +329,70 @@ class MarginCalculatorGUI:
             self.file_label.config(text=str(self.excel_path))
             self.update_status(f"Selected: {self.excel_path.name}")
 
+    def queue_files(self):
+        """Pick several Excel files and queue a job for each."""
+        filenames = filedialog.askopenfilenames(
+            title="Select Excel Files",
+            filetypes=[("Excel Files", "*.xlsx"), ("All Files", "*.*")],
+            initialdir=Path.cwd()
+        )
+        for filename in filenames:
+            self.submit_job(Path(filename))
+
     def update_status(self, message):
-        """Update the status text area."""
-        self.status_text.config(state=tk.NORMAL)
-        self.status_text.insert(tk.END, f"{message}\n")
-        self.status_text.see(tk.END)
-        self.status_text.config(state=tk.DISABLED)
+        """Queue a line for the status text area (safe from any thread)."""
+        self.log_queue.put(str(message))
 
-    def calculate_margin(self):
-        """Start margin calculation in a separate thread."""
-        if self.is_calculating:
-            messagebox.showwarning("Already Running", "Calculation is already in progress!")
+    def _pump(self):
+        """Flush queued log lines and job updates into the widgets (Tk thread)."""
+        lines = []
+        try:
+            while len(lines) < LOG_BATCH_LIMIT:
+                lines.append(self.log_queue.get_nowait())
+        except queue.Empty:
+            pass
+
+        if lines:
+            self.status_text.config(state=tk.NORMAL)
+            self.status_text.insert(tk.END, "\n".join(lines) + "\n")
+            excess = int(self.status_text.index("end-1c").split(".")[0]) - LOG_MAX_LINES
+            if excess > 0:
+                self.status_text.delete("1.0", f"{excess + 1}.0")
+            self.status_text.see(tk.END)
+            self.status_text.config(state=tk.DISABLED)
+
+        updated = set()
+        try:
+            while True:
+                updated.add(self.job_updates.get_nowait())
+        except queue.Empty:
+            pass
+        for job_id in updated:
+            self._refresh_job_row(self.jobs[job_id])
+
+        # Schedule the next pump first: showerror blocks until dismissed
+        self.root.after(LOG_FLUSH_MS, self._pump)
+        try:
+            title, message = self.error_dialogs.get_nowait()
+        except queue.Empty:
             return
+        messagebox.showerror(title, message)
+
+    def _refresh_job_row(self, job):
+        self.job_tree.item(
+            job.id,
+            values=(job.excel_path.name, job.status, f"{job.progress}%", job.timings_text()),
+        )
+        if job.status.startswith("Running"):
+            self.progress["value"] = job.progress
+        elif job.status in ("Done", "Failed", "Cancelled") and self.pending_jobs.empty():
+            self.progress["value"] = 0
 
+    def _job_changed(self, job):
+        self.job_updates.put(job.id)
+
+    def calculate_margin(self):
+        """Queue the selected file for calculation."""
         if not self.excel_path.exists():
             messagebox.showerror(
                 "File Not Found",
@@ -169,92 +400,138 @@ class MarginCalculatorGUI:
             )
             return
 
-        # # Confirm before starting
-        # response = messagebox.askyesno(
-        #     "Confirm Calculation",
-        #     # f"Calculate margin for:\n{self.excel_path.name}\n\nThis will open a browser window."
-        # )
+        self.submit_job(self.excel_path)
 
-        # if not response:
-        #     return
+    def submit_job(self, excel_path):
+        """Add a job to the panel and make sure the runner thread is active."""
+        job = Job(Path(excel_path).resolve())
+        self.jobs[job.id] = job
+        self.job_tree.insert("", tk.END, iid=job.id)
+        self._refresh_job_row(job)
+        self.pending_jobs.put(job)
+        self.update_status(f"Queued: {job.excel_path.name}")
 
-        # Clear status
-        self.status_text.config(state=tk.NORMAL)
-        self.status_text.delete(1.0, tk.END)
-        self.status_text.config(state=tk.DISABLED)
-
-        # Disable button and show progress
-        self.is_calculating = True
-        self.calc_button.config(state=tk.DISABLED, bg="#cccccc")
-        self.progress.pack(pady=10)
-        self.progress.start(10)
-
-        # Run calculation in separate thread
-        calc_thread = threading.Thread(target=self.run_calculation, daemon=True)
-        calc_thread.start()
+        if self.runner_thread is None:
+            self.runner_thread = threading.Thread(
+                target=self.run_jobs, name="MarginJobRunner", daemon=True
+            )
+            self.runner_thread.start()
+
+    def cancel_selected(self):
+        """Cancel the selected jobs (queued jobs are skipped, running ones stop at the next step)."""
+        for job_id in self.job_tree.selection():
+            job = self.jobs[job_id]
+            if job.status in ("Done", "Failed", "Cancelled"):
+                continue
+            job.cancel_event.set()
+            if job.status == "Queued":
+                job.status = "Cancelled"
+            else:
+                job.status = "Cancelling..."
+            self._job_changed(job)
+
+    def run_jobs(self):
+        """Run queued jobs one after another on the shared backend (runner thread)."""
+        while True:
+            job = self.pending_jobs.get()
+            if job.cancel_event.is_set():
+                continue
+            self.run_calculation(job)
+
+    def run_calculation(self, job):
+        """Execute one margin calculation (runs on the runner thread)."""
+
+        from margin_events import PROGRESS_EVENTS
+
+        def on_event(event):
+            if job.cancel_event.is_set() and not event.terminal:
+                raise JobCancelled(f"Cancelled before {event.kind}")
+            if event.kind in PROGRESS_EVENTS:
+                job.steps_done = PROGRESS_EVENTS.index(event.kind) + 1
+            if not event.terminal:
+                job.step = event.kind
+                job.status = f"Running: {event.kind}"
+            self._job_changed(job)
 
-    def run_calculation(self):
-        """Execute the margin calculation (runs in separate thread)."""
         try:
             self.update_status("="*50)
-            self.update_status("Starting margin calculation...")
+            self.update_status(f"Starting margin calculation: {job.excel_path.name}")
             self.update_status("="*50)
+            job.status = "Running"
+            self._job_changed(job)
+
+            # Run the calculation (waits for the background import if still running)
+            from margin_calculator import (
+                margin_results_path,
+                run_margin_calc,
+                write_margin_to_excel,
+            )
 
-            # Run the calculation
-            run_margin_calc(str(self.excel_path))
+            job.result = run_margin_calc(
+                str(job.excel_path),
+                store=self.get_result_store(),
+                timings=job.timings,
+                on_event=on_event,
+            )
+            saved = None
+            if job.result:
+                saved = write_margin_to_excel(job.excel_path, sum(job.result.values()))
 
             # Success
+            job.status = "Done"
             self.update_status("")
             self.update_status("="*50)
             self.update_status(f"✅ SUCCESS!")
-            # self.update_status(f"Calculated Margin: {result}")
-            self.update_status(f"Result saved to: {self.excel_path.name}")
+            if job.result:
+                self.update_status(f"Calculated Margin: {sum(job.result.values()):,.2f}")
+            if saved:
+                self.update_status(f"Result saved to: {saved}")
+            elif job.result:
+                self.update_status("⚠️ Result could not be saved (is it open in Excel?)")
+                self.error_dialogs.put((
+                    "Save Error",
+                    f"The margin for {job.excel_path.name} was calculated but could not "
+                    f"be saved to {margin_results_path(job.excel_path)}.\n\n"
+                    "Close it in Excel and run the calculation again.",
+                ))
             self.update_status("="*50)
 
-            # Show success dialog
-            # self.root.after(
-            #     0,
-            #     lambda: messagebox.showinfo(
-            #         "Success",
-            #         f"Margin calculated successfully!\n\nResult: {result}\n\nCheck your Excel file."
-            #     )
-            # )
+        except JobCancelled as e:
+            job.status = "Cancelled"
+            self.update_status(f"\n⏹ {job.excel_path.name}: {e}")
 
         except FileNotFoundError as e:
-            error_msg = str(e)
-            self.update_status(f"\n❌ ERROR: {error_msg}")
-            self.root.after(
-                0,
-                lambda msg=error_msg: messagebox.showerror("File Error", msg)
-            )
+            job.status = "Failed"
+            job.error = str(e)
+            self.update_status(f"\n❌ ERROR: {job.error}")
+            self.error_dialogs.put(("File Error", job.error))
 
         except Exception as e:
-            error_msg = str(e)
-            self.update_status(f"\n❌ ERROR: {error_msg}")
-            self.root.after(
-                0,
-                lambda msg=error_msg: messagebox.showerror(
-                    "Calculation Error",
-                    f"An error occurred:\n\n{msg}\n\nCheck the status log for details."
-                )
-            )
+            job.status = "Failed"
+            job.error = str(e)
+            self.update_status(f"\n❌ ERROR: {job.error}")
+            self.error_dialogs.put((
+                "Calculation Error",
+                f"An error occurred in {job.excel_path.name}:\n\n{job.error}"
+                "\n\nCheck the status log for details."
+            ))
 
         finally:
-            # Re-enable button
-            self.root.after(0, self.finish_calculation)
+            self._job_changed(job)
 
-    def finish_calculation(self):
-        """Reset UI after calculation completes."""
-        self.is_calculating = False
-        self.calc_button.config(state=tk.NORMAL, bg="#2196F3")
-        self.progress.stop()
-        self.progress.pack_forget()
 
-
-def main():
+def main(argv=None):
     """Main entry point for the GUI application."""
+    parser = argparse.ArgumentParser(description="ICE Margin Calculator GUI")
+    parser.add_argument(
+        "--warm-up",
+        action="store_true",
+        help="Start the browser and open ICA in the background at startup",
+    )
+    args = parser.parse_args(argv)
+
     root = tk.Tk()
-    app = MarginCalculatorGUI(root)
+    app = MarginCalculatorGUI(root, warm_up=args.warm_up)
     root.mainloop()
 
 
@@ -0,0 +1,122 @@
+"""
+Streaming parser for the ICA "Export to Excel" results file.
+
+One export holds every portfolio in the run together with its per-account
+breakdown, so a multi-portfolio run needs one download instead of one grid
+read per portfolio. The workbook is read in openpyxl's read-only (streaming)
+mode straight from memory.
+"""
+
+import csv
+import io
+
+from margin_calculator import RESULT_MARGIN_HEADER, RESULT_PORTFOLIO_HEADER, parse_margin_value
+
+# ---------------------------------------------------------------------
+# CONFIG
+# ---------------------------------------------------------------------
+EXPORT_ACCOUNT_HEADER = "Account"  # Column with the account of a breakdown row
+EXPORT_METRIC_KEYWORDS = ("Margin", "Requirement", "Premium", "Risk", "Collateral")
+EXPORT_TOTAL_ACCOUNTS = ("", "all", "total", "all accounts")  # Portfolio-level rows
+HEADER_SEARCH_ROWS = 20  # Rows scanned for the header row
+# ---------------------------------------------------------------------
+
+
+def _iter_rows(data: bytes):
+    """Yield rows (tuples) from every sheet of an .xlsx export, or from a CSV."""
+    if data[:2] == b"PK":  # .xlsx is a zip file
+        from openpyxl import load_workbook
+
+        wb = load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+        try:
+            for ws in wb.worksheets:
+                yield from ws.iter_rows(values_only=True)
+                yield None  # sheet boundary: look for a new header
+        finally:
+            wb.close()
+    else:
+        text = data.decode("utf-8-sig", errors="replace")
+        yield from (tuple(row) for row in csv.reader(io.StringIO(text)))
+
+
+def _find_columns(headers):
+    names = [str(h).strip() if h is not None else "" for h in headers]
+    lowered = [n.lower() for n in names]
+    if RESULT_PORTFOLIO_HEADER.lower() not in lowered:
+        return None
+
+    portfolio_col = lowered.index(RESULT_PORTFOLIO_HEADER.lower())
+    account_col = None
+    for i, name in enumerate(lowered):
+        if name == EXPORT_ACCOUNT_HEADER.lower():
+            account_col = i
+            break
+
+    metric_cols = {
+        i: name
+        for i, name in enumerate(names)
+        if i not in (portfolio_col, account_col)
+        and any(k.lower() in name.lower() for k in EXPORT_METRIC_KEYWORDS)
+    }
+    primary = next(
+        (i for i, name in metric_cols.items() if RESULT_MARGIN_HEADER.lower() in name.lower()),
+        None,
+    )
+    if primary is None:
+        return None
+    return portfolio_col, account_col, metric_cols, primary
+
+
+def parse_export(data: bytes):
+    """
+    Parse an ICA export into structured results.
+
+    Returns: dict with
+        "portfolios": {portfolio: margin}
+        "accounts":   {portfolio: {account: {metric: value}}}
+    """
+    margins = {}
+    accounts = {}
+    account_totals = {}
+    columns = None
+    scanned = 0
+
+    for row in _iter_rows(data):
+        if row is None:
+            columns = None
+            scanned = 0
+            continue
+        if columns is None:
+            scanned += 1
+            if scanned <= HEADER_SEARCH_ROWS:
+                columns = _find_columns(row)
+            continue
+
+        portfolio_col, account_col, metric_cols, primary = columns
+        if portfolio_col >= len(row) or row[portfolio_col] in (None, ""):
+            continue
+        portfolio = str(row[portfolio_col]).strip()
+        metrics = {
+            name: parse_margin_value(row[i]) for i, name in metric_cols.items() if i < len(row)
+        }
+        metrics = {name: value for name, value in metrics.items() if value is not None}
+
+        account = None
+        if account_col is not None and account_col < len(row) and row[account_col] is not None:
+            account = str(row[account_col]).strip()
+
+        if account is None or account.lower() in EXPORT_TOTAL_ACCOUNTS:
+            value = metrics.get(metric_cols[primary])
+            if value is not None:
+                margins[portfolio] = value
+        else:
+            accounts.setdefault(portfolio, {})[account] = metrics
+            value = metrics.get(metric_cols[primary])
+            if value is not None:
+                account_totals[portfolio] = account_totals.get(portfolio, 0.0) + value
+
+    # Portfolios exported only as account rows: total the primary metric
+    for portfolio, total in account_totals.items():
+        margins.setdefault(portfolio, total)
+
+    return {"portfolios": margins, "accounts": accounts}
@@ -0,0 +1,501 @@
+"""
+Distributed job queue so several machines can share the margin workload.
+
+A producer enqueues position books into a durable SQLite queue. The queue is
+served to the local network by a small JSON-lines TCP server (no outside
+broker), and worker processes on each desk machine hold their own warmed
+BrowserSession, lease jobs with a visibility timeout, heartbeat while they
+work and post results back. Jobs whose lease expires (worker died) are handed
+out again, up to MAX_ATTEMPTS.
+
+    python job_queue.py serve --db margin_queue.db --host 0.0.0.0 --port 8765
+    python job_queue.py enqueue books/*.xlsx --server host:8765
+    python job_queue.py worker --server host:8765 --headless
+    python job_queue.py results --server host:8765
+"""
+
+import argparse
+import base64
+import glob
+import json
+import os
+import socket
+import socketserver
+import sqlite3
+import tempfile
+import time
+import uuid
+from pathlib import Path
+from threading import Event, Lock, Thread
+
+# ---------------------------------------------------------------------
+# CONFIG
+# ---------------------------------------------------------------------
+QUEUE_DB = "margin_queue.db"  # SQLite file holding the queue
+DEFAULT_HOST = "127.0.0.1"  # The server has no auth; bind wider only on a trusted LAN
+DEFAULT_PORT = 8765
+VISIBILITY_TIMEOUT = 300  # Seconds a lease lasts without a heartbeat
+HEARTBEAT_INTERVAL = 30  # Seconds between worker heartbeats
+MAX_ATTEMPTS = 3  # Leases per job before it is marked failed
+POLL_INTERVAL = 2  # Seconds an idle worker waits before asking again
+# ---------------------------------------------------------------------
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    payload BLOB NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    lease_expires REAL,
+    enqueued_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    result TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, enqueued_at);
+"""
+
+
+class LeaseLost(Exception):
+    """The job's lease expired or was taken over by another worker."""
+
+
+class JobQueue:
+    """Durable job queue in a local SQLite file (WAL mode, thread-safe)."""
+
+    def __init__(self, path=QUEUE_DB, visibility_timeout=VISIBILITY_TIMEOUT):
+        self.path = Path(path)
+        self.visibility_timeout = visibility_timeout
+        self._lock = Lock()
+        self._conn = sqlite3.connect(
+            str(self.path), check_same_thread=False, isolation_level=None
+        )
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(_SCHEMA)
+
+    def _write(self, sql, params=()):
+        with self._lock:
+            cur = self._conn.cursor()
+            cur.execute("BEGIN IMMEDIATE")
+            try:
+                cur.execute(sql, params)
+                rowcount = cur.rowcount
+                cur.execute("COMMIT")
+            except Exception:
+                cur.execute("ROLLBACK")
+                raise
+            return rowcount
+
+    def enqueue(self, name, payload: bytes):
+        """Add a position book (file bytes) to the queue. Returns the job id."""
+        job_id = uuid.uuid4().hex
+        self._write(
+            "INSERT INTO jobs (id, name, payload, enqueued_at) VALUES (?, ?, ?, ?)",
+            (job_id, name, payload, time.time()),
+        )
+        return job_id
+
+    def lease(self, worker, visibility_timeout=None):
+        """
+        Lease the oldest available job for ``worker``.
+
+        Jobs whose lease has expired are available again; after MAX_ATTEMPTS
+        leases they are marked failed instead.
+
+        Returns: dict with id, name, payload, attempts, or None if idle
+        """
+        timeout = visibility_timeout or self.visibility_timeout
+        now = time.time()
+        with self._lock:
+            cur = self._conn.cursor()
+            cur.execute("BEGIN IMMEDIATE")
+            try:
+                cur.execute(
+                    "UPDATE jobs SET status = 'failed', finished_at = ?, "
+                    "error = 'lease expired ' || attempts || ' time(s)' "
+                    "WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?",
+                    (now, now, MAX_ATTEMPTS),
+                )
+                cur.execute(
+                    "SELECT id, name, payload, attempts FROM jobs "
+                    "WHERE status = 'queued' OR (status = 'leased' AND lease_expires < ?) "
+                    "ORDER BY enqueued_at LIMIT 1",
+                    (now,),
+                )
+                row = cur.fetchone()
+                if row is None:
+                    cur.execute("COMMIT")
+                    return None
+                cur.execute(
+                    "UPDATE jobs SET status = 'leased', worker = ?, lease_expires = ?, "
+                    "attempts = attempts + 1, started_at = ? WHERE id = ?",
+                    (worker, now + timeout, now, row["id"]),
+                )
+                cur.execute("COMMIT")
+            except Exception:
+                cur.execute("ROLLBACK")
+                raise
+        job = dict(row)
+        job["attempts"] += 1
+        return job
+
+    def heartbeat(self, job_id, worker, visibility_timeout=None):
+        """Extend a lease. Raises LeaseLost if ``worker`` no longer holds it."""
+        timeout = visibility_timeout or self.visibility_timeout
+        updated = self._write(
+            "UPDATE jobs SET lease_expires = ? "
+            "WHERE id = ? AND worker = ? AND status = 'leased'",
+            (time.time() + timeout, job_id, worker),
+        )
+        if not updated:
+            raise LeaseLost(job_id)
+
+    def complete(self, job_id, worker, result):
+        """Store a job's result. Raises LeaseLost if the lease was lost."""
+        updated = self._write(
+            "UPDATE jobs SET status = 'done', finished_at = ?, result = ?, payload = X'' "
+            "WHERE id = ? AND worker = ? AND status = 'leased'",
+            (time.time(), json.dumps(result), job_id, worker),
+        )
+        if not updated:
+            raise LeaseLost(job_id)
+
+    def fail(self, job_id, worker, error, retry=True):
+        """Release a failed job back to the queue (or mark it failed)."""
+        status = "queued" if retry else "failed"
+        self._write(
+            "UPDATE jobs SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE ? END, "
+            "error = ?, worker = NULL, lease_expires = NULL, "
+            "finished_at = CASE WHEN attempts >= ? OR ? = 'failed' THEN ? END "
+            "WHERE id = ? AND worker = ? AND status = 'leased'",
+            (MAX_ATTEMPTS, status, error, MAX_ATTEMPTS, status, time.time(), job_id, worker),
+        )
+
+    def status(self, job_id):
+        """Return the job (without its payload) or None."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, name, status, attempts, worker, enqueued_at, started_at, "
+                "finished_at, result, error FROM jobs WHERE id = ?",
+                (job_id,),
+            ).fetchone()
+        return _job_info(row) if row else None
+
+    def results(self, since=None):
+        """Return finished (done or failed) jobs, oldest first."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, name, status, attempts, worker, enqueued_at, started_at, "
+                "finished_at, result, error FROM jobs "
+                "WHERE status IN ('done', 'failed') AND finished_at >= ? "
+                "ORDER BY finished_at",
+                (since or 0,),
+            ).fetchall()
+        return [_job_info(row) for row in rows]
+
+    def counts(self):
+        """Return {status: number of jobs}."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT status, COUNT(*) FROM jobs GROUP BY status"
+            ).fetchall()
+        return {status: count for status, count in rows}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def _job_info(row):
+    info = dict(row)
+    if info.get("result"):
+        info["result"] = json.loads(info["result"])
+    return info
+
+
+# ---------------------------------------------------------------------
+# Network access: one JSON object per line in each direction
+# ---------------------------------------------------------------------
+
+_METHODS = ("enqueue", "lease", "heartbeat", "complete", "fail", "status", "results", "counts")
+
+
+class _QueueRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        queue = self.server.queue
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                method = request.pop("method")
+                if method not in _METHODS:
+                    raise ValueError(f"unknown method '{method}'")
+                if "payload" in request:
+                    request["payload"] = base64.b64decode(request["payload"])
+                result = getattr(queue, method)(**request)
+                if isinstance(result, dict) and "payload" in result:
+                    result["payload"] = base64.b64encode(result["payload"]).decode()
+                response = {"ok": True, "result": result}
+            except LeaseLost as e:
+                response = {"ok": False, "error": "lease_lost", "message": str(e)}
+            except Exception as e:  # noqa: BLE001 - returned to the client
+                response = {"ok": False, "error": type(e).__name__, "message": str(e)}
+            self.wfile.write((json.dumps(response) + "\n").encode())
+            self.wfile.flush()
+
+
+class QueueServer(socketserver.ThreadingTCPServer):
+    """Serve a JobQueue to workers and producers on the local network."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, queue: JobQueue, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        self.queue = queue
+        super().__init__((host, port), _QueueRequestHandler)
+
+
+class RemoteQueue:
+    """Client with the same interface as JobQueue, talking to a QueueServer."""
+
+    def __init__(self, address, timeout=30):
+        host, _, port = address.rpartition(":")
+        self.address = (host or "localhost", int(port or DEFAULT_PORT))
+        self.timeout = timeout
+        self._lock = Lock()
+        self._sock = None
+        self._file = None
+
+    def _connect(self):
+        self._sock = socket.create_connection(self.address, timeout=self.timeout)
+        self._file = self._sock.makefile("rwb")
+
+    def _call(self, method, **params):
+        if "payload" in params:
+            params["payload"] = base64.b64encode(params["payload"]).decode()
+        message = (json.dumps(dict(params, method=method)) + "\n").encode()
+        with self._lock:
+            for attempt in range(2):
+                try:
+                    if self._sock is None:
+                        self._connect()
+                    self._file.write(message)
+                    self._file.flush()
+                    line = self._file.readline()
+                    if not line:
+                        raise ConnectionError("queue server closed the connection")
+                    break
+                except OSError:
+                    self._reset()
+                    if attempt:
+                        raise
+        response = json.loads(line)
+        if not response["ok"]:
+            if response["error"] == "lease_lost":
+                raise LeaseLost(response["message"])
+            raise RuntimeError(f"{response['error']}: {response['message']}")
+        result = response["result"]
+        if isinstance(result, dict) and "payload" in result:
+            result["payload"] = base64.b64decode(result["payload"])
+        return result
+
+    def _reset(self):
+        try:
+            if self._sock is not None:
+                self._sock.close()
+        finally:
+            self._sock = None
+            self._file = None
+
+    def enqueue(self, name, payload):
+        return self._call("enqueue", name=name, payload=payload)
+
+    def lease(self, worker, visibility_timeout=None):
+        return self._call("lease", worker=worker, visibility_timeout=visibility_timeout)
+
+    def heartbeat(self, job_id, worker, visibility_timeout=None):
+        return self._call(
+            "heartbeat", job_id=job_id, worker=worker, visibility_timeout=visibility_timeout
+        )
+
+    def complete(self, job_id, worker, result):
+        return self._call("complete", job_id=job_id, worker=worker, result=result)
+
+    def fail(self, job_id, worker, error, retry=True):
+        return self._call("fail", job_id=job_id, worker=worker, error=error, retry=retry)
+
+    def status(self, job_id):
+        return self._call("status", job_id=job_id)
+
+    def results(self, since=None):
+        return self._call("results", since=since)
+
+    def counts(self):
+        return self._call("counts")
+
+    def close(self):
+        with self._lock:
+            self._reset()
+
+
+def open_queue(server=None, db=QUEUE_DB):
+    """Return a RemoteQueue for ``server`` ("host:port") or a local JobQueue."""
+    return RemoteQueue(server) if server else JobQueue(db)
+
+
+# ---------------------------------------------------------------------
+# Worker
+# ---------------------------------------------------------------------
+
+
+def run_worker(queue, session=None, worker_id=None, stop_event=None, max_jobs=None):
+    """
+    Lease and run jobs until ``stop_event`` is set (or ``max_jobs`` are done).
+
+    The session is warmed up before the first lease so the first job does
+    not pay for the browser launch.
+    """
+    from margin_calculator import BrowserSession, run_margin_calc
+    from recovery import UploadRejected
+
+    worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+    session = session or BrowserSession(headless=True, slow_mo=0)
+    stop_event = stop_event or Event()
+    done = 0
+
+    print(f"👷 Worker {worker_id} warming up browser session...")
+    try:
+        session.warm_up(block=True)
+    except Exception as e:  # noqa: BLE001 - the first job will retry the launch
+        print(f"⚠️ Warm-up failed: {e}")
+
+    with tempfile.TemporaryDirectory(prefix="margin_worker_") as work_dir:
+        while not stop_event.is_set() and (max_jobs is None or done < max_jobs):
+            job = queue.lease(worker_id)
+            if job is None:
+                stop_event.wait(POLL_INTERVAL)
+                continue
+
+            print(f"\n📥 Leased {job['name']} (attempt {job['attempts']})")
+            book = Path(work_dir) / f"{job['id']}{Path(job['name']).suffix or '.xlsx'}"
+            book.write_bytes(job["payload"])
+
+            lost = Event()
+            finished = Event()
+
+            def beat(job_id=job["id"]):
+                while not finished.wait(HEARTBEAT_INTERVAL):
+                    try:
+                        queue.heartbeat(job_id, worker_id)
+                    except LeaseLost:
+                        lost.set()
+                        return
+                    except Exception as e:  # noqa: BLE001 - keep beating
+                        print(f"⚠️ Heartbeat failed: {e}")
+
+            heart = Thread(target=beat, name="QueueHeartbeat", daemon=True)
+            heart.start()
+            timings = {}
+            try:
+                margins = run_margin_calc(book, session=session, timings=timings)
+                result = {"margins": margins, "timings": timings, "worker": worker_id}
+                finished.set()
+                if lost.is_set():
+                    print(f"⚠️ Lease on {job['name']} was lost; result discarded")
+                else:
+                    queue.complete(job["id"], worker_id, result)
+                    print(f"📤 Posted result for {job['name']}")
+            except LeaseLost:
+                print(f"⚠️ Lease on {job['name']} was lost; result discarded")
+            except (UploadRejected, ValueError) as e:
+                # A bad book fails the same way on every worker
+                finished.set()
+                queue.fail(job["id"], worker_id, str(e), retry=False)
+            except Exception as e:  # noqa: BLE001 - reported back to the queue
+                finished.set()
+                queue.fail(job["id"], worker_id, str(e))
+            finally:
+                finished.set()
+                heart.join()
+                book.unlink(missing_ok=True)
+            done += 1
+
+    return done
+
+
+# ---------------------------------------------------------------------
+# Command line
+# ---------------------------------------------------------------------
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Distributed margin job queue")
+    parser.add_argument("--db", default=QUEUE_DB, help="Queue file (serve / local mode)")
+    parser.add_argument("--server", help="host:port of a queue server")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_serve = sub.add_parser("serve", help="Serve the queue on the network")
+    p_serve.add_argument(
+        "--host",
+        default=DEFAULT_HOST,
+        help="Address to bind; 0.0.0.0 serves the whole network (default: %(default)s)",
+    )
+    p_serve.add_argument("--port", type=int, default=DEFAULT_PORT)
+
+    p_enqueue = sub.add_parser("enqueue", help="Queue position books")
+    p_enqueue.add_argument("files", nargs="+")
+
+    p_worker = sub.add_parser("worker", help="Run jobs with a local browser session")
+    p_worker.add_argument("--headless", action=argparse.BooleanOptionalAction, default=True)
+    p_worker.add_argument("--max-jobs", type=int)
+
+    p_results = sub.add_parser("results", help="Print finished jobs as JSON lines")
+    p_results.add_argument("--since", type=float, default=0, help="Unix time")
+
+    sub.add_parser("counts", help="Show jobs per status")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "serve":
+        server = QueueServer(JobQueue(args.db), args.host, args.port)
+        print(f"📡 Serving {args.db} on {args.host}:{args.port}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+        return 0
+
+    queue = open_queue(args.server, args.db)
+    try:
+        if args.command == "enqueue":
+            for pattern in args.files:
+                for path in sorted(glob.glob(pattern)) or [pattern]:
+                    job_id = queue.enqueue(Path(path).name, Path(path).read_bytes())
+                    print(json.dumps({"id": job_id, "file": str(path)}))
+        elif args.command == "worker":
+            from margin_calculator import BrowserSession
+
+            session = BrowserSession(headless=args.headless, slow_mo=0 if args.headless else 150)
+            try:
+                run_worker(queue, session, max_jobs=args.max_jobs)
+            except KeyboardInterrupt:
+                pass
+            finally:
+                session.close()
+        elif args.command == "results":
+            for job in queue.results(args.since):
+                print(json.dumps(job))
+        elif args.command == "counts":
+            print(json.dumps(queue.counts()))
+    finally:
+        queue.close()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
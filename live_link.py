@@ -0,0 +1,447 @@
+"""
+Event-driven tracking of edits to an open positions workbook.
+
+``read_excel_live`` re-scans the sheet on every calculation. A LiveLink
+instead loads the first sheet once into an in-memory mirror and subscribes
+to the workbook's SheetChange events (Excel COM, Windows), so afterwards
+only the edited cells are read. It keeps the set of dirty rows, re-hashes
+only the portfolios those rows touch, and feeds the delta upload
+(position_delta.py), or skips the calculation when nothing was edited.
+
+FakeEventSource stands in for Excel on machines without it:
+
+    source = FakeEventSource.from_file("positions_template.xlsx")
+    link = LiveLink("positions_template.xlsx", source=source).start()
+    source.edit(3, 14, 250)       # row 3, column N
+    link.changes()                # ([3], {"ACC001-PF001"})
+"""
+
+import os
+import tempfile
+import time
+from pathlib import Path
+from threading import Event, Lock, Thread
+
+from excel_live_reader import find_open_workbook
+from margin_calculator import (
+    PORTFOLIO_COLUMN,
+    read_positions,
+    run_margin_calc,
+    write_positions_file,
+)
+from position_delta import DELTA_MAX_AGE_HOURS, DeltaPlan, portfolio_hashes
+
+# ---------------------------------------------------------------------
+# CONFIG
+# ---------------------------------------------------------------------
+COM_PUMP_INTERVAL = 0.05  # Seconds between COM message pumps
+COM_MAX_CELLS = 50_000  # Larger edits (pasted sheets, whole columns) reload the mirror
+# ---------------------------------------------------------------------
+
+
+def _has_data(values):
+    return any(v is not None and str(v).strip() != "" for v in values)
+
+
+def _used_range_rows(sheet):
+    """The sheet's used range as a list of row tuples, starting at row 1."""
+    used = sheet.UsedRange
+    values = used.Value
+    if used.Count == 1:
+        values = ((values,),)
+    top, left = used.Row, used.Column
+    width = left - 1 + max((len(row) for row in values), default=0)
+    blank = (None,) * width
+    return [blank] * (top - 1) + [(None,) * (left - 1) + tuple(row) for row in values]
+
+
+class _WorkbookEvents:
+    """Workbook event sink for DispatchWithEvents; callbacks are set on a subclass."""
+
+    on_change = None
+    on_resync = None
+
+    def OnSheetChange(self, sheet, target):
+        try:
+            if sheet.Index != 1:
+                return
+            if target.Count > COM_MAX_CELLS or target.Columns.Count == sheet.Columns.Count:
+                self.on_resync()  # Row inserts/deletes shift the mirror
+                return
+            for area in target.Areas:
+                values = area.Value
+                if area.Count == 1:
+                    values = ((values,),)
+                self.on_change(area.Row, area.Column, values)
+        except Exception:  # noqa: BLE001 - an event we cannot read forces a reload
+            self.on_resync()
+
+
+class ComEventSource:
+    """SheetChange events of a workbook open in Excel (needs pywin32)."""
+
+    def __init__(self, excel_path):
+        self.excel_path = Path(excel_path).resolve()
+        self._stop = Event()
+        self._ready = Event()
+        self._error = None
+        self._thread = None
+
+    def _workbook(self):
+        import pythoncom
+        import win32com.client
+
+        pythoncom.CoInitialize()
+        excel = win32com.client.GetActiveObject("Excel.Application")
+        workbook = find_open_workbook(excel, self.excel_path)
+        if workbook is None:
+            raise RuntimeError(f"{self.excel_path.name} is not open in Excel")
+        return workbook
+
+    def snapshot(self):
+        return _used_range_rows(self._workbook().Worksheets(1))
+
+    def start(self, on_change, on_resync):
+        self._stop.clear()
+        self._ready.clear()
+        self._error = None
+        self._thread = Thread(
+            target=self._pump, args=(on_change, on_resync), name="ExcelLiveLink", daemon=True
+        )
+        self._thread.start()
+        self._ready.wait()
+        if self._error is not None:
+            raise self._error
+
+    def _pump(self, on_change, on_resync):
+        # COM events are delivered to the thread that subscribed, while it pumps
+        import pythoncom
+        import win32com.client
+
+        try:
+            handler = type(
+                "_Handler",
+                (_WorkbookEvents,),
+                {"on_change": staticmethod(on_change), "on_resync": staticmethod(on_resync)},
+            )
+            events = win32com.client.DispatchWithEvents(self._workbook(), handler)
+        except Exception as e:  # noqa: BLE001 - re-raised by start()
+            self._error = e
+            self._ready.set()
+            return
+        self._ready.set()
+        try:
+            while not self._stop.is_set():
+                pythoncom.PumpWaitingMessages()
+                time.sleep(COM_PUMP_INTERVAL)
+        finally:
+            try:
+                events.close()
+            except Exception:  # noqa: BLE001 - Excel may already be gone
+                pass
+            pythoncom.CoUninitialize()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+
+class FakeEventSource:
+    """In-process stand-in for Excel: ``edit`` fires change events like SheetChange."""
+
+    def __init__(self, rows=()):
+        self.rows = [list(row) for row in rows]
+        self._on_change = None
+        self._on_resync = None
+
+    @classmethod
+    def from_file(cls, excel_path):
+        headers, rows = read_positions(excel_path)
+        grid = [list(headers)]
+        for excel_row, values in rows:
+            grid.extend([] for _ in range(excel_row - len(grid) - 1))
+            grid.append(list(values))
+        return cls(grid)
+
+    def snapshot(self):
+        return [tuple(row) for row in self.rows]
+
+    def start(self, on_change, on_resync):
+        self._on_change = on_change
+        self._on_resync = on_resync
+
+    def stop(self):
+        self._on_change = self._on_resync = None
+
+    def edit(self, row, column, value):
+        """Set one cell (1-based, like Excel) and fire a change event."""
+        self.edit_range(row, column, [[value]])
+
+    def edit_range(self, row, column, values):
+        """Paste a block of ``values`` with its top-left cell at (row, column)."""
+        values = tuple(tuple(line) for line in values)
+        for i, line in enumerate(values):
+            while len(self.rows) < row + i:
+                self.rows.append([])
+            cells = self.rows[row + i - 1]
+            cells.extend([None] * (column - 1 + len(line) - len(cells)))
+            cells[column - 1 : column - 1 + len(line)] = line
+        if self._on_change is not None:
+            self._on_change(row, column, values)
+
+    def insert_row(self, row, values=()):
+        """Insert a row (shifting the ones below), which Excel reports as a whole-row change."""
+        self.rows.insert(row - 1, list(values))
+        if self._on_resync is not None:
+            self._on_resync()
+
+
+class LiveLink:
+    """In-memory mirror of a workbook's position rows, kept current by change events."""
+
+    def __init__(self, excel_path, source=None):
+        self.excel_path = Path(excel_path).resolve()
+        self.source = source or ComEventSource(self.excel_path)
+        self._lock = Lock()
+        self.headers = []
+        self._cells = {}  # excel row -> values (header width)
+        self._dirty = set()  # rows edited since their portfolio was last hashed
+        self._stale = True
+        self._generation = 0  # Bumped by every reload; only the latest one installs
+        self._replay = None  # Edits that arrive while a reload reads the sheet
+        self._hashes = {}  # portfolio -> positions hash
+        self._members = {}  # portfolio -> excel rows
+        self._row_names = {}  # excel row -> portfolio
+        self._version = 0
+        self._calculated = None  # (version, margins) of the last successful calculation
+        self.events = 0
+        self.reloads = 0
+
+    def start(self):
+        # Subscribe first so no edit falls between the snapshot and the events
+        self.source.start(self._on_change, self._on_resync)
+        self.reload()
+        return self
+
+    def stop(self):
+        self.source.stop()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def reload(self):
+        """
+        Rebuild the mirror from a full read of the sheet.
+
+        Edits that arrive while the sheet is being read may or may not be in
+        the snapshot, so they are replayed on top of it (events carry the new
+        values, so replaying one the snapshot already has changes nothing).
+        A resync or header edit during the read leaves the mirror stale.
+        """
+        with self._lock:
+            self._stale = False
+            self._generation += 1
+            generation = self._generation
+            self._replay = []
+        try:
+            grid = self.source.snapshot()
+        except Exception:
+            with self._lock:
+                if generation == self._generation:
+                    self._replay = None
+                    self._stale = True
+            raise
+        headers = [str(h).strip() if h is not None else "" for h in (grid[0] if grid else ())]
+        while headers and headers[-1] == "":
+            headers.pop()
+        width = len(headers)
+        cells = {}
+        for excel_row, values in enumerate(grid[1:], start=2):
+            values = list(values[:width]) + [None] * (width - len(values))
+            if _has_data(values):
+                cells[excel_row] = values
+
+        with self._lock:
+            if generation != self._generation:
+                return  # A later reload started meanwhile and will install its own read
+            self.headers = headers
+            self._cells = cells
+            self._dirty = set(cells)
+            self._hashes = {}
+            self._members = {}
+            self._row_names = {}
+            self._version += 1
+            self.reloads += 1
+            replay, self._replay = self._replay, None
+            for event in replay:
+                self._apply(*event)
+        print(f"📊 Live link: mirrored {len(cells)} position(s) from {self.excel_path.name}")
+
+    def _on_change(self, row, column, values):
+        with self._lock:
+            self.events += 1
+            if self._replay is not None:
+                self._replay.append((row, column, values))
+            else:
+                self._apply(row, column, values)
+
+    def _apply(self, row, column, values):
+        """Apply one change event to the mirror (lock held)."""
+        if self._stale:
+            return
+        width = len(self.headers)
+        for i, line in enumerate(values):
+            excel_row = row + i
+            if excel_row == 1:
+                self._stale = True  # Header edits remap every column
+                return
+            if column > width:
+                continue
+            cells = self._cells.get(excel_row) or [None] * width
+            for j, value in enumerate(line[: width - column + 1]):
+                cells[column - 1 + j] = value
+            if _has_data(cells):
+                self._cells[excel_row] = cells
+            else:
+                self._cells.pop(excel_row, None)
+            self._dirty.add(excel_row)
+            self._version += 1
+
+    def _on_resync(self):
+        with self._lock:
+            self.events += 1
+            self._stale = True
+
+    def _fresh(self):
+        if self._stale:
+            self.reload()
+
+    def positions(self):
+        """(headers, rows) like ``read_positions``, from the mirror."""
+        self._fresh()
+        with self._lock:
+            return list(self.headers), [(r, tuple(self._cells[r])) for r in sorted(self._cells)]
+
+    def changes(self):
+        """(dirty rows, portfolios they belong to now or belonged to before)."""
+        self._fresh()
+        with self._lock:
+            names = set()
+            if PORTFOLIO_COLUMN in self.headers:
+                col = self.headers.index(PORTFOLIO_COLUMN)
+                for row in self._dirty:
+                    if row in self._row_names:
+                        names.add(self._row_names[row])
+                    if row in self._cells and self._cells[row][col] is not None:
+                        names.add(str(self._cells[row][col]).strip())
+            names.discard("")
+            return sorted(self._dirty), names
+
+    def _rehash(self):
+        """Re-hash the portfolios touched by dirty rows; False if the book cannot be split."""
+        if PORTFOLIO_COLUMN not in self.headers:
+            return False
+        col = self.headers.index(PORTFOLIO_COLUMN)
+        touched = set()
+        for row in self._dirty:
+            old = self._row_names.pop(row, None)
+            if old is not None:
+                self._members[old].discard(row)
+                touched.add(old)
+            if row in self._cells:
+                name = self._cells[row][col]
+                name = "" if name is None else str(name).strip()
+                self._row_names[row] = name
+                self._members.setdefault(name, set()).add(row)
+                touched.add(name)
+        self._dirty.clear()
+
+        for name in touched:
+            rows = self._members.get(name)
+            if not rows:
+                self._members.pop(name, None)
+                self._hashes.pop(name, None)
+            elif name:
+                book = [(r, tuple(self._cells[r])) for r in sorted(rows)]
+                self._hashes[name] = portfolio_hashes(self.headers, book)[0][name]
+        return not self._members.get("")  # Rows without a portfolio name
+
+    def plan_delta(self, store, max_age_hours=DELTA_MAX_AGE_HOURS):
+        """A position_delta.DeltaPlan from the mirror; None if the book cannot be split."""
+        self._fresh()
+        with self._lock:
+            if not self._rehash():
+                return None
+            headers = list(self.headers)
+            hashes = dict(self._hashes)
+            grouped = {
+                name: [(r, tuple(self._cells[r])) for r in sorted(rows)]
+                for name, rows in self._members.items()
+            }
+        stored = store.portfolio_states(list(hashes), max_age_hours=max_age_hours)
+        return DeltaPlan(headers, hashes, grouped, stored)
+
+    def calculate(self, session=None, store=None, **kwargs):
+        """
+        Calculate the book as it is in Excel, saved or not.
+
+        Without edits since the last successful calculation its margins are
+        returned at once. With a ``store`` only changed portfolios are
+        uploaded (see ``plan_delta``); otherwise the whole mirror is.
+        Other keyword arguments go to ``run_margin_calc``.
+        """
+        self._fresh()
+        with self._lock:
+            version = self._version
+            if self._calculated is not None and self._calculated[0] == version:
+                print("♻️  No edits since the last calculation")
+                return dict(self._calculated[1])
+
+        plan = self.plan_delta(store) if store is not None else None
+        if plan is not None:
+            margins = run_margin_calc(
+                self.excel_path, session=session, store=store, delta_plan=plan, **kwargs
+            )
+        else:
+            headers, rows = self.positions()
+            handle, path = tempfile.mkstemp(prefix="live_", suffix=".xlsx")
+            os.close(handle)
+            upload = write_positions_file(path, headers, rows)
+            timings = kwargs.setdefault("timings", {})
+            try:
+                margins = run_margin_calc(upload, session=session, delta=False, **kwargs)
+            finally:
+                upload.unlink(missing_ok=True)
+            if store is not None:
+                store.record_run(self.excel_path, margins, timings=timings)
+
+        self._calculated = (version, dict(margins))
+        return margins
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Print edits of a workbook open in Excel.")
+    parser.add_argument("excel", nargs="?", default="positions_template.xlsx")
+    args = parser.parse_args()
+
+    link = LiveLink(args.excel).start()
+    print("Watching for edits (Ctrl+C to stop)...")
+    seen = link.events
+    try:
+        while True:
+            time.sleep(2)
+            if link.events != seen:
+                seen = link.events
+                rows, names = link.changes()
+                print(f"✏️  Dirty rows {rows} in portfolio(s) {sorted(names)}")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        link.stop()
@@ -0,0 +1,209 @@
+"""
+Marginal contribution (leave-one-out) attribution for a positions file.
+
+For every portfolio in the file a base portfolio is built together with one
+variant per position row (or per contract / expiry group) that leaves that
+row out. All variants are packed into as few multi-portfolio uploads as
+possible, and each row's contribution (base margin - margin without it) is
+written next to a copy of the row in a workbook beside the book.
+"""
+
+import tempfile
+from pathlib import Path
+
+from openpyxl import Workbook
+
+from margin_calculator import (
+    MARGIN_RESULTS_DIR,
+    PORTFOLIO_COLUMN,
+    _perform_margin_calculation,
+    get_browser_session,
+    read_positions,
+    write_positions_file,
+)
+
+# ---------------------------------------------------------------------
+# CONFIG
+# ---------------------------------------------------------------------
+ATTRIBUTION_COLUMN = "Marginal Contribution"  # Column written next to each row copy
+MAX_ROWS_PER_UPLOAD = 20000  # Position rows packed into one upload file
+GROUP_COLUMNS = {
+    "row": None,
+    "contract": ("Exchange Code", "Exchange Contract Code"),
+    "expiry": ("Exchange Code", "Exchange Contract Code", "Expiry Date"),
+}
+# ---------------------------------------------------------------------
+
+
+def _group_key(headers, values, excel_row, group_by):
+    """Return the leave-out group a row belongs to."""
+    columns = GROUP_COLUMNS[group_by]
+    if columns is None:
+        return (excel_row,)
+    missing = [c for c in columns if c not in headers]
+    if missing:
+        raise ValueError(f"Cannot group by '{group_by}': missing column(s) {missing}")
+    # Normalized so that e.g. 20251100 and '20251100' are the same expiry
+    key = (values[headers.index(c)] for c in columns)
+    return tuple("" if v is None else str(v).strip() for v in key)
+
+
+def build_variants(headers, rows, group_by="row"):
+    """
+    Build the base and leave-one-out portfolios for ``rows``.
+
+    Returns: (variants, groups)
+        variants: {upload portfolio name: list of rows}
+        groups: list of (base name, variant name, excel rows left out)
+    """
+    if group_by not in GROUP_COLUMNS:
+        raise ValueError(f"Unknown group_by '{group_by}'. Use one of {list(GROUP_COLUMNS)}")
+    if PORTFOLIO_COLUMN not in headers:
+        raise ValueError(f"'{PORTFOLIO_COLUMN}' column not found in positions file")
+
+    name_col = headers.index(PORTFOLIO_COLUMN)
+
+    by_portfolio = {}
+    for excel_row, values in rows:
+        by_portfolio.setdefault(str(values[name_col]), []).append((excel_row, values))
+
+    def rename(values, name):
+        values = list(values)
+        values[name_col] = name
+        return tuple(values)
+
+    variants = {}
+    groups = []
+    for p_index, (portfolio, members) in enumerate(by_portfolio.items(), start=1):
+        base_name = f"P{p_index}_BASE"
+        variants[base_name] = [(r, rename(v, base_name)) for r, v in members]
+
+        by_group = {}
+        for excel_row, values in members:
+            key = _group_key(headers, values, excel_row, group_by)
+            by_group.setdefault(key, []).append(excel_row)
+
+        for g_index, left_out in enumerate(by_group.values(), start=1):
+            variant_name = f"P{p_index}_LOO{g_index}"
+            left_out_rows = set(left_out)
+            kept = [(r, rename(v, variant_name)) for r, v in members if r not in left_out_rows]
+            # An empty variant has zero margin and does not need an upload
+            if kept:
+                variants[variant_name] = kept
+            groups.append((base_name, variant_name, left_out))
+
+    return variants, groups
+
+
+def _pack_batches(variants, max_rows=MAX_ROWS_PER_UPLOAD):
+    """Split the variant portfolios into upload batches of at most ``max_rows`` rows."""
+    batches = []
+    current = {}
+    current_rows = 0
+    for name, rows in variants.items():
+        if current and current_rows + len(rows) > max_rows:
+            batches.append(current)
+            current = {}
+            current_rows = 0
+        current[name] = rows
+        current_rows += len(rows)
+    if current:
+        batches.append(current)
+    return batches
+
+
+def _run_batch(session, headers, batch, work_dir, index):
+    """Upload one batch of portfolios and return their margins."""
+    upload_path = Path(work_dir) / f"attribution_batch_{index}.xlsx"
+    rows = [row for portfolio_rows in batch.values() for row in portfolio_rows]
+    write_positions_file(upload_path, headers, rows)
+    print(f"📦 Batch {index}: {len(batch)} portfolio(s), {len(rows)} row(s)")
+    return session.run(_perform_margin_calculation, upload_path, list(batch))
+
+
+def attribution_results_path(excel_path):
+    """The workbook ``write_contributions_to_excel`` writes a book's contributions to."""
+    excel_path = Path(excel_path)
+    return excel_path.parent / MARGIN_RESULTS_DIR / f"{excel_path.stem} - {ATTRIBUTION_COLUMN}.xlsx"
+
+
+def write_contributions_to_excel(excel_path, headers, rows, contributions):
+    """
+    Write the book's ``rows`` with their ``{excel_row: contribution}`` to the
+    attribution workbook (``attribution_results_path``).
+
+    Like the margin total, contributions never go into the book itself: an
+    openpyxl save would drop its formula cells' cached values.
+    """
+    path = attribution_results_path(excel_path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Attribution")
+    ws.append(["Row"] + list(headers) + [ATTRIBUTION_COLUMN])
+    for excel_row, values in rows:
+        ws.append([excel_row] + list(values) + [contributions.get(excel_row)])
+    wb.save(path)
+    print(f"✅ Marginal contributions written to {path} ({len(contributions)} rows)")
+    return path
+
+
+def run_attribution(excel_path, group_by="row", session=None, write_back=True):
+    """
+    Compute each row's marginal contribution to its portfolio's margin.
+
+    Batches run one after another on ``session`` (one per ICA login, see
+    margin_calculator.BrowserSession).
+
+    Returns: dict of {excel_row: contribution}
+    """
+    excel_path = Path(excel_path).resolve()
+    if not excel_path.exists():
+        raise FileNotFoundError(f"Excel file not found: {excel_path}")
+
+    headers, rows = read_positions(excel_path)
+    upload_headers = [h for h in headers if h != ATTRIBUTION_COLUMN]
+    if len(upload_headers) != len(headers):
+        keep = [i for i, h in enumerate(headers) if h != ATTRIBUTION_COLUMN]
+        rows = [(r, tuple(v[i] for i in keep)) for r, v in rows]
+        headers = upload_headers
+
+    variants, groups = build_variants(headers, rows, group_by)
+    batches = _pack_batches(variants)
+    session = session or get_browser_session()
+
+    print(f"\n{'='*60}")
+    print(f"Attribution: {len(rows)} row(s), {len(groups)} group(s) by {group_by}")
+    print(f"{len(variants)} portfolio(s) in {len(batches)} upload batch(es)")
+    print(f"{'='*60}")
+
+    margins = {}
+    with tempfile.TemporaryDirectory(prefix="ica_attr_") as work_dir:
+        for index, batch in enumerate(batches, start=1):
+            margins.update(_run_batch(session, headers, batch, work_dir, index))
+
+    contributions = {}
+    for base_name, variant_name, left_out in groups:
+        delta = margins[base_name] - margins.get(variant_name, 0.0)
+        for excel_row in left_out:
+            contributions[excel_row] = delta
+
+    if write_back:
+        write_contributions_to_excel(excel_path, headers, rows, contributions)
+
+    return contributions
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Leave-one-out margin attribution")
+    parser.add_argument("excel_file")
+    parser.add_argument("--group-by", choices=list(GROUP_COLUMNS), default="row")
+    args = parser.parse_args()
+
+    try:
+        result = run_attribution(args.excel_file, group_by=args.group_by)
+        for row, value in sorted(result.items()):
+            print(f"   row {row}: {value:,.2f}")
+    except Exception as e:
+        print(f"Failed: {e}")
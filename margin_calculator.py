@@ -5,13 +5,39 @@ This replaces the old run_margin.py with single-file processing.
 
 import time
 import re
+from contextlib import contextmanager
+from functools import partial
+from datetime import datetime, timezone
 from pathlib import Path
 from queue import Queue
 from threading import Event, Lock, Thread
 from typing import Callable, Optional
-from playwright.sync_api import sync_playwright
-import pyperclip
-from openpyxl import load_workbook
+
+from failure_capture import FlightRecorder, record_step
+from margin_events import FAILED, QUEUED, RESULT, EventEmitter
+from recovery import (
+    BROWSER_CRASHED,
+    CANCELLED,
+    ERROR_CLASSES,
+    LOGIN_URL,
+    SESSION_EXPIRED,
+    SESSION_SAVE_INTERVAL,
+    TASK_RETRIES,
+    TRANSIENT_UI,
+    UPLOAD_REJECTED,
+    CircuitBreaker,
+    SessionExpired,
+    UploadRejected,
+    classify,
+    dismiss_dialogs,
+    retry_step,
+    save_storage_state,
+)
+from selector_cache import SELECTOR_CACHE_FILE, SelectorRegistry
+from session_monitor import BROWSER, CONTEXT, PAGE, SessionMonitor
+
+# openpyxl and Playwright are imported where they are used: both are slow to
+# import and the GUI should not pay for them before its window is shown.
 
 # ---------------------------------------------------------------------
 # CONFIG
@@ -20,11 +46,25 @@ SESSION_FILE = "ice_session.json"
 APP_URL = "https://ica.ice.com/ICA/Main"
 EXCEL_FILE = "positions_template.xlsx"  # Your working Excel file
 RESULT_CELL_ID = "#cell-1468"  # The cell ID where margin result appears
+PORTFOLIO_COLUMN = "Portfolio Name"  # Upload column that names each portfolio
+RESULT_PORTFOLIO_HEADER = "Portfolio"  # Results grid column with the portfolio name
+RESULT_MARGIN_HEADER = "Margin"  # Results grid column (substring) with the margin
+RESULT_SOURCE = "grid"  # "grid" reads the results table, "export" uses Export to Excel
+DELTA_UPLOADS = True  # With a result store, upload only portfolios that changed
+MARGIN_RESULTS_DIR = "margin results"  # Next to each book; write_margin_to_excel output
+EXPORT_DOWNLOADS_DIR = "/dev/shm/ica_exports"  # tmpfs for export downloads (if available)
+RUN_BUSY_SELECTOR = ".ice-overlay.progress-dialog"  # ICA's progress overlay during a run
+ALL_PORTFOLIOS_ROW = re.compile(
+    r"Press Space to toggle row selection \(unchecked\) All Portfolios \(\d+\)"
+)
+UPLOAD_ERROR = re.compile(r"\b(error|invalid|rejected|failed)\b", re.I)  # Upload dialog text
 # ---------------------------------------------------------------------
 
 
 def read_excel_file(excel_path):
     """Read the Excel file and return data info."""
+    from openpyxl import load_workbook
+
     wb = load_workbook(excel_path, read_only=True, data_only=True)
     ws = wb.active
 
@@ -42,65 +82,181 @@ def read_excel_file(excel_path):
     return data_rows
 
 
-def write_margin_to_excel(excel_path, margin_result):
-    """Write the calculated margin back to Excel."""
+def _csv_value(text):
+    text = text.strip()
+    if text == "":
+        return None
     try:
-        wb = load_workbook(excel_path)
-        ws = wb.active
+        return int(text)
+    except ValueError:
+        pass
+    try:
+        return float(text)
+    except ValueError:
+        return text
 
-        # Find the "Calculated Margin" column
-        margin_col = None
-        for col in range(1, ws.max_column + 1):
-            if ws.cell(1, col).value and "Margin" in str(ws.cell(1, col).value):
-                margin_col = col
-                break
 
-        if not margin_col:
-            print("⚠️ 'Calculated Margin' column not found. Adding to column G.")
-            margin_col = 7
-            ws.cell(1, margin_col, "Calculated Margin")
+def read_positions(excel_path):
+    """
+    Read the position rows of the active sheet (or of a CSV file such as a
+    EUREX position export).
 
-        # Write margin result to row 2 (first data row)
-        ws.cell(2, margin_col, margin_result)
+    Returns: (headers, rows) where rows is a list of (excel_row, values).
+    """
+    if Path(excel_path).suffix.lower() == ".csv":
+        import csv
 
-        wb.save(excel_path)
-        wb.close()
+        with open(excel_path, newline="", encoding="utf-8-sig") as f:
+            reader = csv.reader(f)
+            headers = [h.strip() for h in next(reader, [])]
+            rows = []
+            for excel_row, values in enumerate(reader, start=2):
+                values = tuple(_csv_value(v) for v in values[: len(headers)])
+                if any(v is not None for v in values):
+                    rows.append((excel_row, values + (None,) * (len(headers) - len(values))))
+        return headers, rows
 
-        print(f"✅ Margin result written to Excel: {margin_result}")
-        return True
+    from openpyxl import load_workbook
 
-    except Exception as e:
-        print(f"❌ Error writing to Excel: {e}")
-        return False
+    wb = load_workbook(excel_path, read_only=True, data_only=True)
+    ws = wb.active
+
+    rows_iter = ws.iter_rows(values_only=True)
+    headers = [str(h).strip() if h is not None else "" for h in next(rows_iter, ())]
+    rows = []
+    for excel_row, values in enumerate(rows_iter, start=2):
+        if any(v is not None and str(v).strip() != "" for v in values):
+            rows.append((excel_row, tuple(values[: len(headers)])))
+
+    wb.close()
+    return headers, rows
+
+
+def write_positions_file(output_path, headers, rows):
+    """Write ``rows`` (as returned by ``read_positions``) to a new upload workbook."""
+    from openpyxl import Workbook
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Positions")
+    ws.append(list(headers))
+    for _, values in rows:
+        ws.append(list(values))
+    wb.save(output_path)
+    return Path(output_path)
+
+
+def parse_margin_value(text):
+    """Convert a margin string such as '1,234.56 USD' or '(12.5)' to a float."""
+    if isinstance(text, (int, float)):
+        return float(text)
+    if not text:
+        return None
+    cleaned = str(text).strip()
+    negative = cleaned.startswith("(")
+    match = re.search(r"-?[\d,]*\.?\d+", cleaned)
+    if not match:
+        return None
+    value = float(match.group(0).replace(",", ""))
+    return -abs(value) if negative else value
+
+
+def margin_results_path(excel_path):
+    """The workbook ``write_margin_to_excel`` writes a book's total to."""
+    excel_path = Path(excel_path)
+    return excel_path.parent / MARGIN_RESULTS_DIR / f"{excel_path.stem} - Calculated Margin.xlsx"
+
+
+def write_margin_to_excel(excel_path, margin_result):
+    """
+    Write the calculated margin to the book's results workbook
+    (``margin_results_path``), next to the book.
+
+    The book itself is never re-saved: openpyxl drops the cached value of
+    every formula cell when it saves, so computed columns (e.g. an expiry
+    of ``=F35+300``) would read back empty and change the book's delta
+    hashes. Returns the results path, or None if it could not be written
+    (e.g. the results workbook is open in Excel).
+    """
+    from openpyxl import Workbook
+
+    path = margin_results_path(excel_path)
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        wb = Workbook()
+        ws = wb.active
+        ws.title = "Margin"
+        ws.append(["Book", "Calculated Margin", "Calculated At"])
+        ws.append(
+            [Path(excel_path).name, margin_result, datetime.now().strftime("%Y-%m-%d %H:%M:%S")]
+        )
+        wb.save(path)
+    except OSError as e:
+        print(f"❌ Error writing margin result to {path}: {e}")
+        return None
+
+    print(f"✅ Margin result written to {path}: {margin_result}")
+    return path
 
 
 class _Task:
     """Internal helper representing work for the Playwright worker thread."""
 
-    def __init__(self, fn: Callable, args: tuple, kwargs: dict):
+    def __init__(self, fn: Callable, args: tuple, kwargs: dict, cleanup=None):
         self.fn = fn
         self.args = args
         self.kwargs = kwargs
+        self.cleanup = cleanup
+        self.attempts = 0
         self._event = Event()
         self.result = None
         self.exception: Optional[Exception] = None
 
+    def _finish(self):
+        if self.cleanup is not None:
+            try:
+                self.cleanup()
+            except Exception as e:  # noqa: BLE001 - cleanup must not hide the result
+                print(f"⚠️ Task cleanup failed: {e}")
+        self._event.set()
+
     def set_result(self, value):
         self.result = value
-        self._event.set()
+        self._finish()
 
     def set_exception(self, error: Exception):
         self.exception = error
-        self._event.set()
+        self._finish()
 
-    def wait(self):
-        self._event.wait()
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        return self._event.wait(timeout)
 
 
 class BrowserSession:
-    """Manage a long-lived Playwright browser/page on a dedicated worker thread."""
+    """
+    Manage a long-lived Playwright browser/page on a dedicated worker thread.
 
-    def __init__(self):
+    Use one session per ICA login. Every session on the saved login shares
+    one ICA account, and a calculation starts by clearing that account's
+    portfolios, so a second session would delete the first one's uploads and
+    read its results. To overlap books, pipeline them on one session
+    (pipeline.py) instead.
+    """
+
+    def __init__(
+        self,
+        headless: bool = False,
+        slow_mo: int = 150,
+        monitor: Optional[SessionMonitor] = None,
+        breaker: Optional[CircuitBreaker] = None,
+        capture: Optional[FlightRecorder] = None,
+    ):
+        self.headless = headless
+        self.slow_mo = slow_mo
+        self.monitor = monitor or SessionMonitor()
+        self.breaker = breaker or CircuitBreaker()
+        self.capture = capture or FlightRecorder()
+        self.errors = {kind: 0 for kind in ERROR_CLASSES}
+        self._login_saved_at = time.monotonic()
         self._task_queue: "Queue[object]" = Queue()
         self._thread: Optional[Thread] = None
         self._thread_lock = Lock()
@@ -115,19 +271,69 @@ class BrowserSession:
                 )
                 self._thread.start()
 
-    def run(self, fn: Callable, *args, **kwargs):
-        """Execute ``fn`` with a ready Playwright page on the worker thread."""
+    def run(
+        self,
+        fn: Callable,
+        *args,
+        timeout: Optional[float] = None,
+        cleanup: Optional[Callable] = None,
+        **kwargs,
+    ):
+        """
+        Execute ``fn`` with a ready Playwright page on the worker thread.
+
+        If ``timeout`` seconds pass first, TimeoutError is raised and the page
+        is reloaded before the next task; the abandoned task still finishes
+        on the worker thread. While the circuit breaker is open CircuitOpen
+        is raised at once. ``cleanup()`` runs once the task is over for good
+        (after any retry, even if the caller stopped waiting), so it is the
+        place to delete files the task reads.
+        """
 
+        try:
+            self.breaker.check()
+        except Exception:
+            if cleanup is not None:
+                cleanup()
+            raise
         self._ensure_worker()
-        task = _Task(fn, args, kwargs)
+        task = _Task(fn, args, kwargs, cleanup)
         self._task_queue.put(task)
-        task.wait()
+        if not task.wait(timeout):
+            self.mark_needs_reload()
+            raise TimeoutError(f"Browser task did not finish within {timeout}s")
 
         if task.exception is not None:
             raise task.exception
 
         return task.result
 
+    def warm_up(self, block: bool = False):
+        """
+        Launch the browser and open ICA ahead of the first calculation.
+
+        With ``block=False`` the warm-up is queued on the worker thread and
+        this returns immediately; errors are reported on the next task.
+        """
+
+        if block:
+            self.run(_noop)
+            return
+        self._ensure_worker()
+        self._task_queue.put(_Task(_noop, (), {}))
+
+    def stats(self) -> dict:
+        """Health numbers for monitoring (tasks, memory, latency, recycles)."""
+
+        stats = self.monitor.stats()
+        stats["selectors"] = get_selector_registry().stats()
+        stats["errors"] = dict(self.errors)
+        stats["breaker"] = self.breaker.stats()
+        stats["capture"] = self.capture.stats()
+        stats["alive"] = self._thread is not None and self._thread.is_alive()
+        stats["queued"] = self._task_queue.qsize()
+        return stats
+
     def mark_needs_reload(self):
         """Indicate that the page should reload before the next task."""
 
@@ -142,32 +348,94 @@ class BrowserSession:
                 self._thread.join()
             self._thread = None
 
+    @staticmethod
+    def _recycle(level, page, context, browser):
+        """Close the page, context or browser; return what is left to reuse."""
+
+        try:
+            if page and not page.is_closed():
+                page.close()
+            if level in (CONTEXT, BROWSER) and context:
+                context.close()
+            if level == BROWSER and browser and browser.is_connected():
+                browser.close()
+        except Exception as exc:  # noqa: BLE001 - replaced on the next task anyway
+            print(f"⚠️ Error while recycling {level}: {exc}")
+        if level == PAGE:
+            return None, context, browser
+        if level == CONTEXT:
+            return None, None, browser
+        return None, None, None
+
+    def _recover(self, kind, page, context, browser):
+        """
+        Bring the session back after a failed task of error class ``kind``.
+
+        Returns: (page, context, browser, keep_page) where ``keep_page`` says
+        whether the loaded ICA page can be reused without a reload.
+        """
+
+        if kind == UPLOAD_REJECTED:
+            return page, context, browser, True  # The page itself is fine
+        if kind == SESSION_EXPIRED:
+            print("🔑 ICA session expired: reopening with the saved login")
+            page, context, browser = self._recycle(CONTEXT, page, context, browser)
+            return page, context, browser, False
+        if kind == BROWSER_CRASHED:
+            print("💥 Browser crashed: relaunching")
+            page, context, browser = self._recycle(BROWSER, page, context, browser)
+            return page, context, browser, False
+        if kind == TRANSIENT_UI:
+            dismiss_dialogs(page)  # Step retries ran out: reload before the next task
+        return page, context, browser, False
+
+    def _save_login(self, context):
+        """Persist refreshed login cookies so new contexts start signed in."""
+
+        if not SESSION_SAVE_INTERVAL:
+            return
+        if time.monotonic() - self._login_saved_at < SESSION_SAVE_INTERVAL:
+            return
+        self._login_saved_at = time.monotonic()
+        try:
+            save_storage_state(context, SESSION_FILE)
+        except Exception as exc:  # noqa: BLE001 - the old file still works
+            print(f"⚠️ Could not save refreshed login state: {exc}")
+
     def _worker_loop(self):
         playwright = None
         browser = None
         context = None
         page = None
         initialized = False
+        retry = None
 
         try:
             while True:
-                task = self._task_queue.get()
+                task = retry or self._task_queue.get()
+                retry = None
 
                 if task is self._stop_sentinel:
                     self._task_queue.task_done()
                     break
 
+                start = time.perf_counter()
+                self.capture.begin(task)
                 try:
                     if self._reload_event.is_set():
                         initialized = False
                         self._reload_event.clear()
 
                     if playwright is None:
+                        from playwright.sync_api import sync_playwright
+
                         playwright = sync_playwright().start()
 
                     if browser is None or not browser.is_connected():
                         browser = playwright.chromium.launch(
-                            headless=False, slow_mo=150
+                            headless=self.headless,
+                            slow_mo=self.slow_mo,
+                            downloads_path=_downloads_dir(),
                         )
                         context = None
                         page = None
@@ -180,24 +448,73 @@ class BrowserSession:
 
                     if page is None or page.is_closed():
                         page = context.new_page()
+                        self.capture.attach(page)
                         initialized = False
 
                     if not initialized:
                         print("\n🌐 Opening ICE ICA application...")
+                        opened = time.perf_counter()
                         page.goto(APP_URL, timeout=60000)
                         page.wait_for_load_state("networkidle")
+                        record_step("open", time.perf_counter() - opened)
+                        if LOGIN_URL.search(page.url):
+                            raise SessionExpired(
+                                f"ICA redirected to {page.url}; run 'login_once.py' again"
+                            )
                         initialized = True
 
                     result = task.fn(page, *task.args, **task.kwargs)
                     task.set_result(result)
+                    self.capture.finish()  # Writes a bundle only past the SLO
+                    self.breaker.success()
+                    self._save_login(context)
 
                 except Exception as exc:  # noqa: BLE001 - propagate original error
-                    initialized = False
-                    self._reload_event.set()
-                    task.set_exception(exc)
+                    kind = classify(exc, page)
+                    if kind == CANCELLED:
+                        # Stopped between steps by the caller: the session is fine
+                        self.capture.discard()
+                        task.set_exception(exc)
+                        continue
+                    self.capture.finish(error=exc, kind=kind)  # Before recovery closes the page
+                    self.errors[kind] += 1
+                    if kind != UPLOAD_REJECTED:  # bad input, not a sick session
+                        self.breaker.failure(kind)
+                    page, context, browser, initialized = self._recover(
+                        kind, page, context, browser
+                    )
+                    if (
+                        kind in (SESSION_EXPIRED, BROWSER_CRASHED)
+                        and task.attempts < TASK_RETRIES
+                        and not self.breaker.is_open()
+                    ):
+                        task.attempts += 1
+                        retry = task
+                        print(f"🔁 Retrying the job after {kind}...")
+                    else:
+                        task.set_exception(exc)
 
                 finally:
-                    self._task_queue.task_done()
+                    if retry is None:
+                        self._task_queue.task_done()
+
+                if retry is not None:
+                    continue
+
+                # Between jobs: sample health and recycle before the next task
+                self.monitor.record_task(
+                    time.perf_counter() - start,
+                    task.kwargs.get("timings"),
+                    len(task.result) if isinstance(task.result, dict) else None,
+                )
+                self.monitor.sample(page)
+                decision = self.monitor.recycle_level()
+                if decision:
+                    level, reason = decision
+                    print(f"♻️  Recycling browser {level}: {reason}")
+                    page, context, browser = self._recycle(level, page, context, browser)
+                    initialized = False
+                    self.monitor.recycled(level, reason)
 
         finally:
             try:
@@ -213,143 +530,591 @@ class BrowserSession:
                 self._reload_event.clear()
 
 
-browser_session = BrowserSession()
+def _downloads_dir():
+    """Keep export downloads on tmpfs when the machine has one."""
+
+    tmpfs = Path(EXPORT_DOWNLOADS_DIR)
+    if tmpfs.parent.is_dir():
+        tmpfs.mkdir(exist_ok=True)
+        return str(tmpfs)
+    return None
+
+
+def _noop(page):
+    """Task that only makes sure the page is open and ready."""
+    return None
+
+
+_default_session: Optional[BrowserSession] = None
+_default_session_lock = Lock()
+
+
+def get_browser_session() -> BrowserSession:
+    """Return the shared BrowserSession, creating it on first use."""
+
+    global _default_session
+    with _default_session_lock:
+        if _default_session is None:
+            _default_session = BrowserSession()
+        return _default_session
+
+
+def __getattr__(name):
+    # Keep ``margin_calculator.browser_session`` working without creating the
+    # session at import time.
+    if name == "browser_session":
+        return get_browser_session()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# Reads (portfolio, margin text) pairs out of the ag-grid results table. Rows
+# are keyed by row-index because pinned columns live in separate containers.
+_RESULT_GRID_JS = """
+([portfolioHeader, marginHeader]) => {
+    const out = [];
+    for (const grid of document.querySelectorAll('.ag-root-wrapper')) {
+        let portfolioCol = null;
+        let marginCol = null;
+        for (const header of grid.querySelectorAll('.ag-header-cell')) {
+            const text = header.innerText.trim();
+            if (!portfolioCol && text === portfolioHeader) {
+                portfolioCol = header.getAttribute('col-id');
+            }
+            if (!marginCol && text.includes(marginHeader)) {
+                marginCol = header.getAttribute('col-id');
+            }
+        }
+        if (!portfolioCol || !marginCol) continue;
+        const rows = {};
+        for (const row of grid.querySelectorAll('.ag-row')) {
+            const idx = row.getAttribute('row-index');
+            rows[idx] = rows[idx] || {};
+            for (const cell of row.querySelectorAll('.ag-cell')) {
+                rows[idx][cell.getAttribute('col-id')] = cell.innerText.trim();
+            }
+        }
+        for (const row of Object.values(rows)) {
+            if (row[portfolioCol]) out.push([row[portfolioCol], row[marginCol] || '']);
+        }
+    }
+    return out;
+}
+"""
 
 
-def _perform_margin_calculation(page, excel_path: Path):
-    """Core Playwright automation that must run on the worker thread."""
+def _register_controls(registry: SelectorRegistry):
+    """Semantic definitions of every ICA control the automation touches."""
 
-    # Check and clear existing portfolios
-    checkbox_locator = (
-        page.get_by_role(
-            "gridcell",
-            name="Press Space to toggle row selection (unchecked) All Portfolios (1)",
-        )
+    registry.register(
+        "portfolios_select_all",
+        lambda page: page.get_by_role("gridcell", name=ALL_PORTFOLIOS_ROW)
         .get_by_label("Press Space to toggle row")
-        .first
+        .first,
+        optional=True,
+    )
+    registry.register(
+        "portfolios_actions",
+        lambda page: page.get_by_role("button", name="Actions").first,
+    )
+    registry.register(
+        "portfolios_delete", lambda page: page.get_by_role("button", name="Delete")
+    )
+    registry.register(
+        "portfolios_delete_confirm",
+        lambda page: page.get_by_text("Delete", exact=True),
+    )
+    registry.register(
+        "calculations_select_all",
+        lambda page: page.get_by_role(
+            "columnheader",
+            name="Press Space to toggle all rows selection (unchecked) Calculation ID",
+        )
+        .get_by_label("Press Space to toggle all")
+        .first,
+    )
+    registry.register(
+        "calculations_actions",
+        lambda page: page.get_by_role("button", name="Actions").nth(1),
+    )
+    registry.register(
+        "calculations_delete",
+        lambda page: page.get_by_role("button", name="Delete").nth(1),
+    )
+    registry.register("ok_button", lambda page: page.get_by_role("button", name="OK"))
+    registry.register(
+        "tools_menu", lambda page: page.get_by_role("menuitem", name="Tools")
+    )
+    registry.register(
+        "upload_trades_menu",
+        lambda page: page.get_by_role("menuitem", name="Upload Trades"),
+    )
+    registry.register(
+        "select_file_button",
+        lambda page: page.get_by_role("button", name=re.compile("Select file", re.I)),
+    )
+    registry.register(
+        "upload_button", lambda page: page.get_by_role("button", name="Upload")
+    )
+    registry.register(
+        "export_actions",
+        lambda page: page.get_by_role("button", name="Actions").first,
     )
+    registry.register(
+        "export_to_excel_menu",
+        lambda page: page.get_by_role("button", name="Export to Excel").first,
+    )
+    registry.register(
+        "export_confirm",
+        lambda page: page.get_by_role("button", name="Export", exact=True),
+    )
+    registry.register(
+        "run_analytics_button",
+        lambda page: page.get_by_role("button", name="Run Analytics"),
+    )
+    registry.register(
+        "run_button",
+        lambda page: page.get_by_role("tabpanel")
+        .filter(has_text="Run")
+        .get_by_role("button")
+        .nth(1),
+    )
+
+
+_selector_registry: Optional[SelectorRegistry] = None
+
+
+def get_selector_registry() -> SelectorRegistry:
+    """Return the shared selector registry, loading the cache on first use."""
+
+    global _selector_registry
+    with _default_session_lock:
+        if _selector_registry is None:
+            _selector_registry = SelectorRegistry(SELECTOR_CACHE_FILE)
+            _register_controls(_selector_registry)
+        return _selector_registry
+
+
+def _control(page, name):
+    """Locator for a registered ICA control (cached selector or semantic fallback)."""
+
+    return get_selector_registry().locate(page, name)
+
+
+def _clear_portfolios(page):
+    """Delete every portfolio and calculation currently loaded in ICA."""
+
+    checkbox_locator = _control(page, "portfolios_select_all")
 
     if checkbox_locator.count() > 0:
         print("🗑️  Clearing existing portfolios...")
         checkbox_locator.check()
-        page.get_by_role("button", name="Actions").first.click()
-        page.get_by_role("button", name="Delete").click()
-        page.get_by_text("Delete", exact=True).click()
-        page.get_by_role(
-            "columnheader",
-            name="Press Space to toggle all rows selection (unchecked) Calculation ID",
-        ).get_by_label("Press Space to toggle all").first.check()
-        page.get_by_role("button", name="Actions").nth(1).click()
-        page.get_by_role("button", name="Delete").nth(1).click()
-        page.get_by_role("button", name="OK").click()
+        _control(page, "portfolios_actions").click()
+        _control(page, "portfolios_delete").click()
+        _control(page, "portfolios_delete_confirm").click()
+        _control(page, "calculations_select_all").check()
+        _control(page, "calculations_actions").click()
+        _control(page, "calculations_delete").click()
+        _control(page, "ok_button").click()
         time.sleep(2)
     else:
         print("✓ No existing portfolios to clear")
 
-    # Navigate to Tools → Upload Trades
+
+def _delete_portfolios(page, names):
+    """Delete only the portfolios ``names``; other uploads on the account are kept."""
+
+    if not names:
+        return
+    print(f"🗑️  Deleting {len(names)} finished portfolio(s)...")
+    _select_portfolios(page, names)
+    _control(page, "portfolios_actions").click()
+    _control(page, "portfolios_delete").click()
+    _control(page, "portfolios_delete_confirm").click()
+
+
+def _upload_positions(page, excel_path: Path):
+    """Upload a positions file through Tools → Upload Trades."""
+
     print("\n📤 Uploading positions file...")
-    page.get_by_role("menuitem", name="Tools").click()
-    page.get_by_role("menuitem", name="Upload Trades").click()
+    _control(page, "tools_menu").click()
+    _control(page, "upload_trades_menu").click()
 
     # Upload the Excel file
-    page.get_by_role("button", name=re.compile("Select file", re.I)).set_input_files(
-        str(excel_path)
-    )
-    page.get_by_role("button", name="Upload").click()
+    _control(page, "select_file_button").set_input_files(str(excel_path))
+    _control(page, "upload_button").click()
 
     # Wait for upload confirmation
     page.wait_for_selector("button:has-text('OK')", timeout=60000)
-    page.get_by_role("button", name="OK").click()
+    dialog = page.locator('[role="dialog"]:visible, [role="alertdialog"]:visible')
+    message = dialog.first.inner_text(timeout=2000) if dialog.count() else ""
+    if UPLOAD_ERROR.search(message):
+        dismiss_dialogs(page)
+        raise UploadRejected(
+            f"ICA rejected {Path(excel_path).name}: {' '.join(message.split())}"
+        )
+    _control(page, "ok_button").click()
     time.sleep(3)
     okButtonLocator = page.get_by_role("button", name="OK")
     if okButtonLocator.is_visible():
         okButtonLocator.click()
     print("✅ Upload completed")
 
-    # Select all accounts and run calculation
+
+def _run_analytics(page):
+    """Select all uploaded portfolios and start the analytics run."""
+
     print("\n🧮 Running margin calculation...")
     page.locator(
         "input[aria-label*='Press Space to toggle row selection']"
     ).first.check()
-    page.get_by_role("button", name="Run Analytics").click()
-    page.get_by_role("tabpanel").filter(has_text="Run").get_by_role("button").nth(
-        1
-    ).click()
+    _control(page, "run_analytics_button").click()
+    _control(page, "run_button").click()
+
+
+def _portfolio_checkbox(page, name):
+    """The selection checkbox of portfolio ``name`` in the portfolios grid."""
+
+    return page.get_by_role(
+        "gridcell",
+        name=re.compile(
+            r"Press Space to toggle row selection \((un)?checked\) "
+            + re.escape(name)
+            + r"(\s|$)"
+        ),
+    ).get_by_label("Press Space to toggle row")
+
+
+def _select_portfolios(page, names):
+    """Select exactly the portfolios ``names`` in the portfolios grid."""
+
+    checked = page.locator("input[aria-label*='Press Space to toggle row selection (checked)']")
+    for _ in range(checked.count()):
+        checked.first.uncheck()
+    for name in names:
+        _portfolio_checkbox(page, name).first.check()
+
+
+def _run_analytics_for(page, names):
+    """Start an analytics run for the portfolios ``names`` only (others keep running)."""
 
-    # Wait for calculation to complete (fixed time)
-    print("⏳ Waiting for calculation to complete (5 seconds)...")
-    time.sleep(5)  # Results appear within 5 seconds
+    print(f"\n🧮 Running margin calculation for {len(names)} portfolio(s)...")
+    _select_portfolios(page, names)
+    _control(page, "run_analytics_button").click()
+    _control(page, "run_button").click()
+
+
+def _read_portfolio_margins(page):
+    """Return ``{portfolio name: margin}`` for every row of the results grid."""
+
+    rows = page.evaluate(
+        _RESULT_GRID_JS, [RESULT_PORTFOLIO_HEADER, RESULT_MARGIN_HEADER]
+    )
+    margins = {}
+    for name, text in rows:
+        value = parse_margin_value(text)
+        if value is not None:
+            margins[name] = value
+    return margins
+
+
+def _export_results(page):
+    """Download ICA's Export to Excel for the loaded run and parse it in memory."""
+
+    from ica_export import parse_export
+
+    print("📥 Exporting results...")
+    _control(page, "export_actions").click()
+    _control(page, "export_to_excel_menu").click()
+    with page.expect_download(timeout=120000) as download_info:
+        _control(page, "export_confirm").click()
+    download = download_info.value
+    data = Path(download.path()).read_bytes()
+    download.delete()
+    print(f"   Export received ({len(data) / 1024:.0f} KB)")
+    return parse_export(data)
+
+
+def _wait_for_run_complete(page, timeout: float = 300.0):
+    """
+    Wait for ICA's progress overlay of the analytics run to go away.
+
+    Returns False if no overlay appeared (the run finished very quickly or
+    ICA did not show one), True once it has gone.
+    """
+    from playwright.sync_api import TimeoutError as PWTimeoutError
+
+    overlay = page.locator(RUN_BUSY_SELECTOR).first
+    try:
+        overlay.wait_for(state="visible", timeout=5000)
+    except PWTimeoutError:
+        return False
+    overlay.wait_for(state="hidden", timeout=timeout * 1000)
+    return True
+
+
+def _export_portfolio_margins(page, expected, timeout: float = 300.0):
+    """Export until every portfolio in ``expected`` is in the download (no grid reads)."""
+
+    expected = set(expected)
+    deadline = time.monotonic() + timeout
+    delay = 2.0
+    while True:
+        export = _export_results(page)
+        missing = expected - export["portfolios"].keys()
+        if not missing:
+            return export
+        if time.monotonic() + delay > deadline:
+            raise TimeoutError(
+                f"No margin result for {len(missing)} portfolio(s) in the export: "
+                f"{', '.join(sorted(missing)[:5])}"
+            )
+        print(f"⏳ {len(missing)} portfolio(s) still computing; exporting again in {delay:.0f}s")
+        time.sleep(delay)
+        delay = min(delay * 2, 30.0)
+
+
+def _wait_for_portfolio_margins(page, expected, timeout: float = 300.0):
+    """Poll the results grid until every portfolio in ``expected`` has a margin."""
+
+    expected = set(expected)
+    deadline = time.monotonic() + timeout
+    while True:
+        margins = _read_portfolio_margins(page)
+        missing = expected - margins.keys()
+        if not missing:
+            return {name: margins[name] for name in expected}
+        if time.monotonic() > deadline:
+            raise TimeoutError(
+                f"No margin result for {len(missing)} portfolio(s): "
+                f"{', '.join(sorted(missing)[:5])}"
+            )
+        time.sleep(1)
+
+
+# Phases of one calculation, in order (used for timings and progress)
+PHASES = ("clear", "upload", "run", "results")
+
+
+@contextmanager
+def _phase(timings, name, progress=None):
+    """
+    Record the wall time of a named phase into ``timings`` (if given).
+
+    ``progress(name, None)`` is called when the phase starts and
+    ``progress(name, seconds)`` when it completes. The callback may raise to
+    abort the calculation between phases (e.g. when the user cancels).
+    """
+    if progress is not None:
+        progress(name, None)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        if timings is not None:
+            timings[name] = elapsed
+        record_step(name, elapsed)
+    if progress is not None:
+        progress(name, elapsed)
+
+
+def _perform_margin_calculation(
+    page,
+    excel_path: Path,
+    expected_portfolios=None,
+    timings=None,
+    progress=None,
+    result_source=None,
+    details=None,
+):
+    """
+    Core Playwright automation that must run on the worker thread.
+
+    With ``result_source="export"`` (or RESULT_SOURCE) the results come from
+    one Export to Excel download, and the per-account breakdown is stored in
+    ``details["accounts"]`` when a dict is passed.
+    """
+
+    with _phase(timings, "clear", progress):
+        retry_step(page, "clear", _clear_portfolios, page)
+    with _phase(timings, "upload", progress):
+        # A retried upload first clears whatever the failed attempt left behind
+        retry_step(
+            page, "upload", _upload_positions, page, excel_path, before_retry=_clear_portfolios
+        )
+    with _phase(timings, "run", progress):
+        retry_step(page, "run", _run_analytics, page)
+
+    with _phase(timings, "results", progress):
+        if (result_source or RESULT_SOURCE) == "export":
+            # Completion comes from the progress overlay and the export itself;
+            # the results grid is never read
+            print("⏳ Waiting for calculation to complete...")
+            if not _wait_for_run_complete(page) and not expected_portfolios:
+                time.sleep(5)  # No overlay and nothing to check the export against
+            if expected_portfolios:
+                export = _export_portfolio_margins(page, expected_portfolios)
+                margins = {name: export["portfolios"][name] for name in expected_portfolios}
+            else:
+                export = _export_results(page)
+                margins = export["portfolios"]
+            if details is not None:
+                details["accounts"] = export["accounts"]
+        elif expected_portfolios:
+            print(f"⏳ Waiting for {len(expected_portfolios)} portfolio result(s)...")
+            margins = _wait_for_portfolio_margins(page, expected_portfolios)
+        else:
+            # Wait for calculation to complete (fixed time)
+            print("⏳ Waiting for calculation to complete (5 seconds)...")
+            time.sleep(5)  # Results appear within 5 seconds
+            margins = _read_portfolio_margins(page)
     print("✅ Calculation completed")
 
-    # Get the margin result directly from the cell
-    print("\n📋 Extracting margin result...")
-
-    # Method 1: Try to get text directly from the cell
-    # try:
-    #     result_cell = page.locator(RESULT_CELL_ID)
-    #     result_cell.wait_for(timeout=30000, state="visible")  # 30 second timeout
-    #     copied_text = result_cell.inner_text().strip()
-    #     print(f"✅ Margin extracted: {copied_text}")
-    # except Exception as e:
-    #     print(f"⚠️ Direct extraction failed: {e}")
-    #     # Method 2: Fallback to clipboard method
-    #     print("Trying clipboard method...")
-    #     page.locator(RESULT_CELL_ID).click(button="right", timeout=60000)
-    #     time.sleep(0.5)
-    #     page.get_by_text("Copy").first.click(timeout=5000)
-    #     time.sleep(1)
-    #     copied_text = pyperclip.paste().strip()
-    #     print(f"✅ Margin copied via clipboard: {copied_text}")
-
-    # # Result will be shown in the modal
-    # print(f"\n{'='*60}")
-    # print(f"✅ SUCCESS! Margin: {copied_text}")
-    # print(f"{'='*60}\n")
-
-    return
-
-
-def run_margin_calc(excel_path, session: Optional[BrowserSession] = None):
+    for name, value in margins.items():
+        print(f"   {name}: {value:,.2f}")
+
+    return margins
+
+
+def run_margin_calc(
+    excel_path,
+    session: Optional[BrowserSession] = None,
+    store=None,
+    timeout: Optional[float] = None,
+    timings: Optional[dict] = None,
+    progress: Optional[Callable] = None,
+    result_source: Optional[str] = None,
+    on_event: Optional[Callable] = None,
+    delta: Optional[bool] = None,
+    delta_plan=None,
+):
     """
     Main function to run ICE margin calculator.
     1. Uploads the Excel file to ICE
     2. Runs the calculation
     3. Copies the result
-    4. Writes result back to Excel
+
+    If ``store`` (a result_store.ResultStore) is given, the run, its
+    per-portfolio margins and phase timings are recorded there. Phase
+    timings are also written into ``timings`` when a dict is passed, and
+    ``progress(phase, seconds)`` is called as each phase starts (seconds is
+    None) and finishes. ``result_source`` ("grid" or "export") overrides
+    RESULT_SOURCE; exports also record the per-account breakdown.
+    ``on_event(event)`` receives a margin_events.MarginEvent for every step
+    (queued, session-ready, cleared, uploaded, run-started, result/failed);
+    it may raise to abort the calculation before the next step.
+
+    With a ``store`` and ``delta`` (default DELTA_UPLOADS), only portfolios
+    whose positions changed since their last calculation are uploaded and
+    run; the others reuse their stored margin (see position_delta.py).
+    ``delta_plan`` is a DeltaPlan already made for this book (e.g. by
+    live_link.py from unsaved edits); its portfolios are what gets uploaded.
+
+    Returns: dict of {portfolio name: margin} read from the results.
     """
     excel_path = Path(excel_path).resolve()
+    events = EventEmitter(excel_path, on_event)
 
-    if not excel_path.exists():
-        raise FileNotFoundError(f"Excel file not found: {excel_path}")
-
-    # Verify session file exists
-    if not Path(SESSION_FILE).exists():
-        raise FileNotFoundError(
-            f"Session file '{SESSION_FILE}' not found. Please run 'login_once.py' first."
-        )
+    try:
+        if not excel_path.exists():
+            raise FileNotFoundError(f"Excel file not found: {excel_path}")
+
+        # Verify session file exists
+        if not Path(SESSION_FILE).exists():
+            raise FileNotFoundError(
+                f"Session file '{SESSION_FILE}' not found. Please run 'login_once.py' first."
+            )
+    except FileNotFoundError as e:
+        events.emit(FAILED, error=str(e))
+        raise
 
     print(f"\n{'='*60}")
     print(f"Starting Margin Calculation")
     print(f"{'='*60}")
 
-    # Read Excel to show info
-    read_excel_file(excel_path)
+    # Read Excel to show info (a supplied plan already knows the book)
+    if delta_plan is None:
+        read_excel_file(excel_path)
+
+    session = session or get_browser_session()
+    timings = {} if timings is None else timings
+    started_at = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+    details = {}
 
-    session = session or browser_session
+    def on_phase(name, seconds):
+        events.phase(name, seconds)
+        if progress is not None:
+            progress(name, seconds)
 
+    plan = delta_plan
+    upload_path = excel_path
+    handed_off = False  # The session task deletes a temporary upload when it is done
     try:
-        session.run(_perform_margin_calculation, excel_path)
-        return
+        if plan is None and store is not None and (DELTA_UPLOADS if delta is None else delta):
+            from position_delta import plan_delta
+
+            plan = plan_delta(excel_path, store)
+        if plan is not None and plan.reused:
+            print(
+                f"♻️  {len(plan.reused)} unchanged portfolio(s) reuse stored results, "
+                f"{len(plan.changed)} changed"
+            )
+        if plan is not None and plan.changed and (plan.reused or delta_plan is not None):
+            upload_path = plan.write_upload()
+
+        events.emit(QUEUED)
+        if plan is not None and not plan.changed:
+            margins = {}
+        else:
+            handed_off = upload_path != excel_path
+            margins = session.run(
+                _perform_margin_calculation,
+                upload_path,
+                expected_portfolios=plan.changed if plan is not None else None,
+                timings=timings,
+                progress=on_phase,
+                result_source=result_source,
+                details=details,
+                timeout=timeout,
+                cleanup=partial(upload_path.unlink, missing_ok=True) if handed_off else None,
+            )
     except Exception as e:
         print(f"\n❌ Error during calculation: {e}")
-        session.mark_needs_reload()
+        if store is not None:
+            store.record_run(
+                excel_path, {}, timings=timings, error=str(e), started_at=started_at
+            )
+        events.emit(FAILED, timings=dict(timings), error=str(e))
         raise
+    finally:
+        if upload_path != excel_path and not handed_off:
+            upload_path.unlink(missing_ok=True)
+
+    if plan is not None:
+        calculated = margins
+        margins = {
+            name: calculated[name] if name in calculated else plan.reused[name]
+            for name in plan.hashes
+            if name in calculated or name in plan.reused
+        }
+    if store is not None:
+        run_id = store.record_run(
+            excel_path,
+            margins,
+            timings=timings,
+            accounts=details.get("accounts"),
+            started_at=started_at,
+        )
+        if plan is not None:
+            store.save_portfolio_states(plan.states(calculated), run_id)
+    events.emit(RESULT, margins=margins, timings=dict(timings))
+    return margins
 
 
 if __name__ == "__main__":
     # Test run
     try:
-        run_margin_calc(EXCEL_FILE)
-        # print(f"Final result: {result}")
+        result = run_margin_calc(EXCEL_FILE)
+        print(f"Final result: {result}")
     except Exception as e:
         print(f"Failed: {e}")
@@ -0,0 +1,324 @@
+"""
+Headless, scriptable command line entry point for the margin calculator.
+
+Takes files, glob patterns or a list of paths on stdin, runs them on one or
+more browser sessions and streams one JSON line per result to stdout as each
+finishes. Progress messages go to stderr so stdout can be piped. With
+``--engine auto`` ICE and EUREX books are told apart by their headers and
+each venue gets its own workers, so both venues run at the same time. ICA
+always runs on a single session (see margin_calculator.BrowserSession).
+``--pipeline N`` keeps N books computing on the ICA session at once.
+
+    python margin_cli.py books/*.xlsx --timeout 300 > results.jsonl
+    python margin_cli.py books/*.csv --engine eurex --workers 3
+    find /data/books -name '*.xlsx' | python margin_cli.py - --db margin_results.db
+    python margin_cli.py books/*.xlsx books/*.csv --engine auto
+    python margin_cli.py books/*.xlsx --pipeline 3
+"""
+
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+from contextlib import redirect_stdout
+from pathlib import Path
+from queue import Empty, Queue
+from threading import Lock, Thread
+
+import margin_calculator
+from backends import BACKENDS, VENUE_ENGINES, create_backend, detect_venue
+from pipeline import run_pipelined
+
+ENGINES = tuple(BACKENDS) + ("auto",)
+
+
+def expand_inputs(inputs, stdin=None):
+    """Expand file names, glob patterns and '-' (read paths from stdin) into paths."""
+    stdin = stdin or sys.stdin
+    paths = []
+    seen = set()
+
+    def add(path):
+        path = Path(path).expanduser().resolve()
+        if path not in seen:
+            seen.add(path)
+            paths.append(path)
+
+    for item in inputs:
+        if item == "-":
+            for line in stdin:
+                line = line.strip()
+                if line:
+                    add(line)
+        elif glob.has_magic(item):
+            matches = sorted(glob.glob(os.path.expanduser(item), recursive=True))
+            if not matches:
+                print(f"⚠️ No files match '{item}'", file=sys.stderr)
+            for match in matches:
+                add(match)
+        else:
+            add(item)
+    return paths
+
+
+def _result_line(path, margins=None, error=None, timings=None, elapsed=None, engine=None):
+    record = {
+        "file": str(path),
+        "engine": engine,
+        "status": "error" if error is not None else "ok",
+        "margins": margins or {},
+        "total": sum(margins.values()) if margins else None,
+        "timings": timings or {},
+        "elapsed": round(elapsed, 3) if elapsed is not None else None,
+    }
+    if error is not None:
+        record["error"] = error
+    return json.dumps(record)
+
+
+def run_files(
+    paths,
+    workers=1,
+    headless=True,
+    timeout=None,
+    store=None,
+    out=None,
+    result_source=None,
+    engine="ica",
+    pipeline=1,
+):
+    """
+    Run ``paths`` across ``workers`` sessions per engine, writing one JSON
+    line to ``out`` per finished file. ``engine="auto"`` picks the engine of
+    each file from its venue; every engine then gets its own ``workers``.
+    ICA gets one session whatever ``workers`` is (one per login).
+    With ``pipeline`` > 1 the ICA session keeps that many books in flight.
+
+    Returns: number of failed files
+    """
+    out = out or sys.stdout
+    out_lock = Lock()
+    failures = []
+
+    groups = {}
+    for path in paths:
+        if engine == "auto":
+            try:
+                file_engine = VENUE_ENGINES[detect_venue(path)]
+            except Exception as e:  # noqa: BLE001 - reported as a JSON line
+                failures.append(path)
+                out.write(_result_line(path, error=str(e)) + "\n")
+                out.flush()
+                continue
+        else:
+            file_engine = engine
+        groups.setdefault(file_engine, []).append(path)
+
+    def worker(name, jobs):
+        backend = create_backend(name, headless=headless, result_source=result_source)
+        try:
+            while True:
+                try:
+                    path = jobs.get_nowait()
+                except Empty:
+                    return
+                start = time.perf_counter()
+                timings = {}
+                try:
+                    margins = backend.calculate(
+                        path, store=store, timeout=timeout, timings=timings
+                    )
+                    line = _result_line(
+                        path,
+                        margins,
+                        timings=timings,
+                        elapsed=time.perf_counter() - start,
+                        engine=name,
+                    )
+                except Exception as e:  # noqa: BLE001 - reported as a JSON line
+                    failures.append(path)
+                    line = _result_line(
+                        path,
+                        error=str(e),
+                        timings=timings,
+                        elapsed=time.perf_counter() - start,
+                        engine=name,
+                    )
+                with out_lock:
+                    out.write(line + "\n")
+                    out.flush()
+        finally:
+            backend.close()
+
+    def pipeline_worker(name, files):
+        backend = create_backend(name, headless=headless, result_source=result_source)
+        start = time.perf_counter()
+
+        def on_result(path, margins, error, timings):
+            if error is not None:
+                failures.append(path)
+            line = _result_line(
+                path,
+                margins,
+                error=error,
+                timings=timings,
+                elapsed=time.perf_counter() - start,
+                engine=name,
+            )
+            with out_lock:
+                out.write(line + "\n")
+                out.flush()
+
+        try:
+            kwargs = {"result_timeout": timeout} if timeout else {}
+            run_pipelined(
+                files,
+                session=backend.session,
+                depth=pipeline,
+                store=store,
+                on_result=on_result,
+                **kwargs,
+            )
+        finally:
+            backend.close()
+
+    threads = []
+    for name, files in groups.items():
+        if name == "ica" and pipeline > 1:
+            threads.append(
+                Thread(
+                    target=pipeline_worker,
+                    args=(name, files),
+                    name=f"MarginCliPipeline-{name}",
+                    daemon=True,
+                )
+            )
+            continue
+        # ICA: one session per login (see BrowserSession)
+        count = 1 if name == "ica" else workers
+        jobs: "Queue[Path]" = Queue()
+        for path in files:
+            jobs.put(path)
+        threads.extend(
+            Thread(
+                target=worker,
+                args=(name, jobs),
+                name=f"MarginCliWorker-{name}-{i}",
+                daemon=True,
+            )
+            for i in range(max(1, min(count, len(files))))
+        )
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return len(failures)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Run ICE/EUREX margin calculations headlessly and stream JSON results."
+    )
+    parser.add_argument(
+        "inputs", nargs="*", help="Excel files or glob patterns; '-' reads paths from stdin"
+    )
+    parser.add_argument(
+        "--headless",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="Run Chromium without a window (default: on)",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=1,
+        help="Parallel sessions per engine; ICA always uses one (same login)",
+    )
+    parser.add_argument(
+        "-t", "--timeout", type=float, default=None, help="Seconds allowed per file"
+    )
+    parser.add_argument(
+        "--engine",
+        choices=ENGINES,
+        default="ica",
+        help="Calculator backend; 'auto' picks ICA or EUREX per file (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--pipeline",
+        type=int,
+        default=1,
+        metavar="N",
+        help="Books in flight per ICA session; needs a Portfolio Name column (default: off)",
+    )
+    parser.add_argument(
+        "--result-source",
+        choices=("grid", "export"),
+        help="Read results from the grid or one Export to Excel download "
+        "(default: margin_calculator.RESULT_SOURCE)",
+    )
+    parser.add_argument("--db", help="Also record results in this result_store DB")
+    parser.add_argument(
+        "--session-file",
+        default=margin_calculator.SESSION_FILE,
+        help="Saved ICE login from login_once.py (default: %(default)s)",
+    )
+    parser.add_argument(
+        "-q", "--quiet", action="store_true", help="Suppress progress output on stderr"
+    )
+    args = parser.parse_args(argv)
+
+    inputs = args.inputs or (["-"] if not sys.stdin.isatty() else [])
+    paths = expand_inputs(inputs)
+    if not paths:
+        parser.error("no input files")
+    if args.engine == "ica" and args.workers > 1:
+        parser.error(
+            "--workers > 1 is not supported for ICA, which runs one session per "
+            "login (use --pipeline N instead)"
+        )
+    result_source = args.result_source or margin_calculator.RESULT_SOURCE
+    if args.pipeline > 1 and args.engine != "eurex" and result_source == "export":
+        parser.error(
+            "--result-source export is not supported with --pipeline: pipelined "
+            "books are read from the results grid as each one finishes"
+        )
+
+    margin_calculator.SESSION_FILE = args.session_file
+
+    store = None
+    if args.db:
+        from result_store import ResultStore
+
+        store = ResultStore(args.db)
+
+    out = sys.stdout
+    log = open(os.devnull, "w") if args.quiet else sys.stderr
+    try:
+        # Library progress is printed; keep stdout for the JSON stream only
+        with redirect_stdout(log):
+            failed = run_files(
+                paths,
+                workers=args.workers,
+                headless=args.headless,
+                timeout=args.timeout,
+                store=store,
+                out=out,
+                result_source=args.result_source,
+                engine=args.engine,
+                pipeline=args.pipeline,
+            )
+    finally:
+        if store is not None:
+            store.close()
+        if args.quiet:
+            log.close()
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
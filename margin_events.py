@@ -0,0 +1,160 @@
+"""
+Progress events for margin calculations.
+
+``run_margin_calc(..., on_event=callback)`` reports each step of a
+calculation as a MarginEvent as it happens:
+
+    queued -> session-ready -> cleared -> uploaded -> run-started -> result
+
+or ``failed`` instead of ``result``. ``stream_margin_calc`` (a generator) and
+``astream_margin_calc`` (an async iterator) run a calculation in the
+background and yield the same events, so callers can show real progress,
+start downstream work as soon as the result lands, or stop waiting: leaving
+the loop early cancels the calculation at the next step.
+
+    for event in stream_margin_calc("positions.xlsx"):
+        print(event.kind, f"{event.elapsed:.1f}s")
+"""
+
+import queue
+import time
+from threading import Event, Thread
+
+from recovery import Cancelled
+
+QUEUED = "queued"
+SESSION_READY = "session-ready"
+CLEARED = "cleared"
+UPLOADED = "uploaded"
+RUN_STARTED = "run-started"
+RESULT = "result"
+FAILED = "failed"
+
+# Events after "queued" that mark progress, in order (for progress bars)
+PROGRESS_EVENTS = (SESSION_READY, CLEARED, UPLOADED, RUN_STARTED, RESULT)
+TERMINAL_EVENTS = (RESULT, FAILED)
+
+# (phase, finished?) callbacks of run_margin_calc -> event kind
+_PHASE_EVENTS = {
+    ("clear", False): SESSION_READY,
+    ("clear", True): CLEARED,
+    ("upload", True): UPLOADED,
+    ("run", True): RUN_STARTED,
+}
+
+
+class CalculationCancelled(Cancelled):
+    """Raised inside a calculation whose event consumer has gone away."""
+
+
+class MarginEvent:
+    """One step of a calculation. ``elapsed`` counts from the run_margin_calc call."""
+
+    __slots__ = ("kind", "path", "at", "elapsed", "seconds", "margins", "timings", "error")
+
+    def __init__(
+        self, kind, path, elapsed=0.0, seconds=None, margins=None, timings=None, error=None
+    ):
+        self.kind = kind
+        self.path = path
+        self.at = time.time()
+        self.elapsed = elapsed
+        self.seconds = seconds  # Duration of the step that just finished
+        self.margins = margins
+        self.timings = timings
+        self.error = error
+
+    @property
+    def terminal(self):
+        return self.kind in TERMINAL_EVENTS
+
+    def to_dict(self):
+        data = {name: getattr(self, name) for name in self.__slots__}
+        data["path"] = str(self.path)
+        return data
+
+    def __repr__(self):
+        return f"MarginEvent({self.kind!r}, {self.path!r}, elapsed={self.elapsed:.2f})"
+
+
+class EventEmitter:
+    """Build MarginEvents for one calculation and hand them to ``callback``."""
+
+    def __init__(self, path, callback=None):
+        self.path = path
+        self.callback = callback
+        self.start = time.perf_counter()
+
+    def emit(self, kind, **fields):
+        if self.callback is not None:
+            elapsed = time.perf_counter() - self.start
+            self.callback(MarginEvent(kind, self.path, elapsed=elapsed, **fields))
+
+    def phase(self, name, seconds):
+        """Adapter for the ``progress(phase, seconds)`` callback of a calculation."""
+        kind = _PHASE_EVENTS.get((name, seconds is not None))
+        if kind is not None:
+            self.emit(kind, seconds=seconds)
+
+
+def _start(excel_path, kwargs, deliver):
+    """Run run_margin_calc on a thread, passing every event to ``deliver``."""
+    from margin_calculator import run_margin_calc
+
+    cancel = Event()
+    finished = Event()
+
+    def on_event(event):
+        if event.terminal:
+            finished.set()
+        if cancel.is_set():
+            if event.terminal:
+                return  # Nobody is listening any more
+            raise CalculationCancelled(f"Cancelled before '{event.kind}'")
+        deliver(event)
+
+    def run():
+        try:
+            run_margin_calc(excel_path, on_event=on_event, **kwargs)
+        except Exception as e:  # noqa: BLE001 - reported as the failed event
+            if not finished.is_set() and not cancel.is_set():
+                deliver(MarginEvent(FAILED, excel_path, error=str(e)))
+
+    Thread(target=run, name="MarginEventStream", daemon=True).start()
+    return cancel
+
+
+def stream_margin_calc(excel_path, **kwargs):
+    """
+    Run ``run_margin_calc(excel_path, **kwargs)`` in the background and
+    yield its MarginEvents. The last event is ``result`` or ``failed``.
+    """
+    events = queue.Queue()
+    cancel = _start(excel_path, kwargs, events.put)
+    try:
+        while True:
+            event = events.get()
+            yield event
+            if event.terminal:
+                return
+    finally:
+        cancel.set()
+
+
+async def astream_margin_calc(excel_path, **kwargs):
+    """Async iterator version of ``stream_margin_calc``."""
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
+    cancel = _start(
+        excel_path, kwargs, lambda event: loop.call_soon_threadsafe(events.put_nowait, event)
+    )
+    try:
+        while True:
+            event = await events.get()
+            yield event
+            if event.terminal:
+                return
+    finally:
+        cancel.set()
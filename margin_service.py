@@ -0,0 +1,416 @@
+"""
+Long-running local margin service with an HTTP/JSON API.
+
+One resident process owns the browser session(s), so the GUI, scripts and
+Excel users share a warm backend instead of each launching Chromium.
+Requests that arrive within BATCH_WINDOW seconds of each other are merged
+into one multi-portfolio ICA upload and run, and the results are split back
+per caller. There is a single session (one per ICA login, see
+margin_calculator.BrowserSession).
+
+API:
+    POST /jobs                 body = .xlsx bytes (X-File-Name header optional)
+                               or JSON {"path": "C:/books/positions.xlsx"}
+                               -> 202 {"id": ..., "status": "queued"}
+    GET  /jobs/<id>            -> job status and result
+    GET  /jobs/<id>/stream     -> JSON lines, one per status change, until done
+                                  (blank keepalive lines in between)
+    GET  /health
+    GET  /metrics              -> per-session memory, latency and recycle stats
+
+    python margin_service.py --port 8780
+"""
+
+import argparse
+import itertools
+import json
+import tempfile
+import time
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from queue import Empty, Queue
+from threading import Condition, Lock, Thread
+
+from margin_calculator import (
+    PORTFOLIO_COLUMN,
+    BrowserSession,
+    _perform_margin_calculation,
+    read_positions,
+    write_positions_file,
+)
+
+# ---------------------------------------------------------------------
+# CONFIG
+# ---------------------------------------------------------------------
+DEFAULT_PORT = 8780
+BATCH_WINDOW = 1.5  # Seconds to wait for more requests before a run starts
+MAX_BATCH_ROWS = 20000  # Position rows merged into one upload
+MAX_BATCH_JOBS = 25  # Jobs merged into one upload
+JOB_TTL = 3600  # Seconds a finished job stays queryable
+# ---------------------------------------------------------------------
+
+FINISHED = ("done", "error")
+
+
+class ServiceJob:
+    """A submitted position book and its result."""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, name, path: Path, owns_file=False):
+        self.seq = next(self._ids)
+        self.id = f"{self.seq:06d}"
+        self.name = name
+        self.path = path
+        self.owns_file = owns_file
+        self.status = "queued"
+        self.result = None
+        self.error = None
+        self.timings = {}
+        self.batch_size = None
+        self.submitted_at = time.time()
+        self.finished_at = None
+        self.version = 0
+        self.changed = Condition()
+        self.headers = None
+        self.rows = None
+
+    def update(self, **fields):
+        with self.changed:
+            for key, value in fields.items():
+                setattr(self, key, value)
+            if self.status in FINISHED and self.finished_at is None:
+                self.finished_at = time.time()
+            self.version += 1
+            self.changed.notify_all()
+
+    def to_dict(self):
+        info = {
+            "id": self.id,
+            "name": self.name,
+            "status": self.status,
+            "submitted_at": self.submitted_at,
+            "finished_at": self.finished_at,
+            "batch_size": self.batch_size,
+            "timings": self.timings,
+        }
+        if self.result is not None:
+            info["margins"] = self.result
+            info["total"] = sum(self.result.values())
+        if self.error is not None:
+            info["error"] = self.error
+        return info
+
+
+class MarginService:
+    """Owns the browser session, the job table and the micro-batching runner."""
+
+    def __init__(self, headless=True, batch_window=BATCH_WINDOW, store=None):
+        self.batch_window = batch_window
+        self.store = store
+        # One session per ICA login (see BrowserSession)
+        self.sessions = [BrowserSession(headless=headless, slow_mo=0 if headless else 150)]
+        self.jobs = {}
+        self._jobs_lock = Lock()
+        self._pending: "Queue[ServiceJob]" = Queue()
+        self._work_dir = Path(tempfile.mkdtemp(prefix="margin_service_"))
+        self._runners = [
+            Thread(target=self._runner, args=(s,), name=f"MarginServiceRunner-{i}", daemon=True)
+            for i, s in enumerate(self.sessions)
+        ]
+
+    def start(self, warm_up=True):
+        if warm_up:
+            for session in self.sessions:
+                session.warm_up()
+        for runner in self._runners:
+            runner.start()
+
+    def close(self):
+        for session in self.sessions:
+            session.close()
+
+    # -- submission ----------------------------------------------------
+
+    def submit_bytes(self, name, data: bytes):
+        path = self._work_dir / f"upload_{time.time_ns()}{Path(name).suffix or '.xlsx'}"
+        path.write_bytes(data)
+        return self._submit(ServiceJob(name, path, owns_file=True))
+
+    def submit_path(self, path):
+        path = Path(path).resolve()
+        if not path.exists():
+            raise FileNotFoundError(f"Excel file not found: {path}")
+        return self._submit(ServiceJob(path.name, path))
+
+    def _submit(self, job):
+        with self._jobs_lock:
+            self._expire_jobs()
+            self.jobs[job.id] = job
+        self._pending.put(job)
+        return job
+
+    def get(self, job_id):
+        with self._jobs_lock:
+            return self.jobs.get(job_id)
+
+    def _expire_jobs(self):
+        cutoff = time.time() - JOB_TTL
+        for job_id in [
+            j.id for j in self.jobs.values() if j.finished_at and j.finished_at < cutoff
+        ]:
+            del self.jobs[job_id]
+
+    # -- micro-batching ------------------------------------------------
+
+    def _collect_batch(self):
+        """Block for one job, then gather compatible jobs for up to batch_window seconds."""
+        first = self._pending.get()
+        batch = [first]
+        leftovers = []
+        rows = self._load(first)
+        deadline = time.monotonic() + self.batch_window
+
+        while len(batch) < MAX_BATCH_JOBS and first.headers is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                job = self._pending.get(timeout=remaining)
+            except Empty:
+                break
+            job_rows = self._load(job)
+            if job.headers != first.headers or rows + job_rows > MAX_BATCH_ROWS:
+                leftovers.append(job)
+                continue
+            batch.append(job)
+            rows += job_rows
+
+        for job in leftovers:
+            self._pending.put(job)
+        return batch
+
+    def _load(self, job):
+        """Read a job's rows once; jobs that cannot be merged keep headers=None."""
+        if job.rows is None:
+            try:
+                headers, rows = read_positions(job.path)
+                if PORTFOLIO_COLUMN in headers:
+                    job.headers, job.rows = headers, rows
+                else:
+                    job.rows = rows
+            except Exception as e:  # noqa: BLE001 - surfaced when the job runs
+                job.rows = []
+                job.error = str(e)
+        return len(job.rows)
+
+    def _runner(self, session):
+        while True:
+            batch = self._collect_batch()
+            try:
+                self._run_batch(session, batch)
+            except Exception as e:  # noqa: BLE001 - reported to every caller
+                for job in batch:
+                    job.update(status="error", error=str(e))
+            finally:
+                for job in batch:
+                    job.rows = None
+                    if job.owns_file:
+                        job.path.unlink(missing_ok=True)
+                    if self.store is not None and job.status in FINISHED:
+                        self.store.record_run(
+                            job.name, job.result or {}, timings=job.timings, error=job.error
+                        )
+
+    def _run_batch(self, session, batch):
+        for job in batch:
+            job.update(status="running", batch_size=len(batch))
+
+        if batch[0].headers is None:
+            # No Portfolio Name column (or unreadable): upload the file as-is
+            job = batch[0]
+            if job.error:
+                raise ValueError(job.error)
+            timings = {}
+            margins = session.run(_perform_margin_calculation, job.path, timings=timings)
+            job.update(status="done", result=margins, timings=timings)
+            return
+
+        try:
+            self._run_merged(session, batch)
+        except Exception as e:  # noqa: BLE001 - find the job(s) that caused it
+            if len(batch) == 1:
+                raise
+            # One rejected or bad book fails the whole upload: run the jobs
+            # one by one so only the offending caller gets the error
+            print(f"⚠️ Merged run of {len(batch)} request(s) failed: {e}")
+            print("   Running them one by one")
+            for job in batch:
+                try:
+                    self._run_merged(session, [job])
+                except Exception as e:  # noqa: BLE001 - reported to this caller only
+                    job.update(status="error", error=str(e))
+
+    def _run_merged(self, session, batch):
+        """Upload ``batch`` as one file under job-prefixed portfolio names and split the results."""
+        headers = batch[0].headers
+        name_col = headers.index(PORTFOLIO_COLUMN)
+        merged_rows = []
+        owners = {}  # upload portfolio name -> (job, original name)
+        for job in batch:
+            for excel_row, values in job.rows:
+                original = str(values[name_col])
+                upload_name = f"J{job.seq}_{original}"
+                owners[upload_name] = (job, original)
+                values = list(values)
+                values[name_col] = upload_name
+                merged_rows.append((excel_row, tuple(values)))
+
+        upload_path = self._work_dir / f"batch_{batch[0].id}.xlsx"
+        write_positions_file(upload_path, headers, merged_rows)
+        if len(batch) > 1:
+            print(f"📦 Running {len(batch)} request(s) as one upload ({len(merged_rows)} rows)")
+
+        timings = {}
+        try:
+            margins = session.run(
+                _perform_margin_calculation, upload_path, list(owners), timings=timings
+            )
+        finally:
+            upload_path.unlink(missing_ok=True)
+
+        results = {job.id: {} for job in batch}
+        for upload_name, value in margins.items():
+            job, original = owners[upload_name]
+            results[job.id][original] = value
+        for job in batch:
+            job.update(status="done", result=results[job.id], timings=dict(timings))
+
+
+class _ServiceHandler(BaseHTTPRequestHandler):
+    server_version = "MarginService/1.0"
+
+    def log_message(self, format, *args):  # noqa: A002 - BaseHTTPRequestHandler API
+        print(f"🌐 {self.address_string()} {format % args}")
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/jobs":
+            return self._send_json(HTTPStatus.NOT_FOUND, {"error": "not found"})
+
+        service = self.server.service
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length)
+        try:
+            if self.headers.get("Content-Type", "").startswith("application/json"):
+                job = service.submit_path(json.loads(body)["path"])
+            else:
+                name = self.headers.get("X-File-Name") or "upload.xlsx"
+                job = service.submit_bytes(name, body)
+        except FileNotFoundError as e:
+            return self._send_json(HTTPStatus.NOT_FOUND, {"error": str(e)})
+        except (KeyError, ValueError) as e:
+            return self._send_json(HTTPStatus.BAD_REQUEST, {"error": str(e)})
+
+        self._send_json(HTTPStatus.ACCEPTED, job.to_dict())
+
+    def do_GET(self):
+        parts = [p for p in self.path.split("?")[0].split("/") if p]
+        service = self.server.service
+
+        if parts == ["health"]:
+            return self._send_json(
+                HTTPStatus.OK,
+                {"status": "ok", "queued": service._pending.qsize(), "jobs": len(service.jobs)},
+            )
+
+        if parts == ["metrics"]:
+            return self._send_json(
+                HTTPStatus.OK, {"sessions": [s.stats() for s in service.sessions]}
+            )
+
+        if len(parts) in (2, 3) and parts[0] == "jobs":
+            job = service.get(parts[1])
+            if job is None:
+                return self._send_json(HTTPStatus.NOT_FOUND, {"error": "unknown job"})
+            if len(parts) == 2:
+                return self._send_json(HTTPStatus.OK, job.to_dict())
+            if parts[2] == "stream":
+                return self._stream(job)
+
+        self._send_json(HTTPStatus.NOT_FOUND, {"error": "not found"})
+
+    def _stream(self, job):
+        """Send one JSON line per status change until the job finishes."""
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.close_connection = True
+
+        seen = -1
+        while True:
+            with job.changed:
+                changed = job.changed.wait_for(lambda: job.version != seen, timeout=15)
+                seen = job.version
+                payload = job.to_dict()
+            # A blank line keeps an idle connection open without repeating the status
+            line = json.dumps(payload) + "\n" if changed else "\n"
+            try:
+                self.wfile.write(line.encode())
+                self.wfile.flush()
+            except OSError:
+                return  # client went away
+            if payload["status"] in FINISHED:
+                return
+
+
+class MarginHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, service: MarginService, host="127.0.0.1", port=DEFAULT_PORT):
+        self.service = service
+        super().__init__((host, port), _ServiceHandler)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local margin service (HTTP/JSON)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--headless", action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument("--batch-window", type=float, default=BATCH_WINDOW)
+    parser.add_argument("--db", help="Record results in this result_store DB")
+    parser.add_argument("--no-warm-up", action="store_true")
+    args = parser.parse_args(argv)
+
+    store = None
+    if args.db:
+        from result_store import ResultStore
+
+        store = ResultStore(args.db)
+
+    service = MarginService(args.headless, args.batch_window, store)
+    service.start(warm_up=not args.no_warm_up)
+    server = MarginHTTPServer(service, args.host, args.port)
+    print(f"🚀 Margin service listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        if store is not None:
+            store.close()
+
+
+if __name__ == "__main__":
+    main()
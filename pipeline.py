@@ -0,0 +1,247 @@
+"""
+Pipelined runs on one browser session.
+
+Normally a session runs one book at a time: clear, upload, run, then wait
+for ICA to finish before the next book can even start uploading. Most of
+that cycle is ICA computing on the server. In pipelined mode the session
+uploads and starts the next book (under its own portfolio names) while the
+previous ones are still computing, keeping up to ``depth`` books in flight,
+and hands back each book's results as soon as they complete.
+
+The account is never cleared as a whole: every attempt uploads under a
+prefix of its own (a random token plus the book's number) and deletes just
+those portfolios once each book is done, so other uploads are left alone.
+
+    python pipeline.py books/*.xlsx --depth 2
+"""
+
+import argparse
+import shutil
+import tempfile
+import time
+import uuid
+from collections import deque
+from datetime import datetime, timezone
+from functools import partial
+from pathlib import Path
+from threading import Lock
+
+from margin_calculator import (
+    PORTFOLIO_COLUMN,
+    _delete_portfolios,
+    _phase,
+    _portfolio_checkbox,
+    _read_portfolio_margins,
+    _run_analytics_for,
+    _upload_positions,
+    get_browser_session,
+    read_positions,
+    write_positions_file,
+)
+from failure_capture import record_step
+from recovery import UploadRejected, retry_step
+
+# ---------------------------------------------------------------------
+# CONFIG
+# ---------------------------------------------------------------------
+PIPELINE_DEPTH = 2  # Books computing on ICA at the same time
+PIPELINE_POLL = 1.0  # Seconds between results-grid reads while waiting
+PIPELINE_RESULT_TIMEOUT = 300  # Seconds a book may take after its run started
+# ---------------------------------------------------------------------
+
+
+class _Book:
+    """One book in the pipeline, uploaded under its own portfolio prefix."""
+
+    def __init__(self, seq, path):
+        self.seq = seq
+        self.path = Path(path).resolve()
+        self.prefix = None
+        self.names = {}  # upload portfolio name -> name in the book
+        self.upload_path = None
+        self.timings = {}
+        self.started_at = None
+        self.submitted = None
+        self.reported = False  # A retried session task must not report it again
+
+    def prepare(self, work_dir, token):
+        # A new token per attempt: a retry never adds trades to a portfolio
+        # that an earlier attempt left on the account
+        self.prefix = f"Q{token}_{self.seq}_"
+        self.names = {}
+        headers, rows = read_positions(self.path)
+        if PORTFOLIO_COLUMN not in headers:
+            raise ValueError(f"{self.path.name} has no '{PORTFOLIO_COLUMN}' column")
+        col = headers.index(PORTFOLIO_COLUMN)
+        renamed = []
+        for excel_row, values in rows:
+            original = str(values[col]).strip()
+            upload_name = self.prefix + original
+            self.names[upload_name] = original
+            values = list(values)
+            values[col] = upload_name
+            renamed.append((excel_row, tuple(values)))
+        self.upload_path = write_positions_file(
+            Path(work_dir) / f"{self.prefix}{self.path.stem}.xlsx", headers, renamed
+        )
+
+
+def _delete_landed(page, names):
+    """Before an upload retry: delete whichever of ``names`` the failed attempt left."""
+    _delete_portfolios(page, [name for name in names if _portfolio_checkbox(page, name).count()])
+
+
+def _perform_pipelined(page, books, depth, report, result_timeout):
+    """Worker-thread loop: keep ``depth`` books computing, report each as it finishes."""
+
+    work_dir = tempfile.mkdtemp(prefix="ica_pipeline_")
+    token = uuid.uuid4().hex[:6]
+    pending = deque(book for book in books if not book.reported)
+    in_flight = []
+    try:
+        while pending or in_flight:
+            if pending and len(in_flight) < depth:
+                book = pending.popleft()
+                if book.reported:  # The caller gave up on it (run timeout)
+                    continue
+                book.started_at = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+                try:
+                    with _phase(book.timings, "upload"):
+                        book.prepare(work_dir, token)
+                        # An upload that landed but failed to confirm must not be
+                        # added again under the same names
+                        retry_step(
+                            page,
+                            "upload",
+                            _upload_positions,
+                            page,
+                            book.upload_path,
+                            before_retry=partial(_delete_landed, names=list(book.names)),
+                        )
+                except (UploadRejected, ValueError, OSError) as e:
+                    report(book, None, e)  # Bad book: the pipeline carries on
+                    continue
+                with _phase(book.timings, "run"):
+                    retry_step(page, "run", _run_analytics_for, page, list(book.names))
+                book.submitted = time.monotonic()
+                in_flight.append(book)
+                continue
+
+            margins = _read_portfolio_margins(page)
+            finished = []
+            for book in list(in_flight):
+                waited = time.monotonic() - book.submitted
+                if all(name in margins for name in book.names):
+                    book.timings["results"] = waited
+                    record_step(f"results {book.path.name}", waited)
+                    in_flight.remove(book)
+                    report(
+                        book,
+                        {original: margins[name] for name, original in book.names.items()},
+                        None,
+                    )
+                    finished.append(book)
+                elif waited > result_timeout:
+                    in_flight.remove(book)
+                    report(book, None, TimeoutError(f"No result within {result_timeout}s"))
+                    finished.append(book)
+            if finished:
+                names = [name for book in finished for name in book.names]
+                retry_step(page, "delete", _delete_portfolios, page, names)
+            else:
+                time.sleep(PIPELINE_POLL)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def run_pipelined(
+    paths,
+    session=None,
+    depth=PIPELINE_DEPTH,
+    store=None,
+    on_result=None,
+    timeout=None,
+    result_timeout=PIPELINE_RESULT_TIMEOUT,
+):
+    """
+    Run ``paths`` on one session with up to ``depth`` books computing at once.
+
+    ``on_result(path, margins, error, timings)`` is called (on the browser
+    worker thread) as each book finishes; results are also recorded in
+    ``store`` when given. Books need a ``Portfolio Name`` column.
+
+    Returns: list of (path, margins, error) in completion order.
+    """
+    session = session or get_browser_session()
+    books = [_Book(seq, path) for seq, path in enumerate(paths, start=1)]
+    results = []
+    reported = Lock()
+
+    def report(book, margins, error):
+        # After a run timeout the caller fails the unreported books while the
+        # worker may still finish them: whoever comes first reports the book
+        with reported:
+            if book.reported:
+                return
+            book.reported = True
+        error = str(error) if error is not None else None
+        results.append((book.path, margins, error))
+        if error is None:
+            print(f"✅ {book.path.name}: {sum(margins.values()):,.2f}")
+        else:
+            print(f"❌ {book.path.name}: {error}")
+        if store is not None:
+            store.record_run(
+                book.path,
+                margins or {},
+                timings=book.timings,
+                error=error,
+                started_at=book.started_at,
+            )
+        if on_result is not None:
+            try:
+                on_result(book.path, margins, error, dict(book.timings))
+            except Exception as e:  # noqa: BLE001 - a caller bug must not stop the pipeline
+                print(f"⚠️ on_result failed for {book.path.name}: {e}")
+
+    print(f"🚀 Pipelining {len(books)} book(s), {depth} in flight")
+    try:
+        session.run(
+            _perform_pipelined,
+            books,
+            max(1, depth),
+            report,
+            result_timeout,
+            timeout=timeout,
+        )
+    except Exception as e:
+        for book in books:
+            if not book.reported:
+                report(book, None, e)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run several books on one pipelined session.")
+    parser.add_argument("files", nargs="+", help="Position workbooks")
+    parser.add_argument("--depth", type=int, default=PIPELINE_DEPTH, help="Books in flight")
+    parser.add_argument("--db", help="Also record results in this result_store DB")
+    args = parser.parse_args()
+
+    store = None
+    if args.db:
+        from result_store import ResultStore
+
+        store = ResultStore(args.db)
+    start = time.perf_counter()
+    try:
+        done = run_pipelined(args.files, depth=args.depth, store=store)
+    finally:
+        get_browser_session().close()
+        if store is not None:
+            store.close()
+
+    failed = sum(1 for _, _, error in done if error)
+    print(
+        f"\n🧮 {len(done) - failed}/{len(done)} book(s) in {time.perf_counter() - start:.1f}s"
+    )
@@ -0,0 +1,121 @@
+"""
+Incremental (delta) uploads for partially changed books.
+
+Each portfolio's positions are normalized and hashed. The result store keeps
+the hash and margin of the last calculation of every ``Portfolio Name``;
+portfolios whose hash is unchanged (and whose result is recent enough) reuse
+the stored margin, and only the changed ones are uploaded and run. Row order,
+column order, whitespace and 5 vs 5.0 do not count as changes.
+"""
+
+import hashlib
+import os
+import tempfile
+from datetime import date, datetime
+
+from margin_calculator import PORTFOLIO_COLUMN, read_positions, write_positions_file
+
+# ---------------------------------------------------------------------
+# CONFIG
+# ---------------------------------------------------------------------
+DELTA_MAX_AGE_HOURS = 8  # Stored results older than this are recalculated
+IGNORED_COLUMNS = ("Calculated Margin", "Marginal Contribution")  # Written back by us
+# ---------------------------------------------------------------------
+
+
+def _normalize(value):
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return str(value)
+    if isinstance(value, (int, float)):
+        return repr(float(value))
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    text = " ".join(str(value).split())
+    try:
+        return repr(float(text.replace(",", "")))
+    except ValueError:
+        return text
+
+
+def portfolio_hashes(headers, rows):
+    """
+    Hash every portfolio's positions.
+
+    Returns: ({portfolio: hash}, {portfolio: [row, ...]}), or None when a row
+    has no portfolio name (the book cannot be split).
+    """
+    if PORTFOLIO_COLUMN not in headers:
+        return None
+    name_col = headers.index(PORTFOLIO_COLUMN)
+    columns = sorted(
+        (header, i)
+        for i, header in enumerate(headers)
+        if i != name_col and header and header not in IGNORED_COLUMNS
+    )
+
+    lines = {}
+    grouped = {}
+    for row in rows:
+        values = row[1]
+        name = values[name_col]
+        if name is None or str(name).strip() == "":
+            return None
+        name = str(name).strip()
+        grouped.setdefault(name, []).append(row)
+        lines.setdefault(name, []).append(
+            "\x1f".join(
+                f"{header}={_normalize(values[i] if i < len(values) else None)}"
+                for header, i in columns
+            )
+        )
+
+    hashes = {
+        name: hashlib.sha256("\n".join(sorted(book)).encode()).hexdigest()
+        for name, book in lines.items()
+    }
+    return hashes, grouped
+
+
+class DeltaPlan:
+    """Which portfolios of a book must be recalculated and which are reused."""
+
+    def __init__(self, headers, hashes, grouped, stored):
+        self.headers = headers
+        self.hashes = hashes
+        self._grouped = grouped
+        self.reused = {
+            name: stored[name][1]
+            for name, digest in hashes.items()
+            if name in stored and stored[name][0] == digest and stored[name][1] is not None
+        }
+        self.changed = [name for name in hashes if name not in self.reused]
+
+    @property
+    def full(self):
+        return not self.reused
+
+    def write_upload(self):
+        """Write the changed portfolios to a temporary upload workbook."""
+        rows = [row for name in self.changed for row in self._grouped[name]]
+        handle, path = tempfile.mkstemp(prefix="delta_", suffix=".xlsx")
+        os.close(handle)
+        return write_positions_file(path, self.headers, rows)
+
+    def states(self, margins):
+        """{portfolio: (hash, margin)} for freshly calculated portfolios."""
+        return {
+            name: (self.hashes[name], margins[name]) for name in self.changed if name in margins
+        }
+
+
+def plan_delta(excel_path, store, max_age_hours=DELTA_MAX_AGE_HOURS):
+    """Compare ``excel_path`` with the store's last state; None if it cannot be split."""
+    headers, rows = read_positions(excel_path)
+    split = portfolio_hashes(headers, rows)
+    if split is None:
+        return None
+    hashes, grouped = split
+    stored = store.portfolio_states(list(hashes), max_age_hours=max_age_hours)
+    return DeltaPlan(headers, hashes, grouped, stored)
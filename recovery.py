@@ -0,0 +1,231 @@
+"""
+Error classification and step-level recovery for the ICA automation.
+
+Instead of reloading the whole ICA page after any error, each failure is
+classified and handled on its own terms:
+
+    transient-ui     missed click, element not ready, stray dialog
+                     -> dismiss dialogs and retry the step with backoff
+    upload-rejected  ICA refused the positions file
+                     -> dismiss the dialog and fail the job (retrying cannot help)
+    session-expired  ICA redirected to login / answered 401
+                     -> new context from the saved login, retry the job once
+    browser-crashed  page, context or browser is gone
+                     -> relaunch the browser, retry the job once
+    cancelled        the caller stopped the job (Cancelled)
+                     -> fail the job as is; not an error of the session
+
+A circuit breaker stops sending jobs to a session after repeated failures,
+so a real outage fails fast instead of burning minutes on retries.
+"""
+
+import json
+import re
+import time
+from pathlib import Path
+from threading import Lock
+
+# ---------------------------------------------------------------------
+# CONFIG
+# ---------------------------------------------------------------------
+STEP_RETRIES = 2  # Extra attempts of a step after a transient UI error
+TASK_RETRIES = 1  # Extra attempts of a job after a session refresh or relaunch
+BACKOFF_BASE = 0.5  # Seconds before the first retry (doubles each time)
+BACKOFF_MAX = 8.0  # Longest wait between retries
+BREAKER_THRESHOLD = 5  # Consecutive failed jobs before the breaker opens
+BREAKER_COOLDOWN = 120  # Seconds the breaker stays open before a trial job
+SESSION_SAVE_INTERVAL = 600  # Seconds between saves of the refreshed login state
+LOGIN_URL = re.compile(r"login|signin|sign-in|/sso|/auth", re.I)  # ICA login redirect
+DISMISS_BUTTONS = re.compile(r"^(OK|Close|Cancel|Dismiss)$", re.I)
+# ---------------------------------------------------------------------
+
+TRANSIENT_UI = "transient-ui"
+SESSION_EXPIRED = "session-expired"
+UPLOAD_REJECTED = "upload-rejected"
+BROWSER_CRASHED = "browser-crashed"
+UNKNOWN = "unknown"
+ERROR_CLASSES = (TRANSIENT_UI, SESSION_EXPIRED, UPLOAD_REJECTED, BROWSER_CRASHED, UNKNOWN)
+CANCELLED = "cancelled"  # Not an error: no breaker failure, recovery or error count
+
+_CRASH_MARKERS = (
+    "target page, context or browser has been closed",
+    "target closed",
+    "browser has been closed",
+    "browser closed",
+    "connection closed",
+    "page crashed",
+)
+_SESSION_MARKERS = ("401", "unauthorized", "session expired", "session has expired")
+_TRANSIENT_MARKERS = (
+    "timeout",
+    "not visible",
+    "not attached",
+    "detached",
+    "intercepts pointer events",
+    "not stable",
+    "not enabled",
+    "outside of the viewport",
+)
+
+
+class Cancelled(Exception):
+    """Base class of the exceptions callers raise to stop a running job."""
+
+
+class UploadRejected(Exception):
+    """ICA refused the uploaded positions file."""
+
+
+class SessionExpired(Exception):
+    """The saved ICA login is no longer accepted."""
+
+
+class CircuitOpen(RuntimeError):
+    """Jobs are refused because the session keeps failing."""
+
+
+def classify(exc, page=None):
+    """Return the error class (TRANSIENT_UI, SESSION_EXPIRED, ...) of ``exc``."""
+    if isinstance(exc, Cancelled):
+        return CANCELLED
+    if isinstance(exc, UploadRejected):
+        return UPLOAD_REJECTED
+    if isinstance(exc, SessionExpired):
+        return SESSION_EXPIRED
+
+    message = str(exc).lower()
+    if any(marker in message for marker in _CRASH_MARKERS):
+        return BROWSER_CRASHED
+    if page is not None:
+        try:
+            if page.is_closed():
+                return BROWSER_CRASHED
+            if LOGIN_URL.search(page.url):
+                return SESSION_EXPIRED
+        except Exception:  # noqa: BLE001 - a page we cannot even query is gone
+            return BROWSER_CRASHED
+    if any(marker in message for marker in _SESSION_MARKERS):
+        return SESSION_EXPIRED
+    # Playwright errors only; a builtin TimeoutError is our own result wait
+    if type(exc).__module__.startswith("playwright") and any(
+        marker in message for marker in _TRANSIENT_MARKERS
+    ):
+        return TRANSIENT_UI
+    return UNKNOWN
+
+
+def backoff_delay(attempt):
+    """Seconds to wait before retry number ``attempt`` (0-based)."""
+    return min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt)
+
+
+def dismiss_dialogs(page, limit=5):
+    """Close visible dialogs (OK / Close / Cancel, else Escape). Returns their text."""
+    texts = []
+    try:
+        dialogs = page.locator('[role="dialog"]:visible, [role="alertdialog"]:visible')
+        for _ in range(limit):
+            if dialogs.count() == 0:
+                break
+            dialog = dialogs.first
+            texts.append(dialog.inner_text(timeout=1000).strip())
+            button = dialog.get_by_role("button", name=DISMISS_BUTTONS)
+            if button.count():
+                button.first.click(timeout=2000)
+            else:
+                page.keyboard.press("Escape")
+    except Exception:  # noqa: BLE001 - best effort, the retry reports real errors
+        pass
+    return texts
+
+
+def retry_step(page, name, fn, *args, before_retry=None):
+    """
+    Run one automation step, retrying transient UI errors with backoff.
+
+    ``before_retry(page)`` runs before every retry (e.g. to undo a partial
+    upload). Other error classes are raised at once for the session to handle.
+    """
+    for attempt in range(STEP_RETRIES + 1):
+        try:
+            if attempt and before_retry is not None:
+                before_retry(page)
+            return fn(*args)
+        except Exception as exc:
+            if attempt >= STEP_RETRIES or classify(exc, page) != TRANSIENT_UI:
+                raise
+            delay = backoff_delay(attempt)
+            reason = str(exc).strip().splitlines()[0] if str(exc).strip() else type(exc).__name__
+            print(
+                f"🔁 '{name}' retry {attempt + 1}/{STEP_RETRIES} in {delay:.1f}s "
+                f"after transient UI error: {reason}"
+            )
+            dismiss_dialogs(page)
+            time.sleep(delay)
+
+
+def save_storage_state(context, path):
+    """Write the context's (refreshed) cookies and storage to ``path`` atomically."""
+    path = Path(path)
+    tmp = path.with_suffix(path.suffix + ".tmp")
+    tmp.write_text(json.dumps(context.storage_state()))
+    tmp.replace(path)
+
+
+class CircuitBreaker:
+    """
+    Open after BREAKER_THRESHOLD consecutive failed jobs; after the cooldown
+    one trial job is let through, which closes the breaker again on success.
+    """
+
+    def __init__(self, threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._lock = Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.last_error = None
+        self.trips = 0
+
+    def is_open(self):
+        with self._lock:
+            return self._open()
+
+    def _open(self):
+        if self.opened_at is None:
+            return False
+        return time.monotonic() - self.opened_at < self.cooldown
+
+    def check(self):
+        """Raise CircuitOpen while the breaker is open."""
+        with self._lock:
+            if self._open():
+                remaining = self.cooldown - (time.monotonic() - self.opened_at)
+                raise CircuitOpen(
+                    f"{self.failures} consecutive failures (last: {self.last_error}); "
+                    f"not retrying for another {remaining:.0f}s"
+                )
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def failure(self, kind):
+        with self._lock:
+            self.failures += 1
+            self.last_error = kind
+            half_open = self.opened_at is not None
+            if self.threshold and (half_open or self.failures >= self.threshold):
+                if not self._open():
+                    self.trips += 1
+                self.opened_at = time.monotonic()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "open": self._open(),
+                "consecutive_failures": self.failures,
+                "last_error": self.last_error,
+                "trips": self.trips,
+            }
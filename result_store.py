@@ -0,0 +1,505 @@
+"""
+Indexed SQLite history of margin runs.
+Replaces the flat margin_results.csv with tables for runs, portfolios,
+per-account results and phase timings, plus a small query/export API.
+"""
+
+import csv
+import sqlite3
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from threading import Lock
+
+# ---------------------------------------------------------------------
+# CONFIG
+# ---------------------------------------------------------------------
+RESULTS_DB = "margin_results.db"  # SQLite file holding the run history
+# ---------------------------------------------------------------------
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started_at TEXT NOT NULL,
+    finished_at TEXT,
+    source_file TEXT,
+    engine TEXT NOT NULL DEFAULT 'ica',
+    status TEXT NOT NULL,
+    total_margin REAL,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_runs_started ON runs (started_at);
+CREATE INDEX IF NOT EXISTS idx_runs_source ON runs (source_file, started_at);
+
+CREATE TABLE IF NOT EXISTS portfolios (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+
+CREATE TABLE IF NOT EXISTS portfolio_results (
+    run_id INTEGER NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+    portfolio_id INTEGER NOT NULL REFERENCES portfolios (id),
+    margin REAL,
+    PRIMARY KEY (run_id, portfolio_id)
+);
+CREATE INDEX IF NOT EXISTS idx_portfolio_results_portfolio
+    ON portfolio_results (portfolio_id, run_id);
+
+CREATE TABLE IF NOT EXISTS account_results (
+    run_id INTEGER NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+    portfolio_id INTEGER NOT NULL REFERENCES portfolios (id),
+    account TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    value REAL,
+    PRIMARY KEY (run_id, portfolio_id, account, metric)
+);
+CREATE INDEX IF NOT EXISTS idx_account_results_account
+    ON account_results (account, run_id);
+
+CREATE TABLE IF NOT EXISTS phase_timings (
+    run_id INTEGER NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+    phase TEXT NOT NULL,
+    seconds REAL NOT NULL,
+    PRIMARY KEY (run_id, phase)
+);
+CREATE INDEX IF NOT EXISTS idx_phase_timings_phase ON phase_timings (phase);
+
+-- Last calculated positions hash and margin per portfolio (delta uploads)
+CREATE TABLE IF NOT EXISTS portfolio_state (
+    portfolio_id INTEGER PRIMARY KEY REFERENCES portfolios (id),
+    positions_hash TEXT NOT NULL,
+    margin REAL,
+    run_id INTEGER REFERENCES runs (id) ON DELETE SET NULL,
+    updated_at TEXT NOT NULL
+);
+
+-- Micro-benchmark results (bench_io.py) for regression tracking
+CREATE TABLE IF NOT EXISTS benchmarks (
+    id INTEGER PRIMARY KEY,
+    recorded_at TEXT NOT NULL,
+    suite TEXT NOT NULL,
+    name TEXT NOT NULL,
+    rows INTEGER,
+    seconds REAL,
+    peak_mb REAL,
+    revision TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_benchmarks_case ON benchmarks (suite, name, rows, recorded_at);
+"""
+
+EXPORT_COLUMNS = [
+    "run_id",
+    "started_at",
+    "finished_at",
+    "source_file",
+    "engine",
+    "status",
+    "portfolio",
+    "margin",
+    "total_margin",
+    "error",
+]
+ACCOUNT_EXPORT_COLUMNS = [
+    "run_id",
+    "started_at",
+    "finished_at",
+    "source_file",
+    "engine",
+    "portfolio",
+    "account",
+    "metric",
+    "value",
+]
+
+
+def _now():
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _since(days):
+    cutoff = datetime.now(timezone.utc) - timedelta(days=days)
+    return cutoff.strftime("%Y-%m-%d %H:%M:%S")
+
+
+class ResultStore:
+    """Thread-safe wrapper around the SQLite result history (WAL mode)."""
+
+    def __init__(self, path=RESULTS_DB):
+        self.path = Path(path)
+        self._lock = Lock()
+        self._conn = sqlite3.connect(
+            str(self.path), check_same_thread=False, isolation_level=None
+        )
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA foreign_keys=ON")
+        self._conn.executescript(_SCHEMA)
+
+    # -- writes --------------------------------------------------------
+
+    def record_run(self, source_file, margins, **kwargs):
+        """Record a single run. See ``record_runs`` for the accepted keys."""
+        return self.record_runs([dict(kwargs, source_file=source_file, margins=margins)])[0]
+
+    def record_runs(self, runs):
+        """
+        Record several runs in one transaction.
+
+        Each run is a dict with ``source_file`` and ``margins`` ({portfolio: margin})
+        and optionally ``timings`` ({phase: seconds}), ``accounts``
+        ({portfolio: {account: {metric: value}}}), ``status``, ``error``,
+        ``engine``, ``started_at`` and ``finished_at``.
+
+        Returns: list of run ids
+        """
+        run_ids = []
+        with self._lock:
+            cur = self._conn.cursor()
+            cur.execute("BEGIN")
+            try:
+                for run in runs:
+                    run_ids.append(self._insert_run(cur, run))
+                cur.execute("COMMIT")
+            except Exception:
+                cur.execute("ROLLBACK")
+                raise
+        return run_ids
+
+    def _portfolio_id(self, cur, name):
+        cur.execute("INSERT OR IGNORE INTO portfolios (name) VALUES (?)", (name,))
+        cur.execute("SELECT id FROM portfolios WHERE name = ?", (name,))
+        return cur.fetchone()[0]
+
+    def _insert_run(self, cur, run):
+        margins = run.get("margins") or {}
+        status = run.get("status") or ("ok" if run.get("error") is None else "error")
+        total = sum(v for v in margins.values() if v is not None) if margins else None
+        source = run.get("source_file")
+
+        cur.execute(
+            "INSERT INTO runs (started_at, finished_at, source_file, engine, status, "
+            "total_margin, error) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                run.get("started_at") or _now(),
+                run.get("finished_at") or _now(),
+                str(source) if source is not None else None,
+                run.get("engine", "ica"),
+                status,
+                total,
+                run.get("error"),
+            ),
+        )
+        run_id = cur.lastrowid
+
+        ids = {name: self._portfolio_id(cur, name) for name in margins}
+        cur.executemany(
+            "INSERT INTO portfolio_results (run_id, portfolio_id, margin) VALUES (?, ?, ?)",
+            [(run_id, ids[name], value) for name, value in margins.items()],
+        )
+
+        account_rows = []
+        for portfolio, accounts in (run.get("accounts") or {}).items():
+            pid = ids.get(portfolio) or self._portfolio_id(cur, portfolio)
+            for account, metrics in accounts.items():
+                for metric, value in metrics.items():
+                    account_rows.append((run_id, pid, str(account), metric, value))
+        cur.executemany(
+            "INSERT OR REPLACE INTO account_results "
+            "(run_id, portfolio_id, account, metric, value) VALUES (?, ?, ?, ?, ?)",
+            account_rows,
+        )
+
+        cur.executemany(
+            "INSERT OR REPLACE INTO phase_timings (run_id, phase, seconds) VALUES (?, ?, ?)",
+            [(run_id, phase, seconds) for phase, seconds in (run.get("timings") or {}).items()],
+        )
+        return run_id
+
+    def save_portfolio_states(self, states, run_id=None):
+        """Remember ``{portfolio: (positions_hash, margin)}`` as the last calculated state."""
+        if not states:
+            return
+        now = _now()
+        with self._lock:
+            cur = self._conn.cursor()
+            cur.execute("BEGIN")
+            try:
+                for name, (digest, margin) in states.items():
+                    cur.execute(
+                        "INSERT OR REPLACE INTO portfolio_state "
+                        "(portfolio_id, positions_hash, margin, run_id, updated_at) "
+                        "VALUES (?, ?, ?, ?, ?)",
+                        (self._portfolio_id(cur, name), digest, margin, run_id, now),
+                    )
+                cur.execute("COMMIT")
+            except Exception:
+                cur.execute("ROLLBACK")
+                raise
+
+    def record_benchmarks(self, suite, results, revision=None):
+        """Store ``results`` (dicts with name, rows, seconds, peak_mb) of one benchmark run."""
+        now = _now()
+        with self._lock:
+            cur = self._conn.cursor()
+            cur.execute("BEGIN")
+            try:
+                cur.executemany(
+                    "INSERT INTO benchmarks "
+                    "(recorded_at, suite, name, rows, seconds, peak_mb, revision) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [
+                        (
+                            now,
+                            suite,
+                            r["name"],
+                            r.get("rows"),
+                            r.get("seconds"),
+                            r.get("peak_mb"),
+                            revision,
+                        )
+                        for r in results
+                    ],
+                )
+                cur.execute("COMMIT")
+            except Exception:
+                cur.execute("ROLLBACK")
+                raise
+
+    # -- queries -------------------------------------------------------
+
+    def portfolio_states(self, portfolios, max_age_hours=None):
+        """Return {portfolio: (positions_hash, margin)} of the last calculation of each."""
+        if not portfolios:
+            return {}
+        portfolios = list(portfolios)
+        sql = (
+            "SELECT p.name, s.positions_hash, s.margin FROM portfolio_state s "
+            "JOIN portfolios p ON p.id = s.portfolio_id "
+            f"WHERE p.name IN ({', '.join('?' * len(portfolios))})"
+        )
+        params = list(portfolios)
+        if max_age_hours is not None:
+            sql += " AND s.updated_at >= ?"
+            params.append(_since(max_age_hours / 24))
+        return {
+            row["name"]: (row["positions_hash"], row["margin"])
+            for row in self._query(sql, params)
+        }
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            return [dict(row) for row in self._conn.execute(sql, params)]
+
+    def runs(self, days=None, source_file=None, limit=None):
+        """Return recent runs, newest first."""
+        sql = "SELECT * FROM runs WHERE 1 = 1"
+        params = []
+        if days is not None:
+            sql += " AND started_at >= ?"
+            params.append(_since(days))
+        if source_file is not None:
+            sql += " AND source_file = ?"
+            params.append(str(source_file))
+        sql += " ORDER BY started_at DESC, id DESC"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        return self._query(sql, params)
+
+    def portfolio_history(self, portfolio, days=30):
+        """Return [{run_id, started_at, margin, ...}] for ``portfolio`` over ``days``."""
+        return self._query(
+            "SELECT r.id AS run_id, r.started_at, r.source_file, r.engine, pr.margin "
+            "FROM portfolio_results pr "
+            "JOIN portfolios p ON p.id = pr.portfolio_id "
+            "JOIN runs r ON r.id = pr.run_id "
+            "WHERE p.name = ? AND r.started_at >= ? "
+            "ORDER BY r.started_at",
+            (portfolio, _since(days)),
+        )
+
+    def run_results(self, run_id):
+        """Return {portfolio: margin} for one run."""
+        rows = self._query(
+            "SELECT p.name, pr.margin FROM portfolio_results pr "
+            "JOIN portfolios p ON p.id = pr.portfolio_id WHERE pr.run_id = ?",
+            (run_id,),
+        )
+        return {row["name"]: row["margin"] for row in rows}
+
+    def account_results(self, run_id):
+        """Return {portfolio: {account: {metric: value}}} for one run."""
+        rows = self._query(
+            "SELECT p.name, a.account, a.metric, a.value FROM account_results a "
+            "JOIN portfolios p ON p.id = a.portfolio_id WHERE a.run_id = ?",
+            (run_id,),
+        )
+        result = {}
+        for row in rows:
+            accounts = result.setdefault(row["name"], {})
+            accounts.setdefault(row["account"], {})[row["metric"]] = row["value"]
+        return result
+
+    def compare_runs(self, run_a, run_b):
+        """Return {portfolio: (margin_a, margin_b, change)} for two runs."""
+        a = self.run_results(run_a)
+        b = self.run_results(run_b)
+        comparison = {}
+        for name in sorted(a.keys() | b.keys()):
+            left, right = a.get(name), b.get(name)
+            change = right - left if left is not None and right is not None else None
+            comparison[name] = (left, right, change)
+        return comparison
+
+    def benchmark_history(self, suite, name=None, rows=None, limit=None):
+        """Return stored benchmark results of ``suite``, newest first."""
+        sql = "SELECT * FROM benchmarks WHERE suite = ?"
+        params = [suite]
+        if name is not None:
+            sql += " AND name = ?"
+            params.append(name)
+        if rows is not None:
+            sql += " AND rows = ?"
+            params.append(rows)
+        sql += " ORDER BY recorded_at DESC, id DESC"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        return self._query(sql, params)
+
+    def phase_stats(self, days=30):
+        """Return {phase: {count, avg, max}} of phase timings over ``days``."""
+        rows = self._query(
+            "SELECT t.phase, COUNT(*) AS count, AVG(t.seconds) AS avg, MAX(t.seconds) AS max "
+            "FROM phase_timings t JOIN runs r ON r.id = t.run_id "
+            "WHERE r.started_at >= ? GROUP BY t.phase",
+            (_since(days),),
+        )
+        return {row.pop("phase"): row for row in rows}
+
+    # -- export --------------------------------------------------------
+
+    def _export_rows(self, days=None, run_ids=None):
+        sql = (
+            "SELECT r.id AS run_id, r.started_at, r.finished_at, r.source_file, r.engine, "
+            "r.status, p.name AS portfolio, pr.margin, r.total_margin, r.error "
+            "FROM runs r "
+            "LEFT JOIN portfolio_results pr ON pr.run_id = r.id "
+            "LEFT JOIN portfolios p ON p.id = pr.portfolio_id WHERE 1 = 1"
+        )
+        params = []
+        if days is not None:
+            sql += " AND r.started_at >= ?"
+            params.append(_since(days))
+        if run_ids is not None:
+            run_ids = list(run_ids)
+            sql += f" AND r.id IN ({', '.join('?' * len(run_ids))})"
+            params.extend(run_ids)
+        sql += " ORDER BY r.started_at, r.id, p.name"
+        return self._query(sql, params)
+
+    def _export_account_rows(self, days=None, run_ids=None):
+        sql = (
+            "SELECT r.id AS run_id, r.started_at, r.finished_at, r.source_file, r.engine, "
+            "p.name AS portfolio, a.account, a.metric, a.value "
+            "FROM account_results a "
+            "JOIN runs r ON r.id = a.run_id "
+            "JOIN portfolios p ON p.id = a.portfolio_id WHERE 1 = 1"
+        )
+        params = []
+        if days is not None:
+            sql += " AND r.started_at >= ?"
+            params.append(_since(days))
+        if run_ids is not None:
+            run_ids = list(run_ids)
+            sql += f" AND r.id IN ({', '.join('?' * len(run_ids))})"
+            params.extend(run_ids)
+        sql += " ORDER BY r.started_at, r.id, p.name, a.account, a.metric"
+        return self._query(sql, params)
+
+    def export_csv(self, output_path, days=None, run_ids=None, accounts=False):
+        """
+        Export one row per (run, portfolio) to CSV, or with ``accounts`` one
+        row per (run, portfolio, account, metric) from the account results.
+        """
+        if accounts:
+            rows, columns = self._export_account_rows(days, run_ids), ACCOUNT_EXPORT_COLUMNS
+        else:
+            rows, columns = self._export_rows(days, run_ids), EXPORT_COLUMNS
+        with open(output_path, "w", newline="") as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=columns)
+            writer.writeheader()
+            writer.writerows(rows)
+        return len(rows)
+
+    def export_parquet(self, output_path, days=None, run_ids=None, accounts=False):
+        """Export like ``export_csv`` to Parquet (requires pyarrow)."""
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError as e:
+            raise ImportError(
+                "Parquet export requires pyarrow. Install it with 'pip install pyarrow'."
+            ) from e
+
+        if accounts:
+            rows, columns = self._export_account_rows(days, run_ids), ACCOUNT_EXPORT_COLUMNS
+        else:
+            rows, columns = self._export_rows(days, run_ids), EXPORT_COLUMNS
+        table = pa.table({col: [row[col] for row in rows] for col in columns})
+        pq.write_table(table, output_path)
+        return len(rows)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Query the margin result history")
+    parser.add_argument("--db", default=RESULTS_DB)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_runs = sub.add_parser("runs", help="List recent runs")
+    p_runs.add_argument("--days", type=int, default=30)
+
+    p_hist = sub.add_parser("history", help="Margin history for one portfolio")
+    p_hist.add_argument("portfolio")
+    p_hist.add_argument("--days", type=int, default=30)
+
+    p_cmp = sub.add_parser("compare", help="Compare two runs")
+    p_cmp.add_argument("run_a", type=int)
+    p_cmp.add_argument("run_b", type=int)
+
+    p_exp = sub.add_parser("export", help="Export to .csv or .parquet")
+    p_exp.add_argument("output")
+    p_exp.add_argument("--days", type=int)
+    p_exp.add_argument(
+        "--accounts", action="store_true", help="Export the per-account results instead"
+    )
+
+    args = parser.parse_args()
+    store = ResultStore(args.db)
+
+    if args.command == "runs":
+        for run in store.runs(days=args.days):
+            print(
+                f"{run['id']:>6}  {run['started_at']}  {run['status']:<6} "
+                f"{run['total_margin'] or 0:>18,.2f}  {run['source_file']}"
+            )
+    elif args.command == "history":
+        for row in store.portfolio_history(args.portfolio, days=args.days):
+            print(f"{row['started_at']}  run {row['run_id']:>6}  {row['margin']:>18,.2f}")
+    elif args.command == "compare":
+        for name, (a, b, change) in store.compare_runs(args.run_a, args.run_b).items():
+            print(f"{name:<30} {a!s:>18} {b!s:>18} {change!s:>18}")
+    elif args.command == "export":
+        if args.output.endswith(".parquet"):
+            count = store.export_parquet(args.output, days=args.days, accounts=args.accounts)
+        else:
+            count = store.export_csv(args.output, days=args.days, accounts=args.accounts)
+        print(f"✅ Exported {count} row(s) to {args.output}")
+
+    store.close()
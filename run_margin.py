@@ -1,6 +1,6 @@
 # python -m playwright codegen https://ica.ice.com/ICA/Main
 # command to track the actions to be done over the site
-import time, csv, re
+import time, re
 from pathlib import Path
 from playwright.sync_api import sync_playwright, TimeoutError as PWTimeoutError
 import pyperclip  # pip install pyperclip
@@ -9,7 +9,8 @@ import pyperclip  # pip install pyperclip
 # CONFIG
 # ---------------------------------------------------------------------
 EXCEL_FOLDER = "D:\downloads\scenarios"  # folder containing all your Excel files
-OUTPUT_CSV = "margin_results.csv"  # results saved here
+RESULTS_DB = "margin_results.db"  # result history (see result_store.py)
+OUTPUT_CSV = "margin_results.csv"  # CSV export of the latest batch
 SESSION_FILE = "ice_session.json"  # your saved session from login_once.py
 APP_URL = "https://ica.ice.com/ICA/Main"
 # ---------------------------------------------------------------------
@@ -131,26 +132,44 @@ def run_margin_calc(file_path: str):
 
 
 def run_all_files():
+    """Run every workbook in EXCEL_FOLDER and record the results in the history DB."""
+    # Imported here so the legacy single-file path above keeps working on its own
+    from margin_calculator import BrowserSession, _perform_margin_calculation
+    from result_store import ResultStore
+
     folder = Path(EXCEL_FOLDER)
     files = sorted(folder.glob("*.xlsx"))
-    results = []
-
-    for f in files:
-        print(f"\n=== Processing {f.name} ===")
-        try:
-            run_margin_calc(str(f))
-        except Exception as e:
-            result = f"Error: {e}"
-            print("❌", result)
-        results.append({"file": f.name, "result": result})
-
-    # Save results to CSV
-    with open(OUTPUT_CSV, "w", newline="") as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=["file", "result"])
-        writer.writeheader()
-        writer.writerows(results)
-
-    print(f"\n✅ All results saved to {OUTPUT_CSV}")
+    runs = []
+    session = BrowserSession()
+
+    try:
+        for f in files:
+            print(f"\n=== Processing {f.name} ===")
+            timings = {}
+            run = {"source_file": str(f.resolve()), "timings": timings}
+            run["started_at"] = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+            try:
+                run["margins"] = session.run(
+                    _perform_margin_calculation, f.resolve(), timings=timings
+                )
+                print(f"✅ {f.name} → {sum(run['margins'].values()):,.2f}")
+            except Exception as e:
+                run["margins"] = {}
+                run["error"] = str(e)
+                print("❌", f"Error: {e}")
+            # The batch is saved at the end; keep when this file actually finished
+            run["finished_at"] = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+            runs.append(run)
+    finally:
+        session.close()
+
+    # Save all results in one transaction, then export this batch to CSV
+    store = ResultStore(RESULTS_DB)
+    run_ids = store.record_runs(runs)
+    store.export_csv(OUTPUT_CSV, run_ids=run_ids)
+    store.close()
+
+    print(f"\n✅ {len(run_ids)} run(s) saved to {RESULTS_DB} (exported to {OUTPUT_CSV})")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,257 @@
+"""
+Self-healing selector cache for the ICA UI automation.
+
+Each logical control (e.g. "run_analytics_button") is registered with a
+semantic Playwright locator (get_by_role / get_by_text). The first time it is
+found, a fast CSS selector for the element is learned and stored on disk
+together with a fingerprint of the element: its role, its position among
+its siblings, the path of its parents and its text. Later lookups try the
+cached CSS first; if it no longer matches an element with the same
+fingerprint, the semantic locator is used and the selector is re-learned.
+Lookup and learning timings are kept per control.
+"""
+
+import json
+import os
+import tempfile
+import time
+from pathlib import Path
+from threading import Lock
+
+# ---------------------------------------------------------------------
+# CONFIG
+# ---------------------------------------------------------------------
+SELECTOR_CACHE_FILE = "selector_cache.json"  # Learned selectors
+CACHED_WAIT_MS = 5000  # How long a cached selector may take to appear
+LEARN_WAIT_MS = 10000  # How long the semantic locator may take when learning
+# ---------------------------------------------------------------------
+
+# Builds a short CSS selector that matches only ``el``. Attribute values with
+# long digit runs (generated ids such as cell-1468) or check-state text are
+# skipped because they change between sessions.
+_LEARN_JS = r"""
+(el) => {
+    const stable = (v) => v && !/\d{3,}/.test(v) && !/\((un)?checked\)/.test(v);
+    const unique = (sel) => {
+        try {
+            const found = document.querySelectorAll(sel);
+            return found.length === 1 && found[0] === el;
+        } catch (e) {
+            return false;
+        }
+    };
+    const quote = (v) => '"' + v.replace(/\\/g, '\\\\').replace(/"/g, '\\"') + '"';
+    const tag = el.tagName.toLowerCase();
+
+    if (stable(el.id) && unique('#' + CSS.escape(el.id))) return '#' + CSS.escape(el.id);
+    for (const attr of ['data-testid', 'data-test', 'data-qa', 'name', 'aria-label',
+                        'title', 'type', 'role', 'col-id', 'ref']) {
+        const v = el.getAttribute(attr);
+        if (stable(v)) {
+            const sel = `${tag}[${attr}=${quote(v)}]`;
+            if (unique(sel)) return sel;
+        }
+    }
+
+    const parts = [];
+    let node = el;
+    while (node && node.nodeType === 1 && node !== document.documentElement) {
+        if (node !== el && stable(node.id)) {
+            parts.unshift('#' + CSS.escape(node.id));
+        } else {
+            let part = node.tagName.toLowerCase();
+            const parent = node.parentElement;
+            if (parent) {
+                const same = [...parent.children].filter((c) => c.tagName === node.tagName);
+                if (same.length > 1) part += `:nth-of-type(${same.indexOf(node) + 1})`;
+            }
+            parts.unshift(part);
+        }
+        const sel = parts.join(' > ');
+        if (unique(sel)) return sel;
+        if (parts[0].startsWith('#')) break;
+        node = node.parentElement;
+    }
+    return null;
+}
+"""
+
+# Used to confirm a cached selector still points at the same control: two
+# buttons with the same label (e.g. the two "Delete" buttons) differ in
+# role, sibling index or parent path even when their text matches.
+_FINGERPRINT_JS = r"""
+(el) => {
+    const clean = (s) => (s || '')
+        .replace(/\((un)?checked\)/g, '')
+        .replace(/\d+/g, '#')
+        .replace(/\s+/g, ' ')
+        .trim()
+        .slice(0, 80);
+    const roleOf = (node) => node.getAttribute('role') || node.tagName.toLowerCase();
+    const siblings = el.parentElement ? [...el.parentElement.children] : [el];
+    const path = [];
+    for (let node = el.parentElement; node && node !== document.body && path.length < 4;
+         node = node.parentElement) {
+        path.unshift(roleOf(node));
+    }
+    const row = el.closest('[role="row"]');
+    const own = clean(el.getAttribute('aria-label') || el.innerText || el.value);
+    return {
+        role: roleOf(el),
+        index: siblings.filter((c) => c.tagName === el.tagName).indexOf(el),
+        path: path.join(' > '),
+        text: row ? own + ' | ' + clean(row.innerText) : own,
+    };
+}
+"""
+
+
+class _ControlStats:
+    def __init__(self):
+        self.lookups = 0
+        self.cache_hits = 0
+        self.fallbacks = 0
+        self.learned = 0
+        self.cached_seconds = 0.0
+        self.semantic_seconds = 0.0  # Finding the element only, not learning it
+        self.learn_seconds = 0.0
+
+    def to_dict(self):
+        return {
+            "lookups": self.lookups,
+            "cache_hits": self.cache_hits,
+            "fallbacks": self.fallbacks,
+            "learned": self.learned,
+            "avg_cached_ms": 1000 * self.cached_seconds / self.cache_hits
+            if self.cache_hits
+            else None,
+            "avg_semantic_ms": 1000 * self.semantic_seconds / self.fallbacks
+            if self.fallbacks
+            else None,
+            "avg_learn_ms": 1000 * self.learn_seconds / self.learned
+            if self.learned
+            else None,
+        }
+
+
+class SelectorRegistry:
+    """Resolve logical controls through cached CSS selectors with semantic fallback."""
+
+    def __init__(self, path=SELECTOR_CACHE_FILE):
+        self.path = Path(path)
+        self._controls = {}
+        self._stats = {}
+        self._lock = Lock()
+        self._cache = {}
+        if self.path.exists():
+            try:
+                self._cache = json.loads(self.path.read_text())
+            except (OSError, ValueError) as e:
+                print(f"⚠️ Ignoring unreadable selector cache {self.path}: {e}")
+
+    def register(self, name, semantic, optional=False):
+        """
+        Register a control.
+
+        ``semantic(page)`` returns the Playwright locator that defines the
+        control. ``optional`` controls may legitimately be absent, so lookups
+        do not wait for them.
+        """
+        self._controls[name] = (semantic, optional)
+        self._stats.setdefault(name, _ControlStats())
+
+    def locate(self, page, name):
+        """Return a locator for control ``name`` (cached CSS when still valid)."""
+        semantic, optional = self._controls[name]
+        stats = self._stats[name]
+        stats.lookups += 1
+
+        entry = self._cache.get(name)
+        if entry:
+            start = time.perf_counter()
+            locator = page.locator(entry["css"]).first
+            if self._still_valid(locator, entry, optional):
+                stats.cache_hits += 1
+                stats.cached_seconds += time.perf_counter() - start
+                return locator
+
+        start = time.perf_counter()
+        locator = semantic(page)
+        try:
+            if optional and locator.count() == 0:
+                return locator
+            locator.wait_for(state="attached", timeout=LEARN_WAIT_MS)
+        except Exception:  # noqa: BLE001 - the caller's action reports the real error
+            return locator
+        finally:
+            stats.fallbacks += 1
+            stats.semantic_seconds += time.perf_counter() - start
+
+        # Learning is a one-off cost; it is timed apart from the lookup so
+        # the cached vs. semantic comparison stays like for like
+        start = time.perf_counter()
+        try:
+            if self._learn(name, locator):
+                stats.learn_seconds += time.perf_counter() - start
+        except Exception:  # noqa: BLE001 - the lookup itself succeeded
+            pass
+        return locator
+
+    def _still_valid(self, locator, entry, optional):
+        try:
+            if optional:
+                if locator.count() == 0:
+                    return False
+            else:
+                locator.wait_for(state="attached", timeout=CACHED_WAIT_MS)
+            return locator.evaluate(_FINGERPRINT_JS) == entry.get("fingerprint")
+        except Exception:  # noqa: BLE001 - any failure means "re-learn"
+            return False
+
+    def _learn(self, name, locator):
+        css = locator.evaluate(_LEARN_JS)
+        if not css:
+            return False
+        fingerprint = locator.evaluate(_FINGERPRINT_JS)
+        with self._lock:
+            self._cache[name] = {
+                "css": css,
+                "fingerprint": fingerprint,
+                "learned_at": time.time(),
+            }
+            self._stats[name].learned += 1
+            self._save()
+        return True
+
+    def _save(self):
+        # A unique temp file per write: several sessions share one cache file
+        directory = self.path.resolve().parent
+        f = tempfile.NamedTemporaryFile(
+            "w", dir=directory, prefix=self.path.name + ".", suffix=".tmp", delete=False
+        )
+        try:
+            with f:
+                json.dump(self._cache, f, indent=2, sort_keys=True)
+            os.replace(f.name, self.path)
+        except BaseException:
+            Path(f.name).unlink(missing_ok=True)
+            raise
+
+    def forget(self, name=None):
+        """Drop one learned selector (or all of them)."""
+        with self._lock:
+            if name is None:
+                self._cache.clear()
+            else:
+                self._cache.pop(name, None)
+            self._save()
+
+    def stats(self):
+        """Per-control lookup counts and average cached vs. semantic lookup time."""
+        return {name: stats.to_dict() for name, stats in self._stats.items()}
+
+
+if __name__ == "__main__":
+    registry = SelectorRegistry()
+    for control, entry in sorted(registry._cache.items()):
+        print(f"{control:<32} {entry['css']}")
@@ -0,0 +1,250 @@
+"""
+Resource and latency monitoring for BrowserSession.
+
+After every task the session samples the resident memory of its own
+Chromium (the browser process it launched and that process's children, so
+other sessions in the same process are not counted), the page's JS heap
+(through CDP) and the task's phase timings. Phase timings are only compared
+between calculations of a similar size (see ``record_task``). When a
+threshold is crossed it
+recycles the page, the context or the whole browser before the
+next task starts, never in the middle of one. ``stats()`` exposes the
+numbers for monitoring.
+"""
+
+import os
+import statistics
+import sys
+import time
+from collections import deque
+from threading import Lock
+
+# ---------------------------------------------------------------------
+# CONFIG (set a threshold to None to disable it)
+# ---------------------------------------------------------------------
+RECYCLE_MAX_TASKS = 200  # Tasks on one context before it is recreated
+RECYCLE_MAX_JS_HEAP_MB = 400  # Page JS heap before the page is recreated
+RECYCLE_MAX_RSS_MB = 2500  # Chromium resident memory before a relaunch
+RECYCLE_LATENCY_FACTOR = 2.0  # Rolling median vs. baseline before a recycle
+LATENCY_WINDOW = 20  # Recent samples kept per phase and job size
+LATENCY_MIN_SAMPLES = 5  # Samples needed before latency is judged
+# ---------------------------------------------------------------------
+
+# Recycle levels, from cheapest to most expensive
+PAGE = "page"
+CONTEXT = "context"
+BROWSER = "browser"
+_LEVELS = (PAGE, CONTEXT, BROWSER)
+
+
+def browser_pid(browser):
+    """PID of a Playwright Chromium browser's main process (asked over CDP)."""
+    cdp = browser.new_browser_cdp_session()
+    try:
+        processes = cdp.send("SystemInfo.getProcessInfo")["processInfo"]
+    finally:
+        cdp.detach()
+    return next((p["id"] for p in processes if p["type"] == "browser"), None)
+
+
+def chromium_rss_mb(pid):
+    """Resident memory (MB) of the browser process ``pid`` and all its children."""
+    try:
+        import psutil
+    except ImportError:
+        psutil = None
+
+    if psutil is not None:
+        try:
+            root = psutil.Process(pid)
+            processes = [root] + root.children(recursive=True)
+        except psutil.Error:
+            return None
+        total = 0
+        for process in processes:
+            try:
+                total += process.memory_info().rss
+            except psutil.Error:
+                continue
+        return total / 1024 / 1024
+
+    if sys.platform.startswith("linux"):
+        return _linux_tree_rss_mb(pid)
+    return None  # psutil is needed on other platforms
+
+
+def _linux_tree_rss_mb(root):
+    parents = {}
+    rss = {}
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                stat = f.read()
+            with open(f"/proc/{pid}/statm") as f:
+                rss_pages = int(f.read().split()[1])
+        except OSError:
+            continue
+        ppid = int(stat[stat.rindex(")") + 2 :].split()[1])
+        parents.setdefault(ppid, []).append(int(pid))
+        rss[int(pid)] = rss_pages
+
+    if root not in rss:
+        return None
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    total = 0
+    stack = [root]
+    while stack:
+        pid = stack.pop()
+        stack.extend(parents.get(pid, []))
+        total += rss.get(pid, 0) * page_size
+    return total / 1024 / 1024
+
+
+class SessionMonitor:
+    """Collects per-session health numbers and decides when to recycle."""
+
+    def __init__(
+        self,
+        max_tasks=RECYCLE_MAX_TASKS,
+        max_js_heap_mb=RECYCLE_MAX_JS_HEAP_MB,
+        max_rss_mb=RECYCLE_MAX_RSS_MB,
+        latency_factor=RECYCLE_LATENCY_FACTOR,
+    ):
+        self.max_tasks = max_tasks
+        self.max_js_heap_mb = max_js_heap_mb
+        self.max_rss_mb = max_rss_mb
+        self.latency_factor = latency_factor
+
+        self._lock = Lock()
+        self._cdp = None
+        self._cdp_page = None
+        self._browser = None
+        self._browser_pid = None
+        self.tasks_total = 0
+        self.tasks_since_recycle = 0
+        self.recycles = {level: 0 for level in _LEVELS}
+        self.last_recycle = None
+        self.rss_mb = None
+        self.js_heap_mb = None
+        self.started_at = time.time()
+        self._latency = {}
+        self._baseline = {}
+
+    # -- sampling (worker thread) --------------------------------------
+
+    def record_task(self, duration, timings=None, portfolios=None):
+        """
+        Record one finished task and its phase timings.
+
+        Only calculations that report phase ``timings`` and how many
+        ``portfolios`` they priced are judged, and each phase is compared with
+        earlier calculations of the same size class (the portfolio count
+        rounded down to a power of two): a one-portfolio delta run is never
+        measured against a merged batch. Warm-up, pipelined and attribution
+        tasks only count towards RECYCLE_MAX_TASKS.
+        """
+        with self._lock:
+            self.tasks_total += 1
+            self.tasks_since_recycle += 1
+            if not timings or not portfolios:
+                return
+            size = 2 ** (portfolios.bit_length() - 1)
+            for phase, seconds in timings.items():
+                key = f"{phase}/{size}+"
+                window = self._latency.setdefault(key, deque(maxlen=LATENCY_WINDOW))
+                window.append(seconds)
+                if key not in self._baseline and len(window) >= LATENCY_MIN_SAMPLES:
+                    self._baseline[key] = statistics.median(window)
+
+    def sample(self, page):
+        """Read this session's Chromium RSS and the page's JS heap size (best effort)."""
+        rss = None
+        heap = None
+        if page is not None and not page.is_closed():
+            try:
+                browser = page.context.browser
+                if browser is not None and browser is not self._browser:
+                    self._browser = browser
+                    self._browser_pid = None
+                    self._browser_pid = browser_pid(browser)
+                if self._browser_pid is not None:
+                    rss = chromium_rss_mb(self._browser_pid)
+            except Exception:  # noqa: BLE001 - monitoring must never fail a job
+                pass
+            try:
+                if self._cdp is None or self._cdp_page is not page:
+                    self._cdp = page.context.new_cdp_session(page)
+                    self._cdp.send("Performance.enable")
+                    self._cdp_page = page
+                metrics = self._cdp.send("Performance.getMetrics")["metrics"]
+                used = next(m["value"] for m in metrics if m["name"] == "JSHeapUsedSize")
+                heap = used / 1024 / 1024
+            except Exception:  # noqa: BLE001 - CDP is Chromium-only / best effort
+                self._cdp = None
+        with self._lock:
+            self.rss_mb = rss
+            self.js_heap_mb = heap
+
+    # -- decisions -----------------------------------------------------
+
+    def _slow_phase(self):
+        if not self.latency_factor:
+            return None
+        for phase, window in self._latency.items():
+            baseline = self._baseline.get(phase)
+            if baseline and len(window) >= LATENCY_MIN_SAMPLES:
+                current = statistics.median(window)
+                if current > baseline * self.latency_factor:
+                    return phase, current, baseline
+        return None
+
+    def recycle_level(self):
+        """Return (level, reason) if the session should be recycled now, else None."""
+        with self._lock:
+            if self.max_rss_mb and self.rss_mb and self.rss_mb > self.max_rss_mb:
+                return BROWSER, f"Chromium RSS {self.rss_mb:.0f} MB > {self.max_rss_mb} MB"
+            slow = self._slow_phase()
+            if slow:
+                phase, current, baseline = slow
+                return CONTEXT, (
+                    f"'{phase}' median {current:.1f}s > "
+                    f"{self.latency_factor}x baseline {baseline:.1f}s"
+                )
+            if self.max_tasks and self.tasks_since_recycle >= self.max_tasks:
+                return CONTEXT, f"{self.tasks_since_recycle} tasks since last recycle"
+            if self.max_js_heap_mb and self.js_heap_mb and self.js_heap_mb > self.max_js_heap_mb:
+                return PAGE, f"JS heap {self.js_heap_mb:.0f} MB > {self.max_js_heap_mb} MB"
+        return None
+
+    def recycled(self, level, reason):
+        """Note that a recycle happened and reset the rolling windows."""
+        with self._lock:
+            self.recycles[level] += 1
+            self.last_recycle = {"level": level, "reason": reason, "at": time.time()}
+            self.tasks_since_recycle = 0
+            for window in self._latency.values():
+                window.clear()
+            self._cdp = None
+            self._cdp_page = None
+
+    def stats(self):
+        """Snapshot of the session's health numbers."""
+        with self._lock:
+            return {
+                "tasks_total": self.tasks_total,
+                "tasks_since_recycle": self.tasks_since_recycle,
+                "browser_pid": self._browser_pid,
+                "rss_mb": self.rss_mb,
+                "js_heap_mb": self.js_heap_mb,
+                "recycles": dict(self.recycles),
+                "last_recycle": self.last_recycle,
+                "latency_median": {
+                    phase: statistics.median(window)
+                    for phase, window in self._latency.items()
+                    if window
+                },
+                "latency_baseline": dict(self._baseline),
+                "uptime": time.time() - self.started_at,
+            }
@@ -0,0 +1,16 @@
+from backends import ICE, CalculatorBackend, _run_venue
+
+
+class _SameNameBackend(CalculatorBackend):
+    name = "fake"
+    venue = ICE
+
+    def calculate(self, path, store=None, timeout=None):
+        return {"Account": 100.0}
+
+
+def test_books_sharing_a_portfolio_name_are_all_counted():
+    result = _run_venue(_SameNameBackend(), ["a.xlsx", "b.xlsx"], None, None)
+
+    assert result["total"] == 200.0
+    assert result["margins"] == {("a.xlsx", "Account"): 100.0, ("b.xlsx", "Account"): 100.0}
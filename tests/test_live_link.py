@@ -0,0 +1,104 @@
+from live_link import FakeEventSource, LiveLink
+from position_delta import portfolio_hashes
+from result_store import ResultStore
+
+HEADERS = ["Portfolio Name", "Exchange Code", "Exchange Contract Code", "Quantity"]
+ROWS = [
+    ["PF-A", "IFEU", "B", 10],
+    ["PF-A", "IFEU", "G", -5],
+    ["PF-B", "IFLL", "R", 3],
+    ["PF-B", "IFLL", "I", 7],
+]
+QUANTITY = HEADERS.index("Quantity") + 1
+
+
+def _link(source=None):
+    source = source or FakeEventSource([HEADERS] + ROWS)
+    return source, LiveLink("book.xlsx", source=source).start()
+
+
+def test_edit_updates_mirror_and_dirty_rows():
+    source, link = _link()
+    link.plan_delta(ResultStore(":memory:"))  # Hashes everything; nothing dirty after
+    assert link.changes() == ([], set())
+
+    source.edit(3, QUANTITY, 250)
+
+    headers, rows = link.positions()
+    assert dict(rows)[3] == ("PF-A", "IFEU", "G", 250)
+    assert link.changes() == ([3], {"PF-A"})
+    assert link.reloads == 1
+
+
+def test_edit_moving_row_to_other_portfolio_marks_both():
+    source, link = _link()
+    link.plan_delta(ResultStore(":memory:"))
+
+    source.edit(2, 1, "PF-B")
+
+    assert link.changes() == ([2], {"PF-A", "PF-B"})
+
+
+def test_insert_row_reloads_mirror():
+    source, link = _link()
+
+    source.insert_row(3, ["PF-A", "IFEU", "M", 1])
+
+    headers, rows = link.positions()
+    assert link.reloads == 2
+    assert [values for _, values in rows][1] == ("PF-A", "IFEU", "M", 1)
+    assert dict(rows)[4] == ("PF-A", "IFEU", "G", -5)  # Shifted down one row
+
+
+def test_plan_delta_matches_file_hashes_and_reuses_unchanged():
+    store = ResultStore(":memory:")
+    source, link = _link()
+
+    plan = link.plan_delta(store)
+    assert sorted(plan.changed) == ["PF-A", "PF-B"]
+    store.save_portfolio_states(plan.states({"PF-A": 100.0, "PF-B": 200.0}))
+
+    source.edit(4, QUANTITY, 4)
+    plan = link.plan_delta(store)
+
+    assert plan.changed == ["PF-B"]
+    assert plan.reused == {"PF-A": 100.0}
+    hashes, _ = portfolio_hashes(*link.positions())
+    assert plan.hashes == hashes
+
+
+def test_edit_during_reload_is_not_lost():
+    class SlowSource(FakeEventSource):
+        def snapshot(self):
+            grid = super().snapshot()
+            # Excel fires the event after the sheet was read, before the mirror is built
+            self.edit(2, QUANTITY, 99)
+            return grid
+
+    source = SlowSource([HEADERS] + ROWS)
+    link = LiveLink("book.xlsx", source=source)
+    source.start(link._on_change, link._on_resync)
+    link.reload()
+
+    headers, rows = link.positions()
+    assert dict(rows)[2] == ("PF-A", "IFEU", "B", 99)
+    assert link.reloads == 1
+
+
+def test_resync_during_reload_leaves_mirror_stale():
+    class InsertingSource(FakeEventSource):
+        inserted = False
+
+        def snapshot(self):
+            grid = super().snapshot()
+            if not self.inserted:
+                self.inserted = True
+                self.insert_row(2, ["PF-C", "IFEU", "B", 1])
+            return grid
+
+    source = InsertingSource([HEADERS] + ROWS)
+    link = LiveLink("book.xlsx", source=source).start()
+
+    headers, rows = link.positions()
+    assert link.reloads == 2
+    assert dict(rows)[2] == ("PF-C", "IFEU", "B", 1)
@@ -0,0 +1,27 @@
+import shutil
+from pathlib import Path
+
+from openpyxl import load_workbook
+
+from margin_attribution import ATTRIBUTION_COLUMN, write_contributions_to_excel
+from margin_calculator import read_positions
+
+SAMPLE = Path(__file__).resolve().parent.parent / "excels" / "ICE Live (2).xlsx"
+
+
+def test_contributions_leave_the_formula_book_untouched(tmp_path):
+    book = tmp_path / SAMPLE.name
+    shutil.copy(SAMPLE, book)
+    headers, rows = read_positions(book)
+    data = book.read_bytes()
+
+    path = write_contributions_to_excel(book, headers, rows, {36: 12.5})
+
+    assert book.read_bytes() == data
+    ws = load_workbook(path).active
+    table = list(ws.iter_rows(values_only=True))
+    assert table[0][-1] == ATTRIBUTION_COLUMN
+    row_36 = next(r for r in table[1:] if r[0] == 36)
+    expiry = headers.index("Expiry Date") + 1
+    assert row_36[expiry] == dict(rows)[36][expiry - 1] is not None  # The formula's value
+    assert row_36[-1] == 12.5
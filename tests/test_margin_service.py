@@ -0,0 +1,36 @@
+import shutil
+
+from margin_calculator import PORTFOLIO_COLUMN
+from margin_service import MarginService
+from recovery import UploadRejected
+
+HEADERS = [PORTFOLIO_COLUMN, "Exchange Code", "Quantity"]
+
+
+class _RejectingSession:
+    """Rejects any upload that contains a portfolio named BAD."""
+
+    def run(self, fn, upload_path, names, timings=None):
+        if any(name.endswith("_BAD") for name in names):
+            raise UploadRejected("ICA rejected the upload: invalid contract")
+        return {name: 100.0 for name in names}
+
+
+def test_rejected_book_fails_only_its_own_caller(tmp_path):
+    service = MarginService()
+    try:
+        jobs = []
+        for name, portfolio in (("a.xlsx", "PF-A"), ("bad.xlsx", "BAD"), ("c.xlsx", "PF-C")):
+            (tmp_path / name).write_bytes(b"")
+            job = service.submit_path(tmp_path / name)
+            job.headers, job.rows = HEADERS, [(2, (portfolio, "IFEU", 1))]
+            jobs.append(job)
+
+        service._run_batch(_RejectingSession(), jobs)
+
+        assert [job.status for job in jobs] == ["done", "error", "done"]
+        assert jobs[0].result == {"PF-A": 100.0}
+        assert "rejected" in jobs[1].error
+    finally:
+        service.close()
+        shutil.rmtree(service._work_dir, ignore_errors=True)
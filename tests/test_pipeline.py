@@ -0,0 +1,25 @@
+from pipeline import run_pipelined
+
+
+class _TimedOutSession:
+    """Gives up on the pipelined task while the worker still holds it."""
+
+    def run(self, fn, books, depth, report, result_timeout, timeout=None):
+        self.books, self.report = books, report
+        raise TimeoutError("Task exceeded 1s")
+
+
+def test_book_finished_after_run_timeout_is_reported_once(tmp_path):
+    session = _TimedOutSession()
+    calls = []
+
+    results = run_pipelined(
+        [tmp_path / "a.xlsx"],
+        session=session,
+        on_result=lambda *args: calls.append(args),
+        timeout=1,
+    )
+    session.report(session.books[0], {"Account": 1.0}, None)  # The worker finishes late
+
+    assert [(path.name, error) for path, _, error in results] == [("a.xlsx", "Task exceeded 1s")]
+    assert len(calls) == 1
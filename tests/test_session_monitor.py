@@ -0,0 +1,29 @@
+from session_monitor import CONTEXT, LATENCY_MIN_SAMPLES, SessionMonitor
+
+
+def _monitor():
+    return SessionMonitor(max_tasks=None, max_js_heap_mb=None, max_rss_mb=None)
+
+
+def test_larger_jobs_are_not_judged_against_small_ones():
+    monitor = _monitor()
+    for _ in range(LATENCY_MIN_SAMPLES):
+        monitor.record_task(0.1)  # Warm-up tasks
+        monitor.record_task(20.0, {"run": 10.0}, portfolios=1)
+    for _ in range(LATENCY_MIN_SAMPLES):
+        monitor.record_task(600.0)  # A pipelined run reports no phase timings
+        monitor.record_task(90.0, {"run": 60.0}, portfolios=40)
+
+    assert monitor.recycle_level() is None
+
+
+def test_slower_jobs_of_the_same_size_recycle_the_context():
+    monitor = _monitor()
+    for _ in range(LATENCY_MIN_SAMPLES):
+        monitor.record_task(20.0, {"run": 10.0}, portfolios=5)
+    for _ in range(LATENCY_MIN_SAMPLES + 1):
+        monitor.record_task(60.0, {"run": 50.0}, portfolios=6)
+
+    level, reason = monitor.recycle_level()
+    assert level == CONTEXT
+    assert "'run/4+'" in reason
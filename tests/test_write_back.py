@@ -0,0 +1,32 @@
+import shutil
+from pathlib import Path
+
+from openpyxl import load_workbook
+
+from margin_calculator import margin_results_path, read_positions, write_margin_to_excel
+
+SAMPLE = Path(__file__).resolve().parent.parent / "excels" / "ICE Live (2).xlsx"
+
+
+def test_write_back_keeps_formula_values(tmp_path):
+    book = tmp_path / SAMPLE.name
+    shutil.copy(SAMPLE, book)
+    assert load_workbook(book)["Sheet1"]["F36"].value == "=F35+300"  # A formula cell
+    before = read_positions(book)
+    assert dict(before[1])[36][before[0].index("Expiry Date")] is not None
+    data = book.read_bytes()
+
+    path = write_margin_to_excel(book, 1234.5)
+
+    assert book.read_bytes() == data
+    assert read_positions(book) == before
+    assert path == margin_results_path(book)
+    ws = load_workbook(path).active
+    assert [c.value for c in ws[2]][:2] == [book.name, 1234.5]
+
+
+def test_write_back_failure_returns_none(tmp_path):
+    book = tmp_path / "book.xlsx"
+    margin_results_path(book).parent.write_text("not a directory")
+
+    assert write_margin_to_excel(book, 1.0) is None